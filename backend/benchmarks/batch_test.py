@@ -0,0 +1,83 @@
+"""
+Batch endpoint check against a local stub LLM
+
+Uploads N synthetic PDFs to /analyze-batch (as individual files or one zip),
+polls GET /batches/{id} until the batch finishes and reports throughput.
+With BATCH_MAX_CONCURRENCY workers the wall-clock time should be roughly
+N / workers x (single document).
+
+Usage (from backend/):
+    BATCH_MAX_CONCURRENCY=4 python benchmarks/batch_test.py --documents 16 --zip
+"""
+import io
+import os
+import sys
+import time
+import asyncio
+import zipfile
+import argparse
+import tempfile
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from stub_llm import install_stub_llm
+from synthetic_pdf import make_text_pdf
+
+
+async def run(num_documents: int, latency: float, pages: int, as_zip: bool):
+    # Keep the benchmark database out of the working tree
+    os.chdir(tempfile.mkdtemp(prefix="pdf-batch-test-"))
+    install_stub_llm(latency=latency)
+
+    import httpx
+    from main import app
+    from core.batch import batch_processor
+
+    pdfs = [(f"doc_{i}.pdf", make_text_pdf(pages, seed=i)) for i in range(num_documents)]
+    if as_zip:
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w") as archive:
+            for name, data in pdfs:
+                archive.writestr(f"batch/{name}", data)
+        files = [("files", ("batch.zip", buffer.getvalue(), "application/zip"))]
+    else:
+        files = [("files", (name, data, "application/pdf")) for name, data in pdfs]
+
+    async with httpx.AsyncClient(app=app, base_url="http://test", timeout=None) as client:
+        start = time.perf_counter()
+        response = await client.post("/analyze-batch", files=files)
+        response.raise_for_status()
+        batch_id = response.json()["batch_id"]
+        print(f"batch {batch_id}: {response.json()['total_items']} documents queued")
+
+        while True:
+            batch = (await client.get(f"/batches/{batch_id}")).json()
+            if batch["status"] == "completed":
+                break
+            await asyncio.sleep(0.1)
+        elapsed = time.perf_counter() - start
+
+        results = (await client.get(f"/batches/{batch_id}/results")).json()["results"]
+        await batch_processor.stop()
+
+    with_result = sum(1 for r in results if r["result"])
+    print(f"completed {batch['completed_items']}, failed {batch['failed_items']}, with stored result {with_result}")
+    print(f"workers                : {batch_processor.max_concurrency}")
+    print(f"wall clock             : {elapsed:.2f}s")
+    print(f"throughput             : {num_documents / elapsed:.2f} documents/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--documents", type=int, default=16)
+    parser.add_argument("--latency", type=float, default=0.2, help="stub LLM latency per call (seconds)")
+    parser.add_argument("--pages", type=int, default=2)
+    parser.add_argument("--zip", action="store_true", help="upload the documents as one zip archive")
+    args = parser.parse_args()
+    asyncio.run(run(args.documents, args.latency, args.pages, args.zip))
+
+
+if __name__ == "__main__":
+    main()
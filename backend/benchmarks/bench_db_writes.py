@@ -0,0 +1,98 @@
+"""
+Persistence benchmark: inline commits vs the write-behind queue
+
+Simulates N requests finishing concurrently, each persisting one analysis
+result and one analytics session. Inline, every request makes two commits
+and waits for them; write-behind, requests only enqueue and the writer
+commits many records per transaction.
+
+Usage (from backend/):
+    python benchmarks/bench_db_writes.py --requests 500 --concurrency 16
+"""
+import os
+import sys
+import time
+import uuid
+import argparse
+import tempfile
+import statistics
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+
+def fake_records():
+    session_id = str(uuid.uuid4())
+    now = datetime.now().isoformat()
+    result = {
+        "document_type": "Contract",
+        "summary": "A twelve month services agreement. " * 20,
+        "key_sections": {"Parties": "Acme and Globex", "Term": "12 months"},
+        "insights": ["Risk: No termination clause"],
+        "agent_trace": ["Classifier Agent: Identified document as Contract"] * 5
+    }
+    report = {
+        "session_id": session_id,
+        "start_timestamp": now,
+        "end_timestamp": now,
+        "total_duration_seconds": 1.5,
+        "metadata": {"filename": "bench.pdf", "model": "bench-model", "document_type": "Contract"},
+        "token_usage": {"total_tokens": 1200, "prompt_tokens": 1000, "completion_tokens": 200, "api_calls": 4,
+                        "estimated_cost_usd": 0.0001, "call_details": [{"model": "bench-model"}] * 4},
+        "agent_execution": {"total_agents": 4, "successful_agents": 4, "failed_agents": 0, "executions": []},
+        "thinking_process": {"flow": "classifier → (extractor ‖ summarizer) → insight_generator"}
+    }
+    return session_id, result, report
+
+
+def run(mode: str, num_requests: int, concurrency: int):
+    from core import db
+    from core.writer import db_writer
+
+    def persist(_):
+        session_id, result, report = fake_records()
+        start = time.perf_counter()
+        if mode == "inline":
+            db.save_analysis("bench.pdf", result, session_id, content_hash="x", cache_key="y")
+            db.save_analytics_session(report)
+        else:
+            db_writer.submit(db.add_analysis, "bench.pdf", result, session_id, content_hash="x", cache_key="y")
+            db_writer.submit(db.add_analytics_session, report)
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = sorted(executor.map(persist, range(num_requests)))
+    request_done = time.perf_counter() - start
+    if mode == "write-behind":
+        db_writer.drain()
+    durable = time.perf_counter() - start
+
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    print(f"{mode:13s} request wait mean {statistics.mean(latencies) * 1000:7.2f} ms  p95 {p95 * 1000:7.2f} ms"
+          f" | all requests done {request_done:6.2f}s | all rows durable {durable:6.2f}s")
+    if mode == "write-behind":
+        stats = db_writer.stats()
+        print(f"{'':13s} {stats['flushes']} flushes, avg batch {stats['average_batch_size']}, "
+              f"avg flush {stats['average_flush_ms']} ms, max queue depth {stats['max_queue_depth']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=16)
+    args = parser.parse_args()
+
+    # Fresh database in a temp dir, outside the working tree
+    os.chdir(tempfile.mkdtemp(prefix="pdf-db-bench-"))
+    from core.db import init_db
+    init_db()
+
+    run("inline", args.requests, args.concurrency)
+    run("write-behind", args.requests, args.concurrency)
+
+
+if __name__ == "__main__":
+    main()
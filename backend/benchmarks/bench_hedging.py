@@ -0,0 +1,123 @@
+"""
+Benchmark: tail latency of LLM calls with and without hedging
+
+Runs classifier calls through core.llm.get_llm against a local mock OpenAI
+server where a share of the requests are stragglers (--slow-fraction,
+--slow-latency). A warm-up fills the latency history hedging works from,
+then the same calls run with hedging off and on. Reports p50/p95/p99,
+the hedge rate and the tokens spent on cancelled requests. Finally one
+call to a server that is always slow shows the agent deadline at work.
+
+Hedging at the p95 only helps while stragglers are rarer than 5% of the
+calls; otherwise the p95 is the stragglers' own latency.
+
+Usage (from backend/):
+    python benchmarks/bench_hedging.py --calls 400 --slow-fraction 0.02 --slow-latency 1.5
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import statistics
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# No prompt cache: every call has to reach the mock provider
+os.environ.setdefault("LLM_CACHE_ENABLED", "0")
+
+from langchain_core.output_parsers import JsonOutputParser
+
+import core.llm
+import core.hedging
+from mock_openai_server import MockServer, create_app
+from core.agents import CLASSIFIER_PROMPT
+from core.analytics import TokenUsageTracker
+from core.hedging import latency_history, hedge_counters
+
+API_KEY = "mock-key"
+INPUTS = {"text": "This agreement is made between Acme and Globex. " * 20}
+
+
+async def run_calls(calls: int, concurrency: int, deadline_seconds: float = None):
+    tracker = TokenUsageTracker()
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, errors = [], []
+
+    async def one():
+        async with semaphore:
+            deadline = time.monotonic() + deadline_seconds if deadline_seconds else None
+            chain = CLASSIFIER_PROMPT | core.llm.get_llm([tracker], deadline=deadline) | JsonOutputParser()
+            start = time.perf_counter()
+            try:
+                await chain.ainvoke(INPUTS)
+            except Exception as e:
+                errors.append(e)
+            latencies.append(time.perf_counter() - start)
+
+    await asyncio.gather(*[one() for _ in range(calls)])
+    return sorted(latencies), errors, tracker
+
+
+def percentile(values, q: float) -> float:
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+
+def report(label: str, latencies, tracker):
+    rate_control = tracker.get_summary()["rate_control"]
+    print(
+        f"{label:8s} p50 {statistics.median(latencies) * 1000:7.1f} ms  p95 {percentile(latencies, 0.95) * 1000:7.1f} ms  "
+        f"p99 {percentile(latencies, 0.99) * 1000:7.1f} ms  max {latencies[-1] * 1000:7.1f} ms  "
+        f"hedged {rate_control['hedged_calls']:4d} (rate {rate_control['hedge_rate']:.3f}, won {rate_control['hedge_wins']})  "
+        f"wasted {rate_control['hedge_wasted_tokens']} tokens of {tracker.total_tokens}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.05, help="mock server latency per call (seconds)")
+    parser.add_argument("--slow-fraction", type=float, default=0.02)
+    parser.add_argument("--slow-latency", type=float, default=1.5)
+    parser.add_argument("--min-delay", type=float, default=0.0, help="HEDGE_MIN_DELAY for the run (seconds)")
+    parser.add_argument("--port", type=int, default=8903)
+    args = parser.parse_args()
+
+    app = create_app(args.latency, slow_fraction=args.slow_fraction, slow_latency=args.slow_latency)
+    with MockServer(app, port=args.port) as server:
+        llm = core.llm.build_llm(api_key=API_KEY, base_url=server.base_url, model="mock-model")
+        core.llm.get_shared_llm = lambda: llm
+        core.hedging.HEDGE_MIN_DELAY = args.min_delay
+
+        _, _, warmup = asyncio.run(run_calls(200, args.concurrency))
+        latency_history.observe(warmup.call_details)
+        print(f"Latency history: {latency_history.stats()}")
+        print(f"{args.calls} calls, {args.concurrency} at a time, {args.slow_fraction:.0%} stragglers of {args.slow_latency:.1f} s:")
+
+        core.hedging.HEDGE_ENABLED = False
+        latencies, _, tracker = asyncio.run(run_calls(args.calls, args.concurrency))
+        report("off", latencies, tracker)
+
+        core.hedging.HEDGE_ENABLED = True
+        latencies, _, tracker = asyncio.run(run_calls(args.calls, args.concurrency))
+        report("hedged", latencies, tracker)
+        print(f"process-wide: {hedge_counters.stats()}")
+
+    slow_app = create_app(args.slow_latency * 4)
+    with MockServer(slow_app, port=args.port + 1) as server:
+        llm = core.llm.build_llm(api_key=API_KEY, base_url=server.base_url, model="mock-model")
+        core.llm.get_shared_llm = lambda: llm
+        deadline = args.slow_latency
+        latencies, errors, tracker = asyncio.run(run_calls(1, 1, deadline_seconds=deadline))
+        print(
+            f"Always-slow server ({args.slow_latency * 4:.1f} s), {deadline:.1f} s deadline: returned after "
+            f"{latencies[0]:.2f} s with {type(errors[0]).__name__ if errors else 'no error'}, "
+            f"deadlines exceeded {tracker.get_summary()['rate_control']['deadlines_exceeded']}"
+        )
+
+
+if __name__ == "__main__":
+    main()
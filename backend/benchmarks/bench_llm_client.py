@@ -0,0 +1,100 @@
+"""
+Microbenchmark: shared pooled LLM client vs a new ChatOpenAI per call
+
+Runs the classifier chain against a local mock OpenAI-compatible server,
+once building a fresh ChatOpenAI (new OpenAI + httpx clients, new
+connections) for every call as the agents used to, and once through the
+shared client from core.llm. Reports per-call latency for sequential calls
+and wall-clock time for a concurrent async burst.
+
+Usage (from backend/):
+    python benchmarks/bench_llm_client.py --calls 200 --latency 0.01
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import statistics
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from langchain_openai import ChatOpenAI
+from langchain_core.output_parsers import JsonOutputParser
+
+from mock_openai_server import MockServer, create_app
+from core.llm import build_llm
+from core.agents import CLASSIFIER_PROMPT
+from core.analytics import TokenUsageTracker
+
+API_KEY = "mock-key"
+INPUTS = {"text": "This agreement is made between Acme and Globex. " * 20}
+
+
+def fresh_llm(base_url: str, callbacks):
+    """The old behaviour: a new client (and connection pool) per call"""
+    return ChatOpenAI(model="mock-model", openai_api_key=API_KEY, openai_api_base=base_url, temperature=0.1, callbacks=callbacks)
+
+
+def run_sequential(make_llm, calls: int):
+    timings = []
+    for _ in range(calls):
+        start = time.perf_counter()
+        chain = CLASSIFIER_PROMPT | make_llm([TokenUsageTracker()]) | JsonOutputParser()
+        chain.invoke(INPUTS)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+async def run_concurrent(make_llm, calls: int):
+    async def one():
+        chain = CLASSIFIER_PROMPT | make_llm([TokenUsageTracker()]) | JsonOutputParser()
+        await chain.ainvoke(INPUTS)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[one() for _ in range(calls)])
+    return time.perf_counter() - start
+
+
+def report(label: str, timings):
+    timings = sorted(timings)
+    p95 = timings[int(len(timings) * 0.95) - 1]
+    print(f"{label:8s} mean {statistics.mean(timings) * 1000:7.2f} ms   p50 {statistics.median(timings) * 1000:7.2f} ms   p95 {p95 * 1000:7.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.01, help="mock server latency per call (seconds)")
+    parser.add_argument("--port", type=int, default=8900)
+    args = parser.parse_args()
+
+    with MockServer(create_app(args.latency), port=args.port) as server:
+        shared = build_llm(api_key=API_KEY, base_url=server.base_url, model="mock-model")
+        make_fresh = lambda callbacks: fresh_llm(server.base_url, callbacks)
+        make_shared = lambda callbacks: shared.with_config(callbacks=callbacks)
+
+        # Warm up imports and the shared pool
+        run_sequential(make_fresh, 5)
+        run_sequential(make_shared, 5)
+
+        print(f"Sequential, {args.calls} calls (mock latency {args.latency * 1000:.0f} ms):")
+        report("fresh", run_sequential(make_fresh, args.calls))
+        report("shared", run_sequential(make_shared, args.calls))
+
+        async def burst():
+            fresh_wall = await run_concurrent(make_fresh, args.concurrency)
+            shared_wall = await run_concurrent(make_shared, args.concurrency)
+            return fresh_wall, shared_wall
+
+        fresh_wall, shared_wall = asyncio.run(burst())
+        print(f"Concurrent burst of {args.concurrency} async calls:")
+        print(f"fresh    {fresh_wall * 1000:7.1f} ms wall clock")
+        print(f"shared   {shared_wall * 1000:7.1f} ms wall clock")
+
+
+if __name__ == "__main__":
+    main()
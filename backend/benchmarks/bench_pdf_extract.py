@@ -0,0 +1,47 @@
+"""
+Benchmark for PDF text extraction: in-process vs process pool
+
+Usage (from backend/):
+    python benchmarks/bench_pdf_extract.py --pages 10 100 1000
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from synthetic_pdf import make_text_pdf
+from core.pdf import extract_page_texts, PDF_EXTRACT_WORKERS
+
+
+def best_of(fn, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main(page_counts, repeat: int):
+    # Start the pool outside the timed region
+    extract_page_texts(make_text_pdf(2), parallel=True)
+
+    print(f"workers: {PDF_EXTRACT_WORKERS}")
+    print(f"{'pages':>6} {'serial (s)':>11} {'pool (s)':>9} {'speedup':>8}")
+    for pages in page_counts:
+        pdf = make_text_pdf(pages)
+        serial = best_of(lambda: extract_page_texts(pdf, parallel=False), repeat)
+        pooled = best_of(lambda: extract_page_texts(pdf, parallel=True), repeat)
+        assert extract_page_texts(pdf, parallel=False) == extract_page_texts(pdf, parallel=True)
+        print(f"{pages:>6} {serial:>11.3f} {pooled:>9.3f} {serial / pooled:>7.2f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    main(args.pages, args.repeat)
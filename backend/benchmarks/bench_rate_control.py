@@ -0,0 +1,131 @@
+"""
+Benchmark: LLM calls against a throttling provider, with and without rate control
+
+Fires a burst of concurrent classifier calls at a local mock OpenAI server
+that serves only --capacity requests at once and answers the rest 429.
+Once straight through ChatOpenAI with the OpenAI client's own retries (2,
+short backoff, which is what the agents used to get), and once through
+core.llm.get_llm, i.e. the adaptive concurrency limiter with jittered
+retries. Reports failed calls, 429s, queue wait and the concurrency limit
+the limiter settled on.
+
+A second mock without a capacity limit then gets a burst that alternates
+short (classifier sample) and long (extraction-sized) prompts at a latency
+that does not depend on the prompt, long enough that the client's own
+overhead under load stays well inside the latency tolerance. Nothing is
+congested, so the limiter should not cut its limit: latency per token of
+the long prompts is no baseline for the short ones.
+
+Usage (from backend/):
+    python benchmarks/bench_rate_control.py --calls 200 --capacity 8 --latency 0.05
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import statistics
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# No prompt cache: every call has to reach the mock provider
+os.environ.setdefault("LLM_CACHE_ENABLED", "0")
+
+from langchain_openai import ChatOpenAI
+from langchain_core.output_parsers import JsonOutputParser
+
+import core.llm
+from mock_openai_server import MockServer, create_app
+from core.agents import CLASSIFIER_PROMPT
+from core.analytics import TokenUsageTracker
+from core.ratelimit import AdaptiveConcurrencyLimiter, llm_concurrency_limiter
+
+API_KEY = "mock-key"
+INPUTS = {"text": "This agreement is made between Acme and Globex. " * 20}
+# About 3.5k tokens, the size of an extraction call
+LONG_INPUTS = {"text": "This agreement is made between Acme and Globex. " * 350}
+
+
+async def burst(make_llm, calls: int, mixed: bool = False):
+    tracker = TokenUsageTracker()
+    latencies, failures = [], 0
+
+    async def one(i: int):
+        nonlocal failures
+        chain = CLASSIFIER_PROMPT | make_llm([tracker]) | JsonOutputParser()
+        start = time.perf_counter()
+        try:
+            await chain.ainvoke(LONG_INPUTS if mixed and i % 2 else INPUTS)
+            latencies.append(time.perf_counter() - start)
+        except Exception:
+            failures += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[one(i) for i in range(calls)])
+    return time.perf_counter() - start, latencies, failures, tracker.get_summary()["rate_control"]
+
+
+def report(label: str, app, wall: float, latencies, failures: int, calls: int):
+    latencies = sorted(latencies)
+    p95 = latencies[max(int(len(latencies) * 0.95) - 1, 0)] if latencies else 0
+    print(
+        f"{label:10s} ok {len(latencies):4d}/{calls}  failed {failures:4d}  429s {app.state.throttled:5d}  "
+        f"wall {wall:6.2f} s  p50 {statistics.median(latencies) if latencies else 0:6.3f} s  p95 {p95:6.3f} s"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=200)
+    parser.add_argument("--capacity", type=int, default=8, help="requests the mock serves at once")
+    parser.add_argument("--latency", type=float, default=0.05, help="mock server latency per call (seconds)")
+    parser.add_argument("--latency-per-request", type=float, default=0.002)
+    parser.add_argument("--mixed-latency", type=float, default=0.25, help="mock latency of the mixed-prompt burst (seconds)")
+    parser.add_argument("--port", type=int, default=8901)
+    args = parser.parse_args()
+
+    if llm_concurrency_limiter is None:
+        print("LLM_ADAPTIVE_CONCURRENCY is off; the second run only retries")
+
+    app = create_app(args.latency, capacity=args.capacity, latency_per_request=args.latency_per_request)
+    with MockServer(app, port=args.port) as server:
+        plain = ChatOpenAI(model="mock-model", openai_api_key=API_KEY, openai_api_base=server.base_url, temperature=0.1, max_retries=2)
+        controlled = core.llm.build_llm(api_key=API_KEY, base_url=server.base_url, model="mock-model")
+        core.llm.get_shared_llm = lambda: controlled
+
+        print(f"Burst of {args.calls} async calls, provider capacity {args.capacity} (mock latency {args.latency * 1000:.0f} ms):")
+        wall, latencies, failures, _ = asyncio.run(burst(lambda callbacks: plain.with_config(callbacks=callbacks), args.calls))
+        report("plain", app, wall, latencies, failures, args.calls)
+
+        app.state.throttled = 0
+        app.state.max_in_flight = 0
+        wall, latencies, failures, rate_control = asyncio.run(burst(core.llm.get_llm, args.calls))
+        report("controlled", app, wall, latencies, failures, args.calls)
+        print(
+            f"           queue wait {rate_control['queue_wait_seconds'] / args.calls:.3f} s/call "
+            f"(max {rate_control['max_queue_wait_seconds']:.3f} s), retries {rate_control['retries']} "
+            f"({rate_control['throttled_retries']} throttled), provider max in flight {app.state.max_in_flight}"
+        )
+        if llm_concurrency_limiter is not None:
+            print(f"           limiter: {llm_concurrency_limiter.stats()}")
+
+    if llm_concurrency_limiter is None:
+        return
+    # Fresh limiter, so the mixed run starts from the initial limit
+    limiter = AdaptiveConcurrencyLimiter()
+    core.llm.llm_concurrency_limiter = limiter
+    app = create_app(args.mixed_latency)
+    with MockServer(app, port=args.port + 1) as server:
+        controlled = core.llm.build_llm(api_key=API_KEY, base_url=server.base_url, model="mock-model")
+        core.llm.get_shared_llm = lambda: controlled
+        print(f"Burst of {args.calls} async calls alternating short and long prompts, no provider limit (mock latency {args.mixed_latency * 1000:.0f} ms):")
+        wall, latencies, failures, _ = asyncio.run(burst(core.llm.get_llm, args.calls, mixed=True))
+        report("mixed", app, wall, latencies, failures, args.calls)
+        stats = limiter.stats()
+        print(f"           limiter: limit {stats['limit']}, decreases {stats['decreases']} (expected 0), throttled {stats['throttled']}")
+
+
+if __name__ == "__main__":
+    main()
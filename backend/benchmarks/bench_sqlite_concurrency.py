@@ -0,0 +1,117 @@
+"""
+SQLite concurrency benchmark: driver defaults vs the tuned engine
+
+Starts N writer processes (think N uvicorn workers) that each commit
+analytics sessions inline as fast as they can, plus reader processes
+polling the summary and session listing, all against one database file.
+Runs once with SQLITE_TUNING=0 (rollback journal, deferred transactions)
+and once with the tuned defaults (WAL, synchronous=NORMAL, BEGIN IMMEDIATE,
+busy_timeout). Note that on a single core, WAL readers that no longer block
+compete with the writers for CPU; use --readers 0 to measure writes alone.
+
+Usage (from backend/):
+    python benchmarks/bench_sqlite_concurrency.py --writers 8 --readers 1 --seconds 5
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import multiprocessing
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def _configure(workdir: str, tuning: bool):
+    os.environ["SQLITE_TUNING"] = "1" if tuning else "0"
+    os.environ["WRITE_BEHIND_ENABLED"] = "0"
+    os.chdir(workdir)
+
+
+def writer(workdir: str, tuning: bool, seconds: float, results):
+    _configure(workdir, tuning)
+    from core import db
+    from bench_db_writes import fake_records
+
+    latencies, errors = [], 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        _, _, report = fake_records()
+        start = time.perf_counter()
+        try:
+            db.save_analytics_session(report)
+            latencies.append(time.perf_counter() - start)
+        except Exception:
+            errors += 1
+    results.put(("writer", latencies, errors))
+
+
+def reader(workdir: str, tuning: bool, seconds: float, results):
+    _configure(workdir, tuning)
+    from core import db
+
+    latencies, errors = [], 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        start = time.perf_counter()
+        try:
+            db.get_analytics_summary()
+            db.get_analytics_sessions(limit=20)
+            latencies.append(time.perf_counter() - start)
+        except Exception:
+            errors += 1
+    results.put(("reader", latencies, errors))
+
+
+def p95(values):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[max(0, int(len(values) * 0.95) - 1)]
+
+
+def run(tuning: bool, num_writers: int, num_readers: int, seconds: float):
+    workdir = tempfile.mkdtemp(prefix="pdf-sqlite-bench-")
+    _configure(workdir, tuning)
+    from core.db import init_db
+    init_db()
+
+    ctx = multiprocessing.get_context("spawn")
+    results = ctx.Queue()
+    processes = [ctx.Process(target=writer, args=(workdir, tuning, seconds, results)) for _ in range(num_writers)]
+    processes += [ctx.Process(target=reader, args=(workdir, tuning, seconds, results)) for _ in range(num_readers)]
+    for process in processes:
+        process.start()
+    collected = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+
+    writes = [lat for kind, lats, _ in collected if kind == "writer" for lat in lats]
+    write_errors = sum(errors for kind, _, errors in collected if kind == "writer")
+    reads = [lat for kind, lats, _ in collected if kind == "reader" for lat in lats]
+    read_errors = sum(errors for kind, _, errors in collected if kind == "reader")
+
+    label = "tuned" if tuning else "defaults"
+    print(f"{label:9s} writes {len(writes) / seconds:8.1f}/s  p95 {p95(writes) * 1000:8.2f} ms  errors {write_errors:4d}"
+          f" | reads {len(reads) / seconds:7.1f}/s  p95 {p95(reads) * 1000:8.2f} ms  errors {read_errors:4d}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--writers", type=int, default=8)
+    parser.add_argument("--readers", type=int, default=1)
+    parser.add_argument("--seconds", type=float, default=5.0)
+    args = parser.parse_args()
+
+    # Each run configures core.db from the environment in fresh processes
+    for tuning in (False, True):
+        ctx = multiprocessing.get_context("spawn")
+        process = ctx.Process(target=run, args=(tuning, args.writers, args.readers, args.seconds))
+        process.start()
+        process.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+Load test for /analyze-pdf against a local stub LLM
+
+Fires N concurrent uploads at the ASGI app in-process and reports whether
+the requests overlap. With a blocking request path the wall-clock time is
+roughly N x (single request); with the async path it stays close to one.
+
+Usage (from backend/):
+    python benchmarks/load_test.py --requests 8 --latency 0.5
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from stub_llm import install_stub_llm
+from synthetic_pdf import make_text_pdf
+
+
+async def run(num_requests: int, latency: float, pages: int):
+    # Keep the benchmark database out of the working tree
+    os.chdir(tempfile.mkdtemp(prefix="pdf-load-test-"))
+    install_stub_llm(latency=latency)
+
+    import httpx
+    from main import app
+
+    async def one(client, i):
+        pdf = make_text_pdf(pages, seed=i)
+        start = time.perf_counter()
+        response = await client.post(
+            "/analyze-pdf",
+            files={"file": (f"doc_{i}.pdf", pdf, "application/pdf")},
+            data={"bypass_cache": "true"},
+        )
+        response.raise_for_status()
+        return start, time.perf_counter()
+
+    async with httpx.AsyncClient(app=app, base_url="http://test", timeout=None) as client:
+        # Warm-up request measures the single-request latency
+        warm_start, warm_end = await one(client, -1)
+        single = warm_end - warm_start
+
+        t0 = time.perf_counter()
+        spans = await asyncio.gather(*[one(client, i) for i in range(num_requests)])
+        wall = time.perf_counter() - t0
+
+    # Peak number of requests in flight at the same time
+    events = sorted([(s, 1) for s, _ in spans] + [(e, -1) for _, e in spans])
+    in_flight = peak = 0
+    for _, delta in events:
+        in_flight += delta
+        peak = max(peak, in_flight)
+
+    print(f"single request latency : {single:.2f}s")
+    print(f"{num_requests} concurrent requests : {wall:.2f}s wall clock")
+    print(f"serial estimate        : {single * num_requests:.2f}s")
+    print(f"speedup vs serial      : {single * num_requests / wall:.1f}x")
+    print(f"peak requests in flight: {peak}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.5, help="stub LLM latency per call (seconds)")
+    parser.add_argument("--pages", type=int, default=5)
+    args = parser.parse_args()
+    asyncio.run(run(args.requests, args.latency, args.pages))
@@ -0,0 +1,139 @@
+"""
+Local mock of the OpenAI chat completions API
+Answers /v1/chat/completions with the same canned JSON as the stub model,
+after a fixed latency, so the real HTTP client path can be benchmarked
+without network access or API keys.
+
+It can also play an overloaded provider: requests beyond --capacity in
+flight are answered 429 (with Retry-After), and each request in flight
+adds --latency-per-request to the latency of the others. With
+--slow-fraction, that share of requests are stragglers taking
+--slow-latency instead, for tail-latency experiments.
+
+Usage (from backend/):
+    python benchmarks/mock_openai_server.py --port 8900 --latency 0.05
+    python benchmarks/mock_openai_server.py --capacity 8 --latency-per-request 0.01
+    python benchmarks/mock_openai_server.py --slow-fraction 0.02 --slow-latency 2
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import threading
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from stub_llm import CANNED_REPLIES
+
+
+def create_app(
+    latency: float = 0.05,
+    capacity: int = 0,
+    latency_per_request: float = 0.0,
+    retry_after: float = 0.0,
+    slow_fraction: float = 0.0,
+    slow_latency: float = 2.0,
+    seed: int = 0
+) -> FastAPI:
+    """
+    capacity: requests served at once; more get a 429 (0: unlimited)
+    latency_per_request: extra latency per other request in flight
+    retry_after: Retry-After sent with a 429 (0: none)
+    slow_fraction: share of requests that take slow_latency instead
+    """
+    rng = random.Random(seed)
+    app = FastAPI()
+    app.state.requests = 0
+    app.state.throttled = 0
+    app.state.in_flight = 0
+    app.state.max_in_flight = 0
+    app.state.slow = 0
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        app.state.requests += 1
+        if capacity and app.state.in_flight >= capacity:
+            app.state.throttled += 1
+            headers = {"retry-after": str(retry_after)} if retry_after else {}
+            return JSONResponse(
+                {"error": {"message": "Rate limit exceeded", "type": "rate_limit_exceeded", "code": 429}},
+                status_code=429,
+                headers=headers
+            )
+        app.state.in_flight += 1
+        app.state.max_in_flight = max(app.state.max_in_flight, app.state.in_flight)
+        delay = latency + latency_per_request * (app.state.in_flight - 1)
+        if slow_fraction and rng.random() < slow_fraction:
+            app.state.slow += 1
+            delay = slow_latency
+        try:
+            await asyncio.sleep(delay)
+        finally:
+            app.state.in_flight -= 1
+
+        prompt = body["messages"][-1]["content"] if body.get("messages") else ""
+        content = json.dumps({})
+        for keyword, reply in CANNED_REPLIES:
+            if keyword in prompt:
+                content = json.dumps(reply)
+                break
+        prompt_tokens = len(prompt) // 4
+        completion_tokens = len(content) // 4
+        return {
+            "id": f"chatcmpl-mock-{app.state.requests}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "mock-model"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop"
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens
+            }
+        }
+
+    return app
+
+
+class MockServer:
+    """Runs the mock app with uvicorn in a background thread"""
+    def __init__(self, app: FastAPI, host: str = "127.0.0.1", port: int = 8900):
+        self.app = app
+        self.base_url = f"http://{host}:{port}/v1"
+        self._server = uvicorn.Server(uvicorn.Config(app, host=host, port=port, log_level="warning"))
+        self._thread = threading.Thread(target=self._server.run, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        while not self._server.started:
+            time.sleep(0.01)
+        return self
+
+    def __exit__(self, *exc):
+        self._server.should_exit = True
+        self._thread.join()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--capacity", type=int, default=0, help="requests served at once, more get a 429 (0: unlimited)")
+    parser.add_argument("--latency-per-request", type=float, default=0.0, help="extra latency per other request in flight")
+    parser.add_argument("--retry-after", type=float, default=0.0, help="Retry-After of a 429 (0: none)")
+    parser.add_argument("--slow-fraction", type=float, default=0.0, help="share of requests that are stragglers")
+    parser.add_argument("--slow-latency", type=float, default=2.0, help="latency of a straggler (seconds)")
+    args = parser.parse_args()
+    app = create_app(args.latency, args.capacity, args.latency_per_request, args.retry_after, args.slow_fraction, args.slow_latency)
+    uvicorn.run(app, host="127.0.0.1", port=args.port)
@@ -0,0 +1,104 @@
+"""
+Local stub chat model for load tests and benchmarks
+Answers each agent prompt with canned JSON after a fixed latency, so the
+full graph can run without network access or API keys.
+"""
+import time
+import json
+import asyncio
+from typing import Any, AsyncIterator, Iterator, List, Optional
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+# Keyword in the prompt -> canned JSON reply
+CANNED_REPLIES = [
+    ("Document Classifier", {"document_type": "Contract"}),
+    ("Classification and Extraction", {"document_type": "Contract", "confidence": 0.9, "sections": {"Parties": "Acme and Globex", "Term": "12 months"}}),
+    ("Content Extraction", {"sections": {"Parties": "Acme and Globex", "Term": "12 months"}}),
+    ("Summarization", {"summary": "A twelve month services agreement between Acme and Globex."}),
+    ("Insight Generator", {"insights": ["Risk: No termination clause", "Question: Who pays fees?", "Action: Review clause 4"]}),
+    ("Question Answering", {"answer": "The agreement runs for twelve months.", "sources": [1]}),
+]
+
+
+class StubChatModel(BaseChatModel):
+    """
+    Chat model that sleeps for `latency` seconds and returns canned JSON.
+    Streamed, the reply arrives in `chunk_chars` pieces `chunk_delay` apart.
+    """
+    latency: float = 0.5
+    chunk_chars: int = 8
+    chunk_delay: float = 0.02
+    model_name: str = "stub-model"
+
+    @property
+    def _llm_type(self) -> str:
+        return "stub"
+
+    def _reply(self, messages: List[BaseMessage]) -> str:
+        prompt = messages[-1].content if messages else ""
+        for keyword, reply in CANNED_REPLIES:
+            if keyword in prompt:
+                return json.dumps(reply)
+        return json.dumps({})
+
+    def _result(self, messages: List[BaseMessage]) -> ChatResult:
+        content = self._reply(messages)
+        prompt_tokens = sum(len(str(m.content)) for m in messages) // 4
+        completion_tokens = len(content) // 4
+        return ChatResult(
+            generations=[ChatGeneration(message=AIMessage(content=content))],
+            llm_output={
+                "token_usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens + completion_tokens,
+                },
+                "model_name": self.model_name,
+            },
+        )
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs: Any) -> ChatResult:
+        time.sleep(self.latency)
+        return self._result(messages)
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs: Any) -> ChatResult:
+        await asyncio.sleep(self.latency)
+        return self._result(messages)
+
+    def _chunks(self, messages: List[BaseMessage]) -> List[ChatGenerationChunk]:
+        content = self._reply(messages)
+        return [
+            ChatGenerationChunk(message=AIMessageChunk(content=content[i:i + self.chunk_chars]))
+            for i in range(0, len(content), self.chunk_chars)
+        ]
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        time.sleep(self.latency)
+        for i, chunk in enumerate(self._chunks(messages)):
+            if i:
+                time.sleep(self.chunk_delay)
+            if run_manager:
+                run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        await asyncio.sleep(self.latency)
+        for i, chunk in enumerate(self._chunks(messages)):
+            if i:
+                await asyncio.sleep(self.chunk_delay)
+            if run_manager:
+                await run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+
+
+def install_stub_llm(latency: float = 0.5):
+    """
+    Make the shared LLM client a StubChatModel. core.llm.get_llm still binds
+    callbacks and applies the rate limiter around it.
+    """
+    import core.llm
+
+    stub = StubChatModel(latency=latency)
+    core.llm.get_shared_llm = lambda: stub
@@ -0,0 +1,97 @@
+"""
+Synthetic PDF generator for benchmarks and load tests
+Builds text-only PDFs without any third-party dependency
+"""
+import random
+
+WORDS = (
+    "agreement party obligation term payment delivery notice clause liability "
+    "warranty schedule report finding analysis method result revenue invoice "
+    "service period renewal termination confidential governing law section"
+).split()
+
+
+def _escape(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def make_text_pdf(num_pages: int, lines_per_page: int = 40, seed: int = 0) -> bytes:
+    """Return the bytes of a PDF with `num_pages` pages of pseudo-random prose"""
+    rng = random.Random(seed)
+    objects = []
+
+    def add(body: bytes) -> int:
+        objects.append(body)
+        return len(objects)
+
+    catalog_id = add(b"")  # filled in once the page tree exists
+    pages_id = add(b"")
+    font_id = add(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+
+    page_ids = []
+    for page_no in range(num_pages):
+        lines = [f"Page {page_no + 1}. Section {page_no + 1}.1"]
+        for _ in range(lines_per_page - 1):
+            lines.append(" ".join(rng.choice(WORDS) for _ in range(12)).capitalize() + ".")
+        ops = ["BT", "/F1 10 Tf", "12 TL", "50 790 Td"]
+        for line in lines:
+            ops.append(f"({_escape(line)}) Tj T*")
+        ops.append("ET")
+        stream = "\n".join(ops).encode("latin-1")
+        content_id = add(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+        page_ids.append(add(
+            b"<< /Type /Page /Parent %d 0 R /MediaBox [0 0 612 842] "
+            b"/Resources << /Font << /F1 %d 0 R >> >> /Contents %d 0 R >>"
+            % (pages_id, font_id, content_id)
+        ))
+
+    kids = b" ".join(b"%d 0 R" % pid for pid in page_ids)
+    objects[pages_id - 1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, len(page_ids))
+    objects[catalog_id - 1] = b"<< /Type /Catalog /Pages %d 0 R >>" % pages_id
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for obj_id, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n" % obj_id + body + b"\nendobj\n"
+    xref_at = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    for offset in offsets:
+        out += b"%010d 00000 n \n" % offset
+    out += b"trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (
+        len(objects) + 1, catalog_id, xref_at
+    )
+    return bytes(out)
+
+
+def make_image_pdf(num_pages: int, seed: int = 0) -> bytes:
+    """
+    Return the bytes of an image-only PDF (no text layer), like a scanned
+    document: each page is a rendered bitmap of a few lines of prose.
+    """
+    import io
+    from PIL import Image, ImageDraw
+
+    rng = random.Random(seed)
+    pages = []
+    for page_no in range(num_pages):
+        image = Image.new("L", (1240, 1754), color=255)
+        draw = ImageDraw.Draw(image)
+        lines = [f"Page {page_no + 1}. Scanned section {page_no + 1}.1"]
+        lines += [" ".join(rng.choice(WORDS) for _ in range(8)).capitalize() + "." for _ in range(20)]
+        for i, line in enumerate(lines):
+            draw.text((100, 100 + i * 60), line, fill=0)
+        pages.append(image)
+
+    buffer = io.BytesIO()
+    pages[0].save(buffer, format="PDF", save_all=True, append_images=pages[1:], resolution=150)
+    return buffer.getvalue()
+
+
+if __name__ == "__main__":
+    import sys
+    pages = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    path = sys.argv[2] if len(sys.argv) > 2 else f"synthetic_{pages}p.pdf"
+    with open(path, "wb") as f:
+        f.write(make_text_pdf(pages))
+    print(f"Wrote {path}")
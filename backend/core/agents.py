@@ -1,333 +1,1225 @@
-import os
-from langchain_openai import ChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import JsonOutputParser, StrOutputParser
+from langchain_core.exceptions import OutputParserException
 from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.runnables import RunnableLambda
 from core.state import DocumentState
+from core.llm import MODEL_NAME, get_llm, agent_deadline
+from core.chunking import chunk_document, truncate_to_tokens, count_tokens
+from core.mapreduce import MapReduceJob, MAP_REDUCE_TOKEN_BUDGET, use_map_reduce, build_windows, document_tokens, window_key
+from core.budget import pack_informative
+from core.retrieval import RETRIEVAL_TOP_K
+from core.local_classifier import LOCAL_CLASSIFIER_MIN_CONFIDENCE, get_local_classifier
+import os
 import json
 
-# Initialize OpenRouter LLM
-# Note: User must provide OPENROUTER_API_KEY in .env
-# We use a default lightweight model, but allow configuration.
-MODEL_NAME = os.getenv("LLM_MODEL", "google/gemini-2.0-flash-001") # flexible default
-BASE_URL = "https://openrouter.ai/api/v1"
-API_KEY = os.getenv("OPENROUTER_API_KEY")
-
-def get_llm(callbacks=None):
-    if not API_KEY:
-        # Fallback only for demonstration or specific envs; ideally should raise error or handle gracefully
-        print("Warning: OPENROUTER_API_KEY not found.")
-        
-    return ChatOpenAI(
-        model=MODEL_NAME,
-        openai_api_key=API_KEY,
-        openai_api_base=BASE_URL,
-        temperature=0.1,
-        callbacks=callbacks or []
-    )
+# Bump whenever agent prompts or output handling change, so cached results are invalidated.
+PROMPT_VERSION = "3"
 
-# --- Agent 1: Document Classifier ---
-def document_classifier_agent(state: DocumentState) -> DocumentState:
-    import time
-    start_time = time.time()
-    
-    # Get analytics trackers from state
+# --- Chain execution helpers ---
+# Every agent is split into a prepare step (tracking + chain construction) and a
+# finish step (result handling + tracking), so the sync and async entry points
+# share the same logic and differ only in how the chain is invoked.
+
+def _get_callbacks(state: DocumentState) -> list:
     token_tracker = state.get('_token_tracker')
+    return [token_tracker] if token_tracker else []
+
+def _run_chain(chain, inputs: dict):
+    """Invoke a chain synchronously, returning (result, error)"""
+    try:
+        return chain.invoke(inputs), None
+    except Exception as e:
+        return None, e
+
+def _parses_as_json(text: str) -> bool:
+    try:
+        JsonOutputParser().parse(text)
+        return True
+    except OutputParserException:
+        return False
+
+def _agent_llm(state: DocumentState, agent_name: str, cacheable=_parses_as_json):
+    """
+    The shared LLM for one agent run, with its callbacks and its deadline
+    (AGENT_DEADLINES) starting now. Every agent parses the reply as JSON, so
+    by default only replies that parse are kept in the prompt cache.
+    """
+    return get_llm(callbacks=_get_callbacks(state), deadline=agent_deadline(agent_name), cacheable=cacheable)
+
+async def _arun_chain(chain, inputs: dict):
+    """Invoke a chain without blocking the event loop, returning (result, error)"""
+    try:
+        return await chain.ainvoke(inputs), None
+    except Exception as e:
+        return None, e
+
+def _document_chunks(state: DocumentState) -> list:
+    """Token-sized chunks of the document (ingestion normally provides them)"""
+    return state.get("chunks") or chunk_document(state["raw_text"])
+
+# --- Token budgets ---
+# With a core.budget.TokenBudget in the state (_budget), every agent asks it how
+# many document tokens it may send. Over budget, the most informative part of
+# the document that fits is sent instead of all of it.
+
+def _granted(state: DocumentState, agent_name: str, wanted: int) -> int:
+    budget = state.get("_budget")
+    return budget.grant(agent_name, wanted) if budget else wanted
+
+def _packed_text(chunks: list, token_budget: int) -> str:
+    """The most informative chunks that fit token_budget, in order, with gaps marked"""
+    kept, _ = pack_informative(chunks, token_budget)
+    positions = {id(chunk): i for i, chunk in enumerate(chunks)}
+    parts, previous = [], None
+    for chunk in kept:
+        position = positions[id(chunk)]
+        if previous is not None and position != previous + 1:
+            parts.append("[...]")
+        parts.append(chunk["text"])
+        previous = position
+    return "\n".join(parts)
+
+def _single_pass_text(state: DocumentState, agent_name: str, max_tokens: int) -> tuple:
+    """
+    Document text for a single-pass agent: the whole document if it fits
+    max_tokens and the agent's grant, otherwise the most informative chunks
+    that do.
+
+    Returns:
+        (text, whether chunks were left out)
+    """
+    chunks = _document_chunks(state)
+    total = document_tokens(chunks)
+    limit = _granted(state, agent_name, min(total, max_tokens))
+    if total <= limit:
+        return state["raw_text"], False
+    return _packed_text(chunks, limit), True
+
+def _map_windows(state: DocumentState, agent_name: str) -> tuple:
+    """
+    Map-reduce windows for the document within the agent's grant. Windows
+    with a reusable partial result cost nothing and are always kept; of the
+    rest, the most informative that fit are.
+
+    Returns:
+        (windows in document order, number of windows left out)
+    """
+    windows = build_windows(_document_chunks(state))
+    reuse = _reusable_partials(state, agent_name)
+    fresh = [w for w in windows if window_key(w) not in reuse]
+    wanted = document_tokens(fresh)
+    budget = state.get("_budget")
+    limit = budget.grant(agent_name, wanted) if budget else min(wanted, MAP_REDUCE_TOKEN_BUDGET)
+    kept, skipped = pack_informative(fresh, limit)
+    kept_ids = {id(w) for w in kept}
+    return [w for w in windows if id(w) in kept_ids or window_key(w) in reuse], skipped
+
+# --- Near-duplicate revisions ---
+# With an earlier analysis of a near-duplicate revision in the state
+# (_near_duplicate), its mode decides what is re-run: "reuse" (no chunk
+# changed) keeps its outputs, "update" has the extractor and summarizer update
+# them from the changed chunks only, and otherwise ("incremental") map-reduce
+# runs as usual but only sends windows and reduce groups without a stored
+# partial result to the model.
+
+def _near_duplicate_mode(state: DocumentState):
+    previous = state.get("_near_duplicate")
+    return previous["mode"] if previous else None
+
+def _reusable_partials(state: DocumentState, agent_name: str) -> dict:
+    previous = state.get("_near_duplicate") or {}
+    return (previous.get("partials") or {}).get(agent_name) or {}
+
+def _store_partials(state: DocumentState, agent_name: str, job: MapReduceJob):
+    """Hand a job's partial results to the pipeline, which stores them with the result"""
+    partials = state.get("_partials")
+    if partials is not None:
+        partials[agent_name] = job.outputs
+
+def _failed_windows_info(failed_windows: int, error) -> dict:
+    """Analytics of failed map windows. An agent that succeeds without some of them is degraded, and the run is not cached"""
+    if not failed_windows:
+        return {}
+    return {"failed_windows": failed_windows, "degraded": error is None}
+
+def _reuse_near_duplicate(state: DocumentState, agent_label: str, update: dict) -> DocumentState:
+    previous = state["_near_duplicate"]
+    log = f"{agent_label}: Skipped, no chunks changed since near-duplicate session {previous['source_session_id']}."
+    return {**update, "agent_logs": [log]}
+
+def _start_update(state: DocumentState, agent_name: str, **info):
     agent_tracker = state.get('_agent_tracker')
-    
+    previous = state["_near_duplicate"]
     if agent_tracker:
-        agent_tracker.start_agent("classifier", state)
-    
-    callbacks = [token_tracker] if token_tracker else []
-    llm = get_llm(callbacks=callbacks)
-    
-    # We use a snippet of text to classify to save tokens, or full text if reasonable.
-    # For classification, the first 2000 chars are usually enough + some middle/end?
-    # Let's use the first chunk or first 3000 chars of raw text.
-    text_sample = state["raw_text"][:3000]
+        agent_tracker.start_agent(
+            agent_name,
+            state,
+            additional_info={
+                **info,
+                "mode": "near_duplicate_update",
+                "source_session_id": previous["source_session_id"],
+                "changed_chunks": previous["changed_chunks"],
+                "total_chunks": previous["total_chunks"]
+            }
+        )
+
+# --- Agent 1: Document Classifier ---
+CLASSIFIER_PROMPT = ChatPromptTemplate.from_template(
+    """
+    You are an expert Document Classifier Agent.
+    Analyze the following text sample from a document and classify its type.
+
+    Possible types: Contract, Research Paper, Technical Report, Notes, Legal Document, Invoice, Resume, Other.
+
+    Text Sample:
+    {text}
+
+    Return ONLY a JSON object with the key "document_type".
+    Example: {{"document_type": "Contract"}}
+    """
+)
+
+# Tokens of leading text the classifier looks at
+CLASSIFIER_SAMPLE_TOKENS = 750
+
+# Two tiers: the local model (see core.local_classifier) answers when it is
+# confident enough, otherwise the LLM is asked. The agent trace and the
+# classified_by state key tell which tier answered.
+
+def classifier_sample(state: DocumentState) -> str:
+    """The leading part of the document, which is enough to classify it"""
+    return truncate_to_tokens(state["raw_text"], CLASSIFIER_SAMPLE_TOKENS)
+
+def _local_guess(state: DocumentState):
+    """(document_type, confidence) from the local model, or None when it is not trained"""
+    classifier = get_local_classifier()
+    if classifier is None:
+        return None
+    return classifier.predict(classifier_sample(state))
+
+def _is_confident(guess) -> bool:
+    return guess is not None and guess[1] >= LOCAL_CLASSIFIER_MIN_CONFIDENCE
+
+def _local_classification(state: DocumentState, guess) -> DocumentState:
+    agent_tracker = state.get('_agent_tracker')
+    doc_type, confidence = guess
+
+    result_state = {
+        "document_type": doc_type,
+        "classified_by": "local",
+        "agent_logs": [f"Classifier Agent: Identified document as {doc_type} (tier: local model, confidence {confidence:.2f})"]
+    }
 
     if agent_tracker:
-        agent_tracker.start_agent(
-            "classifier", 
-            state, 
-            additional_info={"sample_length": len(text_sample)}
+        agent_tracker.start_agent("classifier", state, additional_info={"tier": "local"})
+        agent_tracker.end_agent(
+            result_state,
+            agent_name="classifier",
+            additional_info={"classified_type": doc_type, "confidence": round(confidence, 4)}
         )
-    
-    callbacks = [token_tracker] if token_tracker else []
-    llm = get_llm(callbacks=callbacks)
-
-    prompt = ChatPromptTemplate.from_template(
-        """
-        You are an expert Document Classifier Agent. 
-        Analyze the following text sample from a document and classify its type.
-        
-        Possible types: Contract, Research Paper, Technical Report, Notes, Legal Document, Invoice, Resume, Other.
-        
-        Text Sample:
-        {text}
-        
-        Return ONLY a JSON object with the key "document_type".
-        Example: {{"document_type": "Contract"}}
-        """
-    )
-    
-    chain = prompt | llm | JsonOutputParser()
-    
-    try:
-        result = chain.invoke({"text": text_sample})
+
+    return result_state
+
+def _escalation_logs(guess) -> list:
+    if guess is None:
+        return []
+    return [f"Classifier Agent: Local model not confident ({guess[0]}, {guess[1]:.2f}), asking the LLM."]
+
+def _classifier_prepare(state: DocumentState, guess=None):
+    agent_tracker = state.get('_agent_tracker')
+
+    text_sample = classifier_sample(state)
+
+    if agent_tracker:
+        info = {"tier": "llm", "sample_length": len(text_sample), "sample_tokens": CLASSIFIER_SAMPLE_TOKENS}
+        if guess is not None:
+            info.update(local_guess=guess[0], local_confidence=round(guess[1], 4))
+        agent_tracker.start_agent("classifier", state, additional_info=info)
+
+    llm = _agent_llm(state, "classifier")
+    chain = CLASSIFIER_PROMPT | llm | JsonOutputParser()
+    return chain, {"text": text_sample}
+
+def _classifier_finish(state: DocumentState, result, error, guess=None) -> DocumentState:
+    agent_tracker = state.get('_agent_tracker')
+
+    if error is None:
         doc_type = result.get("document_type", "Unknown")
-        log = f"Classifier Agent: Identified document as {doc_type}"
+        log = f"Classifier Agent: Identified document as {doc_type} (tier: LLM)"
         success = True
-    except Exception as e:
+    else:
         doc_type = "Unknown"
-        log = f"Classifier Agent: Failed to classify. Error: {str(e)}"
+        log = f"Classifier Agent: Failed to classify. Error: {str(error)}"
         success = False
 
     result_state = {
         "document_type": doc_type,
-        "agent_logs": state.get("agent_logs", []) + [log]
+        "classified_by": "llm",
+        "agent_logs": _escalation_logs(guess) + [log]
     }
-    
+
     if agent_tracker:
         agent_tracker.end_agent(
-            result_state, 
+            result_state,
             success=success,
+            agent_name="classifier",
             additional_info={"classified_type": doc_type}
         )
-    
+
     return result_state
 
+def _llm_classification(state: DocumentState, guess=None) -> DocumentState:
+    chain, inputs = _classifier_prepare(state, guess)
+    return _classifier_finish(state, *_run_chain(chain, inputs), guess=guess)
+
+async def _allm_classification(state: DocumentState, guess=None) -> DocumentState:
+    chain, inputs = _classifier_prepare(state, guess)
+    return _classifier_finish(state, *(await _arun_chain(chain, inputs)), guess=guess)
+
+def document_classifier_agent(state: DocumentState) -> DocumentState:
+    # Already classified while the document was still being parsed (see core.ingest)
+    if state.get("document_type"):
+        return {}
+    guess = _local_guess(state)
+    if _is_confident(guess):
+        return _local_classification(state, guess)
+    return _llm_classification(state, guess)
+
+async def adocument_classifier_agent(state: DocumentState) -> DocumentState:
+    if state.get("document_type"):
+        return {}
+    guess = _local_guess(state)
+    if _is_confident(guess):
+        return _local_classification(state, guess)
+    return await _allm_classification(state, guess)
+
 # --- Agent 2: Content Extraction Agent ---
-def content_extraction_agent(state: DocumentState) -> DocumentState:
-    import time
-    start_time = time.time()
-    
-    # Get analytics trackers from state
-    token_tracker = state.get('_token_tracker')
+EXTRACTOR_PROMPT = ChatPromptTemplate.from_template(
+    """
+    You are an expert Content Extraction Agent.
+    The document type is determined to be: {doc_type}.
+
+    Extract key sections and structured content relevant to this document type.
+    - If Contract: clauses, obligations, deadlines.
+    - If Report: sections, key findings.
+    - If Notes: bullet points, main topics.
+
+    Text content:
+    {text}
+
+    Return a JSON object with a key "sections" mapping section names to content summaries or extracts.
+    """
+)
+
+# Largest document (in tokens) the extractor handles in a single call; longer documents are map-reduced
+EXTRACTOR_MAX_TOKENS = 2500
+
+SECTIONS_REDUCE_PROMPT = ChatPromptTemplate.from_template(
+    """
+    You are an expert Content Extraction Agent.
+    The document type is determined to be: {doc_type}.
+
+    The following JSON objects are key sections extracted from consecutive parts of the same document.
+    Merge them into a single set of sections: combine duplicates, keep document order, and keep content concise.
+
+    Partial sections:
+    {sections}
+
+    Return a JSON object with a key "sections" mapping section names to content summaries or extracts.
+    """
+)
+
+EXTRACTOR_UPDATE_PROMPT = ChatPromptTemplate.from_template(
+    """
+    You are an expert Content Extraction Agent.
+    The document type is determined to be: {doc_type}.
+
+    Key sections were extracted from an earlier revision of this document:
+    {sections}
+
+    The following passages are new or changed in the current revision:
+    {text}
+
+    Return a JSON object with a key "sections" containing only the sections that are new or whose content changes,
+    with their complete updated content. Use the existing section names where they apply.
+    """
+)
+
+def _merge_sections(parts: list) -> dict:
+    """Local fallback reduce: union of section dicts, concatenating repeated sections"""
+    merged = {}
+    for part in parts:
+        for name, content in (part or {}).items():
+            if name in merged and merged[name] != content:
+                merged[name] = f"{merged[name]}\n{content}"
+            else:
+                merged[name] = content
+    return merged
+
+def _extractor_map_reduce_job(state: DocumentState):
     agent_tracker = state.get('_agent_tracker')
-    
-    if agent_tracker:
-        agent_tracker.start_agent("extractor", state)
-    
-    callbacks = [token_tracker] if token_tracker else []
-    llm = get_llm(callbacks=callbacks)
-    
+
     doc_type = state["document_type"]
-    text_sample = state["raw_text"]  
-    # For extraction, we might need more context. 
-    # If text is huge, we might need a map-reduce strategy or just process the first N chunks.
-    # For simplicity in this demo, we assume the text fits context or we truncate.
-    # A robust production system would iterate over chunks.
-    # Let's limit to 10k chars for this demo to ensure speed and low cost.
-    processing_text = text_sample[:10000] 
+    windows, skipped = _map_windows(state, "extractor")
+    reuse = _reusable_partials(state, "extractor")
 
     if agent_tracker:
         agent_tracker.start_agent(
-            "extractor", 
+            "extractor",
             state,
             additional_info={
                 "document_type": doc_type,
-                "processing_length": len(processing_text)
+                "mode": "map_reduce",
+                "windows": len(windows),
+                "windows_skipped": skipped,
+                "windows_reused": sum(window_key(w) in reuse for w in windows)
             }
         )
-    
-    callbacks = [token_tracker] if token_tracker else []
-    llm = get_llm(callbacks=callbacks)
-
-    prompt = ChatPromptTemplate.from_template(
-        """
-        You are an expert Content Extraction Agent.
-        The document type is determined to be: {doc_type}.
-        
-        Extract key sections and structured content relevant to this document type.
-        - If Contract: clauses, obligations, deadlines.
-        - If Report: sections, key findings.
-        - If Notes: bullet points, main topics.
-        
-        Text content:
-        {text}
-        
-        Return a JSON object with a key "sections" mapping section names to content summaries or extracts.
-        """
+
+    llm = _agent_llm(state, "extractor")
+    job = MapReduceJob(
+        "extractor",
+        map_chain=EXTRACTOR_PROMPT | llm | JsonOutputParser(),
+        map_inputs=lambda text: {"doc_type": doc_type, "text": text},
+        reduce_chain=SECTIONS_REDUCE_PROMPT | llm | JsonOutputParser(),
+        reduce_inputs=lambda parts: {"doc_type": doc_type, "sections": json.dumps(parts)},
+        parse=lambda result: result.get("sections", {}),
+        fallback_reduce=_merge_sections,
+        agent_tracker=agent_tracker,
+        reuse=reuse
     )
-    
-    chain = prompt | llm | JsonOutputParser()
-    
-    try:
-        result = chain.invoke({"doc_type": doc_type, "text": processing_text})
+    return job, windows
+
+def _extractor_prepare(state: DocumentState):
+    agent_tracker = state.get('_agent_tracker')
+
+    doc_type = state["document_type"]
+    # Single pass over documents that fit EXTRACTOR_MAX_TOKENS (packed when
+    # map-reduce is off); longer documents go through _extractor_map_reduce_job.
+    processing_text, packed = _single_pass_text(state, "extractor", EXTRACTOR_MAX_TOKENS)
+
+    if agent_tracker:
+        agent_tracker.start_agent(
+            "extractor",
+            state,
+            additional_info={
+                "document_type": doc_type,
+                "processing_length": len(processing_text),
+                "packed": packed
+            }
+        )
+
+    llm = _agent_llm(state, "extractor")
+    chain = EXTRACTOR_PROMPT | llm | JsonOutputParser()
+    return chain, {"doc_type": doc_type, "text": processing_text}
+
+def _extractor_update_prepare(state: DocumentState):
+    previous = state["_near_duplicate"]
+    doc_type = state["document_type"]
+    _start_update(state, "extractor", document_type=doc_type)
+
+    llm = _agent_llm(state, "extractor")
+    chain = EXTRACTOR_UPDATE_PROMPT | llm | JsonOutputParser()
+    inputs = {
+        "doc_type": doc_type,
+        "sections": json.dumps(previous["key_sections"]),
+        "text": previous["changed_text"]
+    }
+    return chain, inputs
+
+def _apply_section_updates(state: DocumentState, result, error) -> tuple:
+    """Previous revision's sections with the changed and new ones from an update call"""
+    if error is not None:
+        return result, error
+    return {"sections": {**state["_near_duplicate"]["key_sections"], **result.get("sections", {})}}, None
+
+def _extractor_finish(state: DocumentState, result, error, failed_windows: int = 0) -> DocumentState:
+    agent_tracker = state.get('_agent_tracker')
+
+    if error is None:
         sections = result.get("sections", {})
         log = f"Extraction Agent: Extracted {len(sections)} key sections."
+        if failed_windows:
+            log += f" {failed_windows} map windows failed and are missing from the result."
         success = True
-    except Exception as e:
+    else:
         sections = {}
-        log = f"Extraction Agent: Extraction failed. Error: {str(e)}"
+        log = f"Extraction Agent: Extraction failed. Error: {str(error)}"
         success = False
-        
+
     result_state = {
         "extracted_sections": sections,
-        "agent_logs": state["agent_logs"] + [log]
+        "agent_logs": [log]
     }
-    
+
     if agent_tracker:
         agent_tracker.end_agent(
-            result_state, 
+            result_state,
             success=success,
-            additional_info={"sections_found": len(sections)}
+            agent_name="extractor",
+            additional_info={"sections_found": len(sections), **_failed_windows_info(failed_windows, error)}
         )
-    
+
     return result_state
 
-# --- Agent 3: Summarization Agent ---
-def summarization_agent(state: DocumentState) -> DocumentState:
-    import time
-    start_time = time.time()
-    
-    # Get analytics trackers from state
-    token_tracker = state.get('_token_tracker')
+def content_extraction_agent(state: DocumentState) -> DocumentState:
+    # Already extracted together with the classification (see classify_and_extract_agent)
+    if state.get("extracted_sections"):
+        return {}
+    mode = _near_duplicate_mode(state)
+    if mode == "reuse":
+        return _reuse_near_duplicate(state, "Extraction Agent", {"extracted_sections": state["_near_duplicate"]["key_sections"]})
+    if mode == "update":
+        chain, inputs = _extractor_update_prepare(state)
+        return _extractor_finish(state, *_apply_section_updates(state, *_run_chain(chain, inputs)))
+    if use_map_reduce(_document_chunks(state), EXTRACTOR_MAX_TOKENS):
+        job, windows = _extractor_map_reduce_job(state)
+        sections, error, failed_windows = job.run(windows)
+        _store_partials(state, "extractor", job)
+        return _extractor_finish(state, {"sections": sections}, error, failed_windows)
+    chain, inputs = _extractor_prepare(state)
+    return _extractor_finish(state, *_run_chain(chain, inputs))
+
+async def acontent_extraction_agent(state: DocumentState) -> DocumentState:
+    if state.get("extracted_sections"):
+        return {}
+    mode = _near_duplicate_mode(state)
+    if mode == "reuse":
+        return _reuse_near_duplicate(state, "Extraction Agent", {"extracted_sections": state["_near_duplicate"]["key_sections"]})
+    if mode == "update":
+        chain, inputs = _extractor_update_prepare(state)
+        return _extractor_finish(state, *_apply_section_updates(state, *(await _arun_chain(chain, inputs))))
+    if use_map_reduce(_document_chunks(state), EXTRACTOR_MAX_TOKENS):
+        job, windows = _extractor_map_reduce_job(state)
+        sections, error, failed_windows = await job.arun(windows)
+        _store_partials(state, "extractor", job)
+        return _extractor_finish(state, {"sections": sections}, error, failed_windows)
+    chain, inputs = _extractor_prepare(state)
+    return _extractor_finish(state, *(await _arun_chain(chain, inputs)))
+
+# --- Agents 1+2 fused: Classification and Extraction ---
+# Optional: documents short enough for a single extraction pass are classified
+# and extracted in one call. The reply is validated against FUSED_SCHEMA; if it
+# does not validate or is not confident enough, the classifier runs as usual
+# and the extractor follows it (the two-stage path).
+FUSED_CLASSIFY_EXTRACT = os.getenv("FUSED_CLASSIFY_EXTRACT", "0") == "1"
+FUSED_MIN_CONFIDENCE = float(os.getenv("FUSED_MIN_CONFIDENCE", "0.7"))
+
+DOCUMENT_TYPES = ["Contract", "Research Paper", "Technical Report", "Notes", "Legal Document", "Invoice", "Resume", "Other"]
+
+FUSED_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "document_type": {"type": "string", "enum": DOCUMENT_TYPES},
+        "confidence": {"type": "number", "minimum": 0, "maximum": 1},
+        "sections": {"type": "object", "minProperties": 1, "additionalProperties": {"type": "string"}}
+    },
+    "required": ["document_type", "confidence", "sections"]
+}
+
+FUSED_PROMPT = ChatPromptTemplate.from_template(
+    """
+    You are an expert Document Classification and Extraction Agent.
+    First classify the document's type, then extract key sections and structured content relevant to that type.
+    - If Contract: clauses, obligations, deadlines.
+    - If Report: sections, key findings.
+    - If Notes: bullet points, main topics.
+
+    Text content:
+    {text}
+
+    Return ONLY a JSON object that conforms to this JSON schema:
+    {schema}
+    "confidence" is how sure you are of the document type, from 0 to 1.
+    """
+)
+
+def use_fused_call(state: DocumentState) -> bool:
+    """Whether the classifier node classifies and extracts in one call"""
+    return (
+        FUSED_CLASSIFY_EXTRACT
+        and not state.get("document_type")
+        and not use_map_reduce(_document_chunks(state), EXTRACTOR_MAX_TOKENS)
+    )
+
+def _validate_fused(result) -> tuple:
+    """(document_type, sections, confidence) of a fused reply; ValueError if it does not match FUSED_SCHEMA"""
+    if not isinstance(result, dict):
+        raise ValueError("reply is not a JSON object")
+    doc_type = result.get("document_type")
+    if doc_type not in DOCUMENT_TYPES:
+        raise ValueError(f"document_type {doc_type!r} is not one of the known types")
+    confidence = result.get("confidence")
+    if isinstance(confidence, bool) or not isinstance(confidence, (int, float)) or not 0 <= confidence <= 1:
+        raise ValueError(f"confidence {confidence!r} is not a number from 0 to 1")
+    sections = result.get("sections")
+    if not isinstance(sections, dict) or not sections:
+        raise ValueError("sections is missing or empty")
+    if not all(isinstance(content, str) for content in sections.values()):
+        raise ValueError("section contents are not all strings")
+    return doc_type, sections, float(confidence)
+
+def _fused_reply_valid(text: str) -> bool:
+    """Whether a fused reply parses and validates, i.e. is worth keeping in the prompt cache"""
+    try:
+        _validate_fused(JsonOutputParser().parse(text))
+        return True
+    except (OutputParserException, ValueError):
+        return False
+
+def _fused_prepare(state: DocumentState):
     agent_tracker = state.get('_agent_tracker')
-    
+
+    processing_text, _ = _single_pass_text(state, "extractor", EXTRACTOR_MAX_TOKENS)
+
     if agent_tracker:
-        agent_tracker.start_agent("summarizer", state)
-    
-    callbacks = [token_tracker] if token_tracker else []
-    llm = get_llm(callbacks=callbacks)
-    
-    # In a real chunk-based system, we would summarize chunks and then aggregate.
-    # Here we perform a direct summarization on the potentially truncated text 
-    # or the aggregated chunks if we implemented a map-reduce. 
-    # We will use the raw text (truncated if massive).
-    
-    text_content = state["raw_text"][:15000] 
+        agent_tracker.start_agent(
+            "classifier_extractor",
+            state,
+            additional_info={"processing_length": len(processing_text), "min_confidence": FUSED_MIN_CONFIDENCE}
+        )
+
+    llm = _agent_llm(state, "classifier_extractor", cacheable=_fused_reply_valid)
+    chain = FUSED_PROMPT | llm | JsonOutputParser()
+    return chain, {"text": processing_text, "schema": json.dumps(FUSED_SCHEMA)}
+
+def _fused_finish(state: DocumentState, result, error, guess=None) -> tuple:
+    """
+    Returns:
+        (state update, or None to fall back to the two-stage path; the
+        validated reply (doc_type, sections, confidence), or None; log lines)
+    """
+    agent_tracker = state.get('_agent_tracker')
+
+    validated = None
+    if error is None:
+        try:
+            validated = _validate_fused(result)
+        except ValueError as e:
+            error = e
+
+    update = None
+    if error is not None:
+        log = f"Classification and Extraction Agent: Reply failed validation, falling back to two stages. Error: {str(error)}"
+    else:
+        doc_type, sections, confidence = validated
+        if confidence >= FUSED_MIN_CONFIDENCE:
+            log = f"Classification and Extraction Agent: Identified document as {doc_type} (confidence {confidence:.2f}) and extracted {len(sections)} key sections in one call."
+            update = {"document_type": doc_type, "classified_by": "fused", "extracted_sections": sections}
+        else:
+            log = f"Classification and Extraction Agent: Not confident of {doc_type} ({confidence:.2f}), falling back to two stages."
+
+    if agent_tracker:
+        agent_tracker.end_agent(
+            {"document_type": validated[0] if validated else None},
+            success=error is None,
+            error=str(error) if error is not None else None,
+            agent_name="classifier_extractor",
+            additional_info={
+                "classified_type": validated[0] if validated else None,
+                "confidence": validated[2] if validated else None,
+                "sections_found": len(validated[1]) if validated else 0,
+                "fallback": update is None
+            }
+        )
+
+    log = _escalation_logs(guess) + [log]
+    return ({**update, "agent_logs": log} if update else None), validated, log
+
+def _fused_fallback(classification: DocumentState, validated, log: list) -> DocumentState:
+    """
+    Two-stage classification after a rejected fused reply. Sections that
+    validated are kept when the classifier agrees on the type, so the
+    extractor does not run again.
+    """
+    update = {**classification, "agent_logs": log + classification.get("agent_logs", [])}
+    if validated and classification.get("document_type") == validated[0]:
+        update["extracted_sections"] = validated[1]
+        update["agent_logs"].append(f"Extraction Agent: Kept {len(validated[1])} key sections from the fused call, the classifier agrees on {validated[0]}.")
+    return update
+
+def classify_and_extract_agent(state: DocumentState) -> DocumentState:
+    """
+    Classifier node: the fused call when it applies (see use_fused_call) and
+    the local model is not confident, the classifier otherwise
+    """
+    if not use_fused_call(state):
+        return document_classifier_agent(state)
+    guess = _local_guess(state)
+    if _is_confident(guess):
+        return _local_classification(state, guess)
+    chain, inputs = _fused_prepare(state)
+    update, validated, log = _fused_finish(state, *_run_chain(chain, inputs), guess=guess)
+    if update is not None:
+        return update
+    return _fused_fallback(_llm_classification(state), validated, log)
+
+async def aclassify_and_extract_agent(state: DocumentState) -> DocumentState:
+    if not use_fused_call(state):
+        return await adocument_classifier_agent(state)
+    guess = _local_guess(state)
+    if _is_confident(guess):
+        return _local_classification(state, guess)
+    chain, inputs = _fused_prepare(state)
+    update, validated, log = _fused_finish(state, *(await _arun_chain(chain, inputs)), guess=guess)
+    if update is not None:
+        return update
+    return _fused_fallback(await _allm_classification(state), validated, log)
+
+# --- Agent 3: Summarization Agent ---
+SUMMARIZER_PROMPT = ChatPromptTemplate.from_template(
+    """
+    You are an expert Summarization Agent.
+    Provide a concise, comprehensive summary of the document.
+    Focus on the main objectives, outcomes, and key entities involved.
+
+    Document Text:
+    {text}
+
+    Return a JSON object with `summary` key. The value of `summary` MUST be a single string paragraph, NOT an object or list.
+    """
+)
+
+# Largest document (in tokens) the summarizer handles in a single call; longer documents are map-reduced
+SUMMARIZER_MAX_TOKENS = 3750
+
+SUMMARY_REDUCE_PROMPT = ChatPromptTemplate.from_template(
+    """
+    You are an expert Summarization Agent.
+    The following are summaries of consecutive parts of the same document, in order.
+    Combine them into one concise, comprehensive summary of the whole document.
+    Focus on the main objectives, outcomes, and key entities involved.
+
+    Partial summaries:
+    {summaries}
+
+    Return a JSON object with `summary` key. The value of `summary` MUST be a single string paragraph, NOT an object or list.
+    """
+)
+
+SUMMARY_UPDATE_PROMPT = ChatPromptTemplate.from_template(
+    """
+    You are an expert Summarization Agent.
+    Below is the summary of an earlier revision of a document, followed by the passages that are new or changed in the current revision.
+    Update the summary so that it describes the current revision, keeping everything that still holds.
+
+    Previous summary:
+    {summary}
+
+    New or changed passages:
+    {text}
+
+    Return a JSON object with `summary` key. The value of `summary` MUST be a single string paragraph, NOT an object or list.
+    """
+)
+
+def _summary_text(value) -> str:
+    """Normalize a model-provided summary value to a string"""
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return str(value)
+
+_JSON_ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+
+class _SummaryDeltas:
+    """
+    Follows the JSON a summarizer call is generating and reports new text of
+    its top-level "summary" string to the event sink as "summary_delta" events.
+
+    Every character is scanned once, so a long reply costs linear time rather
+    than a re-parse per chunk. Anything before the opening brace (a ```json
+    fence, a preamble) is skipped. A summary that is not a string is left to
+    the final parse.
+    """
+    def __init__(self, on_event):
+        self.on_event = on_event
+        self.summary = ""
+        self._pieces = []
+        self._depth = 0          # object/array nesting; 0 until the opening brace
+        self._in_string = False
+        self._escape = None      # None, "" right after a backslash, or the hex digits of a \u escape
+        self._high_surrogate = None
+        self._expect = None      # at the top level: "key", "colon" or "value"
+        self._key = []           # characters of the top-level key being read
+        self._last_key = None
+        self._in_summary = False
+        self._done = False
+
+    @property
+    def text(self) -> str:
+        return "".join(self._pieces)
+
+    def _string_char(self, char: str):
+        """Decoded character of a string being read, or None while an escape sequence is incomplete"""
+        if self._escape is None:
+            if char == "\\":
+                self._escape = ""
+                return None
+            return char
+        if self._escape == "" and char != "u":
+            self._escape = None
+            return _JSON_ESCAPES.get(char, char)
+        self._escape += char
+        if len(self._escape) < 5:
+            return None
+        code = int(self._escape[1:], 16) if all(c in "0123456789abcdefABCDEF" for c in self._escape[1:]) else 0xFFFD
+        self._escape = None
+        if 0xD800 <= code < 0xDC00:
+            self._high_surrogate = code
+            return None
+        if 0xDC00 <= code < 0xE000 and self._high_surrogate is not None:
+            code = 0x10000 + ((self._high_surrogate - 0xD800) << 10) + (code - 0xDC00)
+        self._high_surrogate = None
+        return chr(code)
+
+    def feed(self, piece: str):
+        self._pieces.append(piece)
+        if self._done:
+            return
+        delta = []
+        for char in piece:
+            if self._in_string:
+                if self._escape is None and char == '"':
+                    self._in_string = False
+                    if self._in_summary:
+                        self._done = True
+                        break
+                    if self._depth == 1 and self._expect == "key":
+                        self._last_key = "".join(self._key)
+                        self._expect = "colon"
+                    continue
+                decoded = self._string_char(char)
+                if decoded is None:
+                    continue
+                if self._in_summary:
+                    delta.append(decoded)
+                elif self._depth == 1 and self._expect == "key":
+                    self._key.append(decoded)
+            elif char == '"':
+                self._in_string = True
+                if self._depth == 1 and self._expect == "key":
+                    self._key = []
+                elif self._depth == 1 and self._expect == "value" and self._last_key == "summary":
+                    self._in_summary = True
+            elif char in "{[":
+                if self._depth == 0 and char == "[":
+                    continue
+                self._depth += 1
+                if self._depth == 1:
+                    self._expect = "key"
+            elif self._depth == 0:
+                continue
+            elif char in "}]":
+                self._depth -= 1
+                if self._depth == 0:
+                    self._done = True
+                    break
+            elif self._depth == 1:
+                if char == ":" and self._expect == "colon":
+                    self._expect = "value"
+                elif char == ",":
+                    self._expect = "key"
+        if delta:
+            delta = "".join(delta)
+            self.summary += delta
+            self.on_event("summary_delta", {"delta": delta})
+
+def _summary_chain(state: DocumentState, prompt, llm):
+    """
+    prompt | llm | JsonOutputParser(). With an event sink in the state the
+    call is streamed and the summary text is reported as it is generated;
+    the complete output is still parsed as strict JSON at the end.
+    """
+    on_event = state.get('_event_sink')
+    if on_event is None:
+        return prompt | llm | JsonOutputParser()
+
+    generate = prompt | llm
+
+    def stream(inputs: dict):
+        deltas = _SummaryDeltas(on_event)
+        for chunk in generate.stream(inputs):
+            deltas.feed(chunk.content)
+        return JsonOutputParser().parse(deltas.text)
+
+    async def astream(inputs: dict):
+        deltas = _SummaryDeltas(on_event)
+        async for chunk in generate.astream(inputs):
+            deltas.feed(chunk.content)
+        return JsonOutputParser().parse(deltas.text)
+
+    return RunnableLambda(stream, afunc=astream)
+
+def _summarizer_map_reduce_job(state: DocumentState):
+    agent_tracker = state.get('_agent_tracker')
+
+    windows, skipped = _map_windows(state, "summarizer")
+    reuse = _reusable_partials(state, "summarizer")
 
     if agent_tracker:
         agent_tracker.start_agent(
-            "summarizer", 
+            "summarizer",
             state,
-            additional_info={"input_length": len(text_content)}
+            additional_info={
+                "mode": "map_reduce",
+                "windows": len(windows),
+                "windows_skipped": skipped,
+                "windows_reused": sum(window_key(w) in reuse for w in windows)
+            }
         )
-    
-    callbacks = [token_tracker] if token_tracker else []
-    llm = get_llm(callbacks=callbacks)
-
-    prompt = ChatPromptTemplate.from_template(
-        """
-        You are an expert Summarization Agent.
-        Provide a concise, comprehensive summary of the document.
-        Focus on the main objectives, outcomes, and key entities involved.
-        
-        Document Text:
-        {text}
-        
-        Return a JSON object with `summary` key. The value of `summary` MUST be a single string paragraph, NOT an object or list.
-        """
+
+    llm = _agent_llm(state, "summarizer")
+    job = MapReduceJob(
+        "summarizer",
+        map_chain=SUMMARIZER_PROMPT | llm | JsonOutputParser(),
+        map_inputs=lambda text: {"text": text},
+        reduce_chain=SUMMARY_REDUCE_PROMPT | llm | JsonOutputParser(),
+        reduce_inputs=lambda parts: {"summaries": "\n\n".join(f"Part {i + 1}: {p}" for i, p in enumerate(parts))},
+        parse=lambda result: _summary_text(result.get("summary", "")),
+        fallback_reduce=lambda parts: " ".join(parts),
+        agent_tracker=agent_tracker,
+        # The last reduce produces the summary itself, so that is the call to stream
+        final_reduce_chain=_summary_chain(state, SUMMARY_REDUCE_PROMPT, llm),
+        reuse=reuse
     )
-    
-    chain = prompt | llm | JsonOutputParser()
-    
-    try:
-        result = chain.invoke({"text": text_content})
-        summary_val = result.get("summary", "No summary generated.")
-        
+    return job, windows
+
+def _summarizer_prepare(state: DocumentState):
+    agent_tracker = state.get('_agent_tracker')
+
+    # Single-pass summarization of documents that fit SUMMARIZER_MAX_TOKENS;
+    # longer documents go through _summarizer_map_reduce_job instead.
+    text_content, packed = _single_pass_text(state, "summarizer", SUMMARIZER_MAX_TOKENS)
+
+    if agent_tracker:
+        agent_tracker.start_agent(
+            "summarizer",
+            state,
+            additional_info={"input_length": len(text_content), "packed": packed}
+        )
+
+    llm = _agent_llm(state, "summarizer")
+    chain = _summary_chain(state, SUMMARIZER_PROMPT, llm)
+    return chain, {"text": text_content}
+
+def _summarizer_update_prepare(state: DocumentState):
+    previous = state["_near_duplicate"]
+    _start_update(state, "summarizer", input_length=len(previous["changed_text"]))
+
+    llm = _agent_llm(state, "summarizer")
+    chain = _summary_chain(state, SUMMARY_UPDATE_PROMPT, llm)
+    return chain, {"summary": previous["summary"], "text": previous["changed_text"]}
+
+def _summarizer_finish(state: DocumentState, result, error, failed_windows: int = 0) -> DocumentState:
+    agent_tracker = state.get('_agent_tracker')
+
+    if error is None:
         # Ensure summary is a string
-        if isinstance(summary_val, (dict, list)):
-            summary = json.dumps(summary_val)
-        else:
-            summary = str(summary_val)
-            
+        summary = _summary_text(result.get("summary", "No summary generated."))
+
         log = "Summarization Agent: Generated summary."
+        if failed_windows:
+            log += f" {failed_windows} map windows failed and are missing from the summary."
         success = True
-    except Exception as e:
+    else:
         summary = "Error generating summary."
-        log = f"Summarization Agent: Failed. Error: {str(e)}"
+        log = f"Summarization Agent: Failed. Error: {str(error)}"
         success = False
 
     result_state = {
         "summary": summary,
-        "agent_logs": state["agent_logs"] + [log]
+        "agent_logs": [log]
     }
-    
+
     if agent_tracker:
         agent_tracker.end_agent(
-            result_state, 
+            result_state,
             success=success,
-            additional_info={"summary_length": len(summary) if summary else 0}
+            agent_name="summarizer",
+            additional_info={"summary_length": len(summary) if summary else 0, **_failed_windows_info(failed_windows, error)}
         )
-    
+
     return result_state
 
+def summarization_agent(state: DocumentState) -> DocumentState:
+    mode = _near_duplicate_mode(state)
+    if mode == "reuse":
+        return _reuse_near_duplicate(state, "Summarization Agent", {"summary": state["_near_duplicate"]["summary"]})
+    if mode == "update":
+        chain, inputs = _summarizer_update_prepare(state)
+        return _summarizer_finish(state, *_run_chain(chain, inputs))
+    if use_map_reduce(_document_chunks(state), SUMMARIZER_MAX_TOKENS):
+        job, windows = _summarizer_map_reduce_job(state)
+        summary, error, failed_windows = job.run(windows)
+        _store_partials(state, "summarizer", job)
+        return _summarizer_finish(state, {"summary": summary}, error, failed_windows)
+    chain, inputs = _summarizer_prepare(state)
+    return _summarizer_finish(state, *_run_chain(chain, inputs))
+
+async def asummarization_agent(state: DocumentState) -> DocumentState:
+    mode = _near_duplicate_mode(state)
+    if mode == "reuse":
+        return _reuse_near_duplicate(state, "Summarization Agent", {"summary": state["_near_duplicate"]["summary"]})
+    if mode == "update":
+        chain, inputs = _summarizer_update_prepare(state)
+        return _summarizer_finish(state, *(await _arun_chain(chain, inputs)))
+    if use_map_reduce(_document_chunks(state), SUMMARIZER_MAX_TOKENS):
+        job, windows = _summarizer_map_reduce_job(state)
+        summary, error, failed_windows = await job.arun(windows)
+        _store_partials(state, "summarizer", job)
+        return _summarizer_finish(state, {"summary": summary}, error, failed_windows)
+    chain, inputs = _summarizer_prepare(state)
+    return _summarizer_finish(state, *(await _arun_chain(chain, inputs)))
+
 # --- Agent 4: Insight Generator Agent ---
-def insight_generator_agent(state: DocumentState) -> DocumentState:
-    import time
-    start_time = time.time()
-    
-    # Get analytics trackers from state
-    token_tracker = state.get('_token_tracker')
+INSIGHT_PROMPT = ChatPromptTemplate.from_template(
+    """
+    You are an expert Insight Generator Agent.
+    Based on the document summary, type, and extracted sections, generate strategic insights.
+
+    1. Generate 3 key questions a user might have.
+    2. Identify potentially risky areas or missing information (if applicable).
+    3. Suggest follow-up actions.
+
+    Document Type: {doc_type}
+    Summary: {summary}
+    Sections: {sections}
+
+    Return a JSON object with a key "insights" which is a LIST of strings.
+    Example: ["Risk: Missing termination date", "Question: Who is the primary stakeholder?", "Action: Review clause 4.2"]
+    """
+)
+
+# Largest input (summary and sections, in tokens) the insight generator sends
+INSIGHT_MAX_TOKENS = 3000
+
+def _fit_sections(sections: dict, max_tokens: int) -> str:
+    """Sections as JSON within max_tokens, each section's content shortened by the same share"""
+    text = json.dumps(sections)
+    tokens = count_tokens(text)
+    if tokens <= max_tokens or not sections:
+        return text
+    keep = max_tokens / tokens
+    return json.dumps({
+        name: truncate_to_tokens(content if isinstance(content, str) else json.dumps(content), max(1, int(count_tokens(str(content)) * keep)))
+        for name, content in sections.items()
+    })
+
+def _insight_prepare(state: DocumentState, limit: int):
     agent_tracker = state.get('_agent_tracker')
-    
-    if agent_tracker:
-        agent_tracker.start_agent("insight_generator", state)
-    
-    callbacks = [token_tracker] if token_tracker else []
-    llm = get_llm(callbacks=callbacks)
-    
-    summary = state.get("summary", "")
+
+    summary = truncate_to_tokens(state.get("summary") or "", limit // 2)
     sections = state.get("extracted_sections", {})
     doc_type = state.get("document_type", "Unknown") # Access from state directly
+    sections_text = _fit_sections(sections, limit - count_tokens(summary))
 
     if agent_tracker:
         agent_tracker.start_agent(
-            "insight_generator", 
+            "insight_generator",
             state,
             additional_info={
                 "has_summary": bool(summary),
-                "num_sections": len(sections)
+                "num_sections": len(sections),
+                "input_tokens_granted": limit
             }
         )
-    
-    callbacks = [token_tracker] if token_tracker else []
-    llm = get_llm(callbacks=callbacks)
-
-    prompt = ChatPromptTemplate.from_template(
-        """
-        You are an expert Insight Generator Agent.
-        Based on the document summary, type, and extracted sections, generate strategic insights.
-        
-        1. Generate 3 key questions a user might have.
-        2. Identify potentially risky areas or missing information (if applicable).
-        3. Suggest follow-up actions.
-        
-        Document Type: {doc_type}
-        Summary: {summary}
-        Sections: {sections}
-        
-        Return a JSON object with a key "insights" which is a LIST of strings.
-        Example: ["Risk: Missing termination date", "Question: Who is the primary stakeholder?", "Action: Review clause 4.2"]
-        """
-    )
-    
-    chain = prompt | llm | JsonOutputParser()
-    
-    try:
-        # Pass doc_type to invoke
-        result = chain.invoke({"summary": summary, "sections": json.dumps(sections), "doc_type": doc_type})
+
+    llm = _agent_llm(state, "insight_generator")
+    chain = INSIGHT_PROMPT | llm | JsonOutputParser()
+    return chain, {"summary": summary, "sections": sections_text, "doc_type": doc_type}
+
+def _insight_limit(state: DocumentState) -> int:
+    wanted = count_tokens(state.get("summary") or "") + count_tokens(json.dumps(state.get("extracted_sections", {})))
+    return _granted(state, "insight_generator", min(wanted, INSIGHT_MAX_TOKENS))
+
+def _budget_spent(state: DocumentState, agent_label: str) -> DocumentState:
+    return {"agent_logs": [f"{agent_label}: Skipped, the request's token budget is spent."]}
+
+def _insight_finish(state: DocumentState, result, error) -> DocumentState:
+    agent_tracker = state.get('_agent_tracker')
+
+    if error is None:
         insights = result.get("insights", [])
         log = f"Insight Agent: Generated {len(insights)} insights."
         success = True
-    except Exception as e:
+    else:
         insights = []
-        log = f"Insight Agent: Failed. Error: {str(e)}"
+        log = f"Insight Agent: Failed. Error: {str(error)}"
         success = False
 
     result_state = {
         "insights": insights,
-        "agent_logs": state["agent_logs"] + [log]
+        "agent_logs": [log]
     }
-    
+
     if agent_tracker:
         agent_tracker.end_agent(
-            result_state, 
+            result_state,
             success=success,
+            agent_name="insight_generator",
             additional_info={"num_insights": len(insights)}
         )
-    
+
+    return result_state
+
+def _insights_unchanged(state: DocumentState) -> bool:
+    return _near_duplicate_mode(state) == "reuse"
+
+def insight_generator_agent(state: DocumentState) -> DocumentState:
+    if _insights_unchanged(state):
+        return _reuse_near_duplicate(state, "Insight Agent", {"insights": state["_near_duplicate"]["insights"]})
+    limit = _insight_limit(state)
+    if limit <= 0:
+        return _budget_spent(state, "Insight Agent")
+    chain, inputs = _insight_prepare(state, limit)
+    return _insight_finish(state, *_run_chain(chain, inputs))
+
+async def ainsight_generator_agent(state: DocumentState) -> DocumentState:
+    if _insights_unchanged(state):
+        return _reuse_near_duplicate(state, "Insight Agent", {"insights": state["_near_duplicate"]["insights"]})
+    limit = _insight_limit(state)
+    if limit <= 0:
+        return _budget_spent(state, "Insight Agent")
+    chain, inputs = _insight_prepare(state, limit)
+    return _insight_finish(state, *(await _arun_chain(chain, inputs)))
+
+# --- Agent 5: Question Answering Agent ---
+ANSWER_PROMPT = ChatPromptTemplate.from_template(
+    """
+    You are an expert Question Answering Agent.
+    Answer the question using only the numbered excerpts from the document below.
+    If the excerpts do not contain the answer, say that the document does not appear to answer it.
+
+    Excerpts:
+    {excerpts}
+
+    Question: {question}
+
+    Return a JSON object with a key "answer" (a string) and a key "sources" (a LIST of the excerpt numbers the answer is based on).
+    """
+)
+
+# Most excerpt tokens sent with a question (the best match is always sent)
+ANSWER_MAX_CONTEXT_TOKENS = 1500
+
+def _answer_passages(state: DocumentState) -> list:
+    """Best matching chunks for the question that fit ANSWER_MAX_CONTEXT_TOKENS and the agent's grant"""
+    matches = state["_chunk_index"].search(state["user_question"], RETRIEVAL_TOP_K)
+    limit = _granted(state, "question_answerer", min(sum(p["tokens"] for p in matches), ANSWER_MAX_CONTEXT_TOKENS)) if matches else 0
+    passages, tokens = [], 0
+    for passage in matches:
+        if passages and tokens + passage["tokens"] > limit:
+            break
+        passages.append(passage)
+        tokens += passage["tokens"]
+    return passages
+
+def _answer_prepare(state: DocumentState):
+    agent_tracker = state.get('_agent_tracker')
+
+    question = state["user_question"]
+    passages = _answer_passages(state)
+
+    if agent_tracker:
+        agent_tracker.start_agent(
+            "question_answerer",
+            state,
+            additional_info={
+                "question_length": len(question),
+                "passages": len(passages),
+                "context_tokens": sum(p["tokens"] for p in passages),
+                "document_chunks": len(state["_chunk_index"].chunks),
+                "top_score": passages[0]["score"] if passages else None
+            }
+        )
+
+    llm = _agent_llm(state, "question_answerer")
+    chain = ANSWER_PROMPT | llm | JsonOutputParser()
+    excerpts = "\n\n".join(
+        f"[{i + 1}] (pages {p['page_start']}-{p['page_end']})\n{p['text']}" for i, p in enumerate(passages)
+    )
+    return chain, {"excerpts": excerpts, "question": question}, passages
+
+def _answer_finish(state: DocumentState, passages: list, result, error) -> DocumentState:
+    agent_tracker = state.get('_agent_tracker')
+
+    if error is None:
+        answer = str(result.get("answer", ""))
+        cited = [n for n in result.get("sources", []) if isinstance(n, int) and 1 <= n <= len(passages)]
+        sources = [passages[n - 1] for n in cited] or passages
+        log = f"Question Answering Agent: Answered from {len(passages)} of {len(state['_chunk_index'].chunks)} chunks."
+        success = True
+    else:
+        answer = None
+        sources = passages
+        log = f"Question Answering Agent: Failed. Error: {str(error)}"
+        success = False
+
+    result_state = {
+        "answer": {
+            "question": state["user_question"],
+            "answer": answer,
+            "sources": [
+                {"chunk": p["chunk"], "page_start": p["page_start"], "page_end": p["page_end"], "score": p["score"]}
+                for p in sources
+            ]
+        },
+        "agent_logs": [log]
+    }
+
+    if agent_tracker:
+        agent_tracker.end_agent(
+            result_state,
+            success=success,
+            agent_name="question_answerer",
+            additional_info={"sources": len(sources)}
+        )
+
     return result_state
+
+def _has_question(state: DocumentState) -> bool:
+    return bool((state.get("user_question") or "").strip()) and state.get("_chunk_index") is not None
+
+# Returned without a model call when no chunk shares a term with the question
+NO_MATCH_ANSWER = "The document does not appear to answer this question."
+
+def question_answering_agent(state: DocumentState) -> DocumentState:
+    if not _has_question(state):
+        return {}
+    chain, inputs, passages = _answer_prepare(state)
+    if not passages:
+        return _answer_finish(state, passages, {"answer": NO_MATCH_ANSWER}, None)
+    return _answer_finish(state, passages, *_run_chain(chain, inputs))
+
+async def aquestion_answering_agent(state: DocumentState) -> DocumentState:
+    if not _has_question(state):
+        return {}
+    chain, inputs, passages = _answer_prepare(state)
+    if not passages:
+        return _answer_finish(state, passages, {"answer": NO_MATCH_ANSWER}, None)
+    return _answer_finish(state, passages, *(await _arun_chain(chain, inputs)))
+
+# --- Token budget planning ---
+def token_demands(state: DocumentState) -> dict:
+    """
+    Document tokens each agent would send for this document without a budget,
+    to plan its core.budget.TokenBudget. Near-duplicate updates send only the
+    changed text (bounded by NEAR_DUPLICATE_MAX_CHANGED_TOKENS) and are not
+    budgeted.
+    """
+    chunks = _document_chunks(state)
+    mode = _near_duplicate_mode(state)
+    demands = {}
+    if mode not in ("reuse", "update"):
+        for agent_name, single_pass_tokens in (("extractor", EXTRACTOR_MAX_TOKENS), ("summarizer", SUMMARIZER_MAX_TOKENS)):
+            if use_map_reduce(chunks, single_pass_tokens):
+                reuse = _reusable_partials(state, agent_name)
+                demands[agent_name] = document_tokens([w for w in build_windows(chunks) if window_key(w) not in reuse])
+            else:
+                demands[agent_name] = min(document_tokens(chunks), single_pass_tokens)
+    if mode != "reuse":
+        demands["insight_generator"] = INSIGHT_MAX_TOKENS
+    if _has_question(state):
+        demands["question_answerer"] = ANSWER_MAX_CONTEXT_TOKENS
+    return demands
@@ -4,55 +4,218 @@ Tracks LLM API calls, token usage, and agent execution metrics
 """
 import time
 import json
-from typing import Dict, Any, List, Optional
+import threading
+from typing import Callable, Dict, Any, List, Optional
 from datetime import datetime
 from functools import wraps
 from langchain_core.callbacks import BaseCallbackHandler
 from langchain_core.outputs import LLMResult
+from core.chunking import count_tokens
+from core.llm_cache import CacheMiss
 
 class TokenUsageTracker(BaseCallbackHandler):
     """
-    Callback handler to track token usage and LLM calls
+    Callback handler to track token usage, latency and generation speed of LLM calls.
+
+    Streamed calls report no token usage, so their counts are estimated
+    from the prompt and the generated text. Calls answered by the prompt
+    cache (core.llm_cache) are not API calls; their tokens count as saved.
     """
     def __init__(self):
         self.total_tokens = 0
         self.prompt_tokens = 0
         self.completion_tokens = 0
         self.api_calls = 0
+        self.cache_hits = 0
+        self.prompt_tokens_saved = 0
+        self.completion_tokens_saved = 0
         self.call_details: List[Dict[str, Any]] = []
+        # Waits for the process-wide LLM limiters (see core.llm.RateControlledLLM)
+        self.queue_wait_seconds = 0.0
+        self.max_queue_wait_seconds = 0.0
+        self.concurrency_limit = None
+        self.retries = 0
+        self.throttled_retries = 0
+        self.deadlines_exceeded = 0
+        # Hedged calls (see core.hedging), those the hedge won and the tokens the losers cost
+        self.hedged_calls = 0
+        self.hedge_wins = 0
+        self.hedge_wasted_tokens = 0
+        # In-flight calls by run id: start time, first token time, prompts, model
+        self._runs: Dict[Any, Dict[str, Any]] = {}
+        # Callbacks fire from parallel graph branches
+        self._lock = threading.Lock()
         
     def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], **kwargs) -> None:
         """Called when LLM starts running"""
-        self.api_calls += 1
+        model_kwargs = (serialized or {}).get('kwargs', {})
+        with self._lock:
+            self.api_calls += 1
+            self._runs[kwargs.get('run_id')] = {
+                'start': time.perf_counter(),
+                'first_token': None,
+                'prompts': prompts,
+                'model': model_kwargs.get('model_name') or model_kwargs.get('model')
+            }
+
+    def on_llm_new_token(self, token: str, **kwargs) -> None:
+        """Called for every streamed token - the first one marks time-to-first-token"""
+        with self._lock:
+            run = self._runs.get(kwargs.get('run_id'))
+            if run is not None and run['first_token'] is None:
+                run['first_token'] = time.perf_counter()
+
+    def on_llm_error(self, error: BaseException, **kwargs) -> None:
+        with self._lock:
+            self._runs.pop(kwargs.get('run_id'), None)
+            if isinstance(error, CacheMiss):
+                # A cache-only attempt; the call that follows is the real one
+                self.api_calls -= 1
         
     def on_llm_end(self, response: LLMResult, **kwargs) -> None:
-        """Called when LLM ends running - capture token usage"""
-        if response.llm_output and 'token_usage' in response.llm_output:
-            usage = response.llm_output['token_usage']
+        """Called when LLM ends running - capture token usage and timings"""
+        end = time.perf_counter()
+        with self._lock:
+            run = self._runs.pop(kwargs.get('run_id'), None)
+
+        first = response.generations[0][0] if response.generations and response.generations[0] else None
+        cache_info = (first.generation_info or {}) if first is not None else {}
+        if cache_info.get('prompt_cache_hit'):
+            self._record_cache_hit(cache_info, run, end)
+            return
+
+        llm_output = response.llm_output or {}
+        usage = llm_output.get('token_usage')
+        estimated = not usage
+        if usage:
             prompt_tokens = usage.get('prompt_tokens', 0)
             completion_tokens = usage.get('completion_tokens', 0)
             total = usage.get('total_tokens', 0)
-            
+        elif run is not None:
+            prompt_tokens = sum(count_tokens(p) for p in run['prompts'])
+            completion_tokens = sum(count_tokens(g.text) for gens in response.generations for g in gens)
+            total = prompt_tokens + completion_tokens
+        else:
+            return
+
+        call = {
+            'timestamp': datetime.now().isoformat(),
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'total_tokens': total,
+            'model': llm_output.get('model_name') or (run and run['model']) or 'unknown'
+        }
+        if estimated:
+            call['usage_estimated'] = True
+        elif run is not None:
+            # Our own count of the same prompt, to calibrate token budgets against (see core.budget)
+            call['estimated_prompt_tokens'] = sum(count_tokens(p) for p in run['prompts'])
+            call['prompt_chars'] = sum(len(p) for p in run['prompts'])
+        if run is not None:
+            # Without streaming the first token arrives with the whole response.
+            # Tokens/sec is the generation rate after the first token when streamed.
+            streamed = run['first_token'] is not None
+            first_token = run['first_token'] if streamed else end
+            generation_seconds = end - first_token if streamed else end - run['start']
+            call.update({
+                'streamed': streamed,
+                'latency_seconds': round(end - run['start'], 4),
+                'time_to_first_token_seconds': round(first_token - run['start'], 4),
+                'tokens_per_second': round(completion_tokens / generation_seconds, 2) if generation_seconds > 0 else None
+            })
+
+        with self._lock:
             self.prompt_tokens += prompt_tokens
             self.completion_tokens += completion_tokens
             self.total_tokens += total
-            
+
             # Store individual call details
-            self.call_details.append({
-                'timestamp': datetime.now().isoformat(),
-                'prompt_tokens': prompt_tokens,
-                'completion_tokens': completion_tokens,
-                'total_tokens': total,
-                'model': response.llm_output.get('model_name', 'unknown')
-            })
+            self.call_details.append(call)
+
+    def _record_cache_hit(self, cache_info: Dict[str, Any], run: Optional[Dict[str, Any]], end: float):
+        prompt_saved = cache_info.get('cached_prompt_tokens', 0)
+        completion_saved = cache_info.get('cached_completion_tokens', 0)
+        call = {
+            'timestamp': datetime.now().isoformat(),
+            'prompt_tokens': 0,
+            'completion_tokens': 0,
+            'total_tokens': 0,
+            'model': (run and run['model']) or 'unknown',
+            'cache_hit': True,
+            'tokens_saved': prompt_saved + completion_saved
+        }
+        if run is not None:
+            call['latency_seconds'] = round(end - run['start'], 4)
+        with self._lock:
+            # on_llm_start counted it as an API call before the cache answered
+            self.api_calls -= 1
+            self.cache_hits += 1
+            self.prompt_tokens_saved += prompt_saved
+            self.completion_tokens_saved += completion_saved
+            self.call_details.append(call)
     
+    def record_queue_wait(self, seconds: float, concurrency_limit: Optional[int] = None):
+        """Time a call waited to be admitted, and the concurrency limit it was admitted under"""
+        with self._lock:
+            self.queue_wait_seconds += seconds
+            self.max_queue_wait_seconds = max(self.max_queue_wait_seconds, seconds)
+            if concurrency_limit is not None:
+                self.concurrency_limit = concurrency_limit
+
+    def record_retry(self, throttled: bool):
+        with self._lock:
+            self.retries += 1
+            if throttled:
+                self.throttled_retries += 1
+
+    def record_deadline_exceeded(self):
+        with self._lock:
+            self.deadlines_exceeded += 1
+
+    def record_hedge(self, hedge_won: bool, wasted_tokens: int):
+        """A hedged call returned; wasted_tokens is our estimate of what the cancelled request cost"""
+        with self._lock:
+            self.hedged_calls += 1
+            self.hedge_wins += hedge_won
+            self.hedge_wasted_tokens += wasted_tokens
+
+    def get_totals(self) -> Dict[str, int]:
+        """Running token counts, without the per-call details"""
+        with self._lock:
+            return {
+                'total_tokens': self.total_tokens,
+                'prompt_tokens': self.prompt_tokens,
+                'completion_tokens': self.completion_tokens,
+                'api_calls': self.api_calls,
+                'cache_hits': self.cache_hits
+            }
+
     def get_summary(self) -> Dict[str, Any]:
         """Get summary of token usage"""
+        ttfts = [c['time_to_first_token_seconds'] for c in self.call_details if 'time_to_first_token_seconds' in c]
+        rates = [c['tokens_per_second'] for c in self.call_details if c.get('tokens_per_second')]
         return {
             'total_tokens': self.total_tokens,
             'prompt_tokens': self.prompt_tokens,
             'completion_tokens': self.completion_tokens,
             'api_calls': self.api_calls,
+            'cache_hits': self.cache_hits,
+            'prompt_tokens_saved': self.prompt_tokens_saved,
+            'completion_tokens_saved': self.completion_tokens_saved,
+            'average_time_to_first_token_seconds': round(sum(ttfts) / len(ttfts), 4) if ttfts else None,
+            'average_tokens_per_second': round(sum(rates) / len(rates), 2) if rates else None,
+            'rate_control': {
+                'queue_wait_seconds': round(self.queue_wait_seconds, 4),
+                'max_queue_wait_seconds': round(self.max_queue_wait_seconds, 4),
+                'concurrency_limit': self.concurrency_limit,
+                'retries': self.retries,
+                'throttled_retries': self.throttled_retries,
+                'deadlines_exceeded': self.deadlines_exceeded,
+                'hedged_calls': self.hedged_calls,
+                'hedge_rate': round(self.hedged_calls / self.api_calls, 4) if self.api_calls else 0,
+                'hedge_wins': self.hedge_wins,
+                'hedge_wasted_tokens': self.hedge_wasted_tokens
+            },
             'call_details': self.call_details
         }
     
@@ -62,16 +225,45 @@ class TokenUsageTracker(BaseCallbackHandler):
         self.prompt_tokens = 0
         self.completion_tokens = 0
         self.api_calls = 0
+        self.cache_hits = 0
+        self.prompt_tokens_saved = 0
+        self.completion_tokens_saved = 0
         self.call_details = []
+        self.queue_wait_seconds = 0.0
+        self.max_queue_wait_seconds = 0.0
+        self.concurrency_limit = None
+        self.retries = 0
+        self.throttled_retries = 0
+        self.deadlines_exceeded = 0
+        self.hedged_calls = 0
+        self.hedge_wins = 0
+        self.hedge_wasted_tokens = 0
+        self._runs = {}
 
 
 class AgentExecutionTracker:
     """
-    Tracks agent execution flow, timing, and thinking process
+    Tracks agent execution flow, timing, and thinking process.
+    Agents may run concurrently (parallel graph branches), so running
+    executions are keyed by agent name rather than held in a single slot.
     """
     def __init__(self):
         self.executions: List[Dict[str, Any]] = []
-        self.current_execution: Optional[Dict[str, Any]] = None
+        self.active_executions: Dict[str, Dict[str, Any]] = {}
+        self._listeners: List[Callable[[Dict[str, Any]], None]] = []
+        self._lock = threading.Lock()
+
+    def add_listener(self, callback: Callable[[Dict[str, Any]], None]):
+        """Call callback(execution) whenever an agent finishes. It may run on any thread and must not block."""
+        self._listeners.append(callback)
+    
+    @property
+    def current_execution(self) -> Optional[Dict[str, Any]]:
+        """Most recently started execution that is still running"""
+        with self._lock:
+            if not self.active_executions:
+                return None
+            return list(self.active_executions.values())[-1]
         
     def start_agent(self, agent_name: str, input_data: Dict[str, Any], additional_info: Dict[str, Any] = None):
         """Start tracking an agent execution
@@ -88,7 +280,7 @@ class AgentExecutionTracker:
         if additional_info:
             print(f"   Context: {additional_info}")
 
-        self.current_execution = {
+        execution = {
             'agent_name': agent_name,
             'start_time': start_time,
             'start_timestamp': timestamp,
@@ -96,58 +288,103 @@ class AgentExecutionTracker:
             'status': 'running',
             'metadata': additional_info or {}
         }
+        with self._lock:
+            self.active_executions[agent_name] = execution
         
-    def end_agent(self, output_data: Dict[str, Any], success: bool = True, error: Optional[str] = None, additional_info: Dict[str, Any] = None):
-        """End tracking an agent execution"""
-        if self.current_execution:
-            end_time = time.time()
-            duration = end_time - self.current_execution['start_time']
-            
-            # Merge additional info if provided
-            if additional_info:
-                self.current_execution['metadata'].update(additional_info)
-                
-            self.current_execution.update({
-                'end_time': end_time,
-                'end_timestamp': datetime.now().isoformat(),
+    def record_step(self, agent_name: str, step: str, duration: float, **info):
+        """Record a timed sub-step of a running agent (e.g. one map-reduce window)"""
+        with self._lock:
+            execution = self.active_executions.get(agent_name)
+            if execution is None:
+                return
+            execution.setdefault('steps', []).append({
+                'step': step,
                 'duration_seconds': duration,
-                'output_size': len(str(output_data)),
-                'success': success,
-                'error': error,
-                'status': 'completed' if success else 'failed'
+                **info
             })
+        
+    def discard_agent(self, agent_name: str):
+        """Stop tracking a running agent without recording it (e.g. a cancelled call whose result is no longer needed)"""
+        with self._lock:
+            self.active_executions.pop(agent_name, None)
+        
+    def end_agent(self, output_data: Dict[str, Any], success: bool = True, error: Optional[str] = None, additional_info: Dict[str, Any] = None, agent_name: Optional[str] = None):
+        """End tracking an agent execution
+        
+        Args:
+            agent_name: Agent to close. May be omitted when only one agent is running.
+        """
+        with self._lock:
+            if agent_name is None and len(self.active_executions) == 1:
+                agent_name = next(iter(self.active_executions))
+            execution = self.active_executions.pop(agent_name, None)
+        if not execution:
+            return
+        
+        end_time = time.time()
+        duration = end_time - execution['start_time']
+        
+        # Merge additional info if provided
+        if additional_info:
+            execution['metadata'].update(additional_info)
             
-            status_icon = "✅" if success else "❌"
-            print(f"[{datetime.now().strftime('%H:%M:%S')}] {status_icon} Agent completed in {duration:.2f}s.")
-            
-            self.executions.append(self.current_execution)
-            self.current_execution = None
+        execution.update({
+            'end_time': end_time,
+            'end_timestamp': datetime.now().isoformat(),
+            'duration_seconds': duration,
+            'output_size': len(str(output_data)),
+            'success': success,
+            'error': error,
+            'status': 'completed' if success else 'failed'
+        })
+        
+        status_icon = "✅" if success else "❌"
+        print(f"[{datetime.now().strftime('%H:%M:%S')}] {status_icon} Agent '{execution['agent_name']}' completed in {duration:.2f}s.")
+        
+        with self._lock:
+            self.executions.append(execution)
+
+        for listener in self._listeners:
+            listener(execution)
     
     def get_execution_summary(self) -> Dict[str, Any]:
         """Get summary of all agent executions"""
         if not self.executions:
             return {
                 'total_agents': 0,
+                'successful_agents': 0,
+                'failed_agents': 0,
+                'degraded_agents': 0,
                 'total_duration': 0,
+                'wall_clock_duration': 0,
+                'average_duration': 0,
                 'executions': []
             }
         
-        total_duration = sum(e.get('duration_seconds', 0) for e in self.executions)
-        successful = sum(1 for e in self.executions if e.get('success', False))
+        executions = sorted(self.executions, key=lambda e: e.get('start_time', 0))
+        total_duration = sum(e.get('duration_seconds', 0) for e in executions)
+        successful = sum(1 for e in executions if e.get('success', False))
+        # Succeeded with part of the input missing (e.g. failed map-reduce windows)
+        degraded = sum(1 for e in executions if e.get('success', False) and e.get('metadata', {}).get('degraded'))
+        # Agents can overlap, so wall-clock time may be less than the summed durations
+        wall_clock = max(e.get('end_time', 0) for e in executions) - min(e.get('start_time', 0) for e in executions)
         
         return {
-            'total_agents': len(self.executions),
+            'total_agents': len(executions),
             'successful_agents': successful,
-            'failed_agents': len(self.executions) - successful,
+            'failed_agents': len(executions) - successful,
+            'degraded_agents': degraded,
             'total_duration': total_duration,
-            'average_duration': total_duration / len(self.executions) if self.executions else 0,
-            'executions': self.executions
+            'wall_clock_duration': wall_clock,
+            'average_duration': total_duration / len(executions) if executions else 0,
+            'executions': executions
         }
     
     def reset(self):
         """Reset execution tracking"""
-        self.executions = []
-        self.current_execution = None
+        with self._lock:
+            self.executions = []
+            self.active_executions = {}
 
 
 class AnalyticsSession:
@@ -161,11 +398,23 @@ class AnalyticsSession:
         self.token_tracker = TokenUsageTracker()
         self.agent_tracker = AgentExecutionTracker()
         self.metadata: Dict[str, Any] = {}
+        self.cache_info: Dict[str, Any] = {}
         
     def set_metadata(self, **kwargs):
         """Set session metadata"""
         self.metadata.update(kwargs)
     
+    def record_cache_lookup(self, status: str, counters: Optional[Dict[str, Any]] = None, **kwargs):
+        """Record the result cache outcome for this session
+        
+        Args:
+            status: 'hit', 'miss' or 'bypass'
+            counters: Process-wide cache counters at lookup time
+        """
+        self.cache_info = {'status': status, **kwargs}
+        if counters:
+            self.cache_info['counters'] = counters
+    
     def get_full_report(self) -> Dict[str, Any]:
         """Get complete analytics report"""
         end_time = time.time()
@@ -182,6 +431,11 @@ class AnalyticsSession:
             (token_summary['prompt_tokens'] / 1000) * cost_per_1k_prompt +
             (token_summary['completion_tokens'] / 1000) * cost_per_1k_completion
         )
+        # What the calls answered by the prompt cache would have cost
+        estimated_cost_saved = (
+            (token_summary['prompt_tokens_saved'] / 1000) * cost_per_1k_prompt +
+            (token_summary['completion_tokens_saved'] / 1000) * cost_per_1k_completion
+        )
         
         return {
             'session_id': self.session_id,
@@ -194,17 +448,26 @@ class AnalyticsSession:
                 'prompt_tokens': token_summary['prompt_tokens'],
                 'completion_tokens': token_summary['completion_tokens'],
                 'api_calls': token_summary['api_calls'],
+                'average_time_to_first_token_seconds': token_summary['average_time_to_first_token_seconds'],
+                'average_tokens_per_second': token_summary['average_tokens_per_second'],
                 'estimated_cost_usd': round(estimated_cost, 6),
+                'prompt_cache_hits': token_summary['cache_hits'],
+                'tokens_saved': token_summary['prompt_tokens_saved'] + token_summary['completion_tokens_saved'],
+                'estimated_cost_saved_usd': round(estimated_cost_saved, 6),
+                'rate_control': token_summary['rate_control'],
                 'call_details': token_summary['call_details']
             },
             'agent_execution': {
                 'total_agents': execution_summary['total_agents'],
                 'successful_agents': execution_summary['successful_agents'],
                 'failed_agents': execution_summary['failed_agents'],
+                'degraded_agents': execution_summary['degraded_agents'],
                 'total_duration': execution_summary['total_duration'],
+                'wall_clock_duration': execution_summary['wall_clock_duration'],
                 'average_duration': execution_summary['average_duration'],
                 'executions': execution_summary['executions']
             },
+            'cache': self.cache_info,
             'thinking_process': self._generate_thinking_process_summary(execution_summary)
         }
     
@@ -213,6 +476,9 @@ class AnalyticsSession:
         executions = execution_summary.get('executions', [])
         
         thinking_steps = []
+        # Group agents whose executions overlap in time into one parallel stage
+        stages: List[List[str]] = []
+        stage_end = None
         for exec_data in executions:
             thinking_steps.append({
                 'step': len(thinking_steps) + 1,
@@ -221,11 +487,22 @@ class AnalyticsSession:
                 'status': exec_data.get('status'),
                 'timestamp': exec_data.get('start_timestamp')
             })
+            start = exec_data.get('start_time', 0)
+            end = exec_data.get('end_time', start)
+            if stages and stage_end is not None and start < stage_end:
+                stages[-1].append(exec_data.get('agent_name'))
+                stage_end = max(stage_end, end)
+            else:
+                stages.append([exec_data.get('agent_name')])
+                stage_end = end
         
         return {
             'total_steps': len(thinking_steps),
             'steps': thinking_steps,
-            'flow': ' → '.join([s['agent'] for s in thinking_steps])
+            'flow': ' → '.join(
+                stage[0] if len(stage) == 1 else '(' + ' ‖ '.join(stage) + ')'
+                for stage in stages
+            )
         }
 
 
@@ -247,12 +524,12 @@ def track_agent_execution(agent_name: str):
                 result = func(state, *args, **kwargs)
                 
                 if tracker:
-                    tracker.end_agent(result, success=True)
+                    tracker.end_agent(result, success=True, agent_name=agent_name)
                 
                 return result
             except Exception as e:
                 if tracker:
-                    tracker.end_agent({}, success=False, error=str(e))
+                    tracker.end_agent({}, success=False, error=str(e), agent_name=agent_name)
                 raise
         
         return wrapper
@@ -0,0 +1,143 @@
+"""
+Batch Analysis
+Queues uploaded documents and analyzes them with a fixed number of
+concurrent graph runs. Progress and per-file outcomes are stored in the
+batch_jobs / batch_items tables; results live in analysis_results.
+"""
+import os
+import uuid
+import asyncio
+import zipfile
+from typing import List, Optional, Tuple
+
+from fastapi.concurrency import run_in_threadpool
+
+from core.db import create_batch, mark_batch_item_started, mark_batch_item_finished
+from core.writer import db_writer
+from core.pipeline import analyze_document, spool_upload
+
+# Concurrent graph runs across all batches
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "4"))
+# Documents waiting to be analyzed; new batches are rejected beyond this
+BATCH_QUEUE_SIZE = int(os.getenv("BATCH_QUEUE_SIZE", "1000"))
+
+
+class BatchQueueFullError(Exception):
+    """The job queue cannot take all documents of a batch"""
+
+
+def is_zip_upload(filename: str, content_type: Optional[str]) -> bool:
+    return (filename or "").lower().endswith(".zip") or content_type in ("application/zip", "application/x-zip-compressed")
+
+
+def spool_zip_members(source) -> List[Tuple[str, str, str]]:
+    """
+    Spool every PDF inside a zip upload to its own temp file. Blocking; run it
+    in a worker thread.
+
+    Returns:
+        list of (member filename, temp file path, content hash)
+    """
+    spooled = []
+    try:
+        with zipfile.ZipFile(source) as archive:
+            for member in archive.infolist():
+                if member.is_dir() or not member.filename.lower().endswith(".pdf"):
+                    continue
+                with archive.open(member) as member_file:
+                    path, content_hash = spool_upload(member_file)
+                spooled.append((os.path.basename(member.filename), path, content_hash))
+    except BaseException:
+        for _, path, _ in spooled:
+            os.unlink(path)
+        raise
+    return spooled
+
+
+class BatchProcessor:
+    """
+    Bounded job queue drained by a fixed pool of worker tasks. Each job is one
+    spooled document; the worker owns the temp file and deletes it when done.
+    """
+    def __init__(self, max_concurrency: int = BATCH_MAX_CONCURRENCY, queue_size: int = BATCH_QUEUE_SIZE):
+        self.max_concurrency = max(1, max_concurrency)
+        self.queue_size = queue_size
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+
+    def start(self):
+        """Start the worker tasks on the running event loop"""
+        if self._workers:
+            return
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._workers = [
+            asyncio.create_task(self._worker(i)) for i in range(self.max_concurrency)
+        ]
+
+    async def stop(self):
+        """Cancel the workers; queued jobs are dropped and their temp files removed"""
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        while self._queue is not None and not self._queue.empty():
+            job = self._queue.get_nowait()
+            os.unlink(job[2])
+
+    def stats(self) -> dict:
+        return {
+            'workers': len(self._workers),
+            'queued': self._queue.qsize() if self._queue else 0,
+            'queue_size': self.queue_size
+        }
+
+    async def submit(self, documents: List[Tuple[str, str, str]], user_question: Optional[str] = None) -> str:
+        """
+        Create a batch and enqueue its documents.
+
+        Args:
+            documents: (filename, spooled temp file path, content hash) tuples;
+                ownership of the temp files passes to the processor
+        Raises:
+            BatchQueueFullError: if the queue has no room for the whole batch
+        """
+        self.start()
+        if self._queue.qsize() + len(documents) > self.queue_size:
+            raise BatchQueueFullError(
+                f"Batch queue is full ({self._queue.qsize()} of {self.queue_size} documents queued)"
+            )
+
+        batch_id = str(uuid.uuid4())
+        item_ids = await run_in_threadpool(
+            create_batch, batch_id, [filename for filename, _, _ in documents], user_question
+        )
+        for item_id, (filename, path, content_hash) in zip(item_ids, documents):
+            self._queue.put_nowait((item_id, filename, path, content_hash, user_question))
+        print(f"Batch {batch_id}: queued {len(documents)} documents.")
+        return batch_id
+
+    async def _worker(self, index: int):
+        while True:
+            item_id, filename, path, content_hash, user_question = await self._queue.get()
+            session_id = str(uuid.uuid4())
+            try:
+                # Progress goes through the same writer as the results, so an item is
+                # never marked completed before its result row is written
+                await db_writer.asubmit(mark_batch_item_started, item_id, session_id)
+                _, result_session_id = await analyze_document(
+                    path, filename, content_hash,
+                    user_question=user_question,
+                    session_id=session_id
+                )
+                await db_writer.asubmit(mark_batch_item_finished, item_id, result_session_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Batch worker {index}: {filename} failed: {e}")
+                await db_writer.asubmit(mark_batch_item_finished, item_id, None, str(e) or type(e).__name__)
+            finally:
+                os.unlink(path)
+                self._queue.task_done()
+
+
+batch_processor = BatchProcessor()
@@ -0,0 +1,248 @@
+"""
+Token Budgets
+Per-agent and per-request ceilings on the tokens one document analysis may
+spend. When a document would go over, agents send the most informative part
+of it that fits rather than everything (or just its beginning).
+
+Budgets are counted in our own token estimates (core.chunking.count_tokens),
+which are calibrated against the usage the API reported for earlier calls:
+the model's tokenizer is not ours, and without tiktoken counts are estimated
+from characters.
+"""
+import os
+import heapq
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from core.state import Chunk
+from core.retrieval import hashed_term_weights
+
+TOKEN_BUDGET_ENABLED = os.getenv("TOKEN_BUDGET_ENABLED", "1") == "1"
+# Tokens (prompt + completion, as reported by the API) one analysis may spend in total
+REQUEST_TOKEN_BUDGET = int(os.getenv("REQUEST_TOKEN_BUDGET", "150000"))
+# Document tokens each agent may send, as "agent=tokens,..."; agents not listed are only
+# held to the request budget
+AGENT_TOKEN_BUDGETS = os.getenv(
+    "AGENT_TOKEN_BUDGETS",
+    "extractor=60000,summarizer=60000,insight_generator=3000,question_answerer=1500"
+)
+# Tokens spent per document token sent: prompt templates, completions and reduce calls
+BUDGET_OVERHEAD = float(os.getenv("BUDGET_OVERHEAD", "1.3"))
+# Stored analytics sessions the calibration starts from
+CALIBRATION_SESSIONS = int(os.getenv("CALIBRATION_SESSIONS", "200"))
+# Estimated prompt tokens observed before the calibration is trusted
+CALIBRATION_MIN_TOKENS = int(os.getenv("CALIBRATION_MIN_TOKENS", "20000"))
+
+# Calibrated ratios outside this range point at bad data rather than a different tokenizer
+_RATIO_RANGE = (0.5, 2.0)
+_PACK_DIMENSIONS = 2 ** 14
+
+
+def parse_agent_budgets(value: str) -> Dict[str, int]:
+    budgets = {}
+    for item in value.split(","):
+        if "=" in item:
+            agent, tokens = item.split("=", 1)
+            budgets[agent.strip()] = int(tokens)
+    return budgets
+
+
+class TokenCalibration:
+    """
+    Ratio of the prompt tokens the API reported to the tokens we estimated
+    for the same prompts, per model, and the characters per reported token.
+    Fed with the call details of finished analyses (see TokenUsageTracker).
+    """
+    def __init__(self, min_tokens: int = CALIBRATION_MIN_TOKENS):
+        self.min_tokens = min_tokens
+        self._totals: Dict[str, Dict[str, int]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, call_details: Iterable[Dict[str, Any]]):
+        with self._lock:
+            for call in call_details:
+                if call.get("cache_hit") or call.get("usage_estimated") or not call.get("estimated_prompt_tokens"):
+                    continue
+                totals = self._totals.setdefault(call.get("model") or "unknown", {"reported": 0, "estimated": 0, "chars": 0})
+                totals["reported"] += call.get("prompt_tokens", 0)
+                totals["estimated"] += call["estimated_prompt_tokens"]
+                totals["chars"] += call.get("prompt_chars", 0)
+
+    def load_history(self, limit: int = CALIBRATION_SESSIONS):
+        """Start from the calls of the most recent stored analytics sessions. Blocking (database read)."""
+        from core.db import get_recent_call_details
+        for call_details in get_recent_call_details(limit):
+            self.observe(call_details)
+
+    def _model_totals(self, model: Optional[str]) -> Optional[Dict[str, int]]:
+        totals = self._totals.get(model or "unknown")
+        if totals is None or totals["estimated"] < self.min_tokens:
+            return None
+        return totals
+
+    def ratio(self, model: Optional[str]) -> float:
+        """Reported tokens per estimated token; 1.0 until enough calls were observed"""
+        with self._lock:
+            totals = self._model_totals(model)
+            if totals is None:
+                return 1.0
+            return min(max(totals["reported"] / totals["estimated"], _RATIO_RANGE[0]), _RATIO_RANGE[1])
+
+    def chars_per_token(self, model: Optional[str]) -> Optional[float]:
+        with self._lock:
+            totals = self._model_totals(model)
+            if totals is None or not totals["reported"] or not totals["chars"]:
+                return None
+            return totals["chars"] / totals["reported"]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            models = list(self._totals)
+        return {
+            model: {
+                "ratio": round(self.ratio(model), 4),
+                "chars_per_token": round(cpt, 3) if (cpt := self.chars_per_token(model)) else None,
+                "estimated_prompt_tokens": self._totals[model]["estimated"]
+            }
+            for model in models
+        }
+
+
+token_calibration = TokenCalibration()
+
+
+def pack_informative(chunks: List[Chunk], token_budget: int, keep_first: bool = True) -> Tuple[List[Chunk], int]:
+    """
+    Chunks (or map windows) that fit token_budget, chosen for what they add:
+    greedily the one covering the most not-yet-covered term weight (tf-idf
+    over the chunks themselves) per token. Boilerplate repeated across pages
+    adds little after its first occurrence. The opening chunk is kept first,
+    since it usually says what the document is.
+
+    Returns:
+        (selected chunks in document order, number of chunks left out)
+    """
+    total = sum(c["tokens"] for c in chunks)
+    if total <= token_budget:
+        return list(chunks), 0
+
+    features = [hashed_term_weights(c["text"], _PACK_DIMENSIONS) for c in chunks]
+    document_frequency = np.zeros(_PACK_DIMENSIONS, dtype=np.float32)
+    for indices, _ in features:
+        document_frequency[indices] += 1
+    idf = np.log((1 + len(chunks)) / (1 + document_frequency)) + 1
+    covered = np.zeros(_PACK_DIMENSIONS, dtype=bool)
+
+    def gain(i: int) -> float:
+        indices, weights = features[i]
+        new = ~covered[indices]
+        return float((np.abs(weights[new]) * idf[indices[new]]).sum()) / max(chunks[i]["tokens"], 1)
+
+    selected, used = [], 0
+
+    def take(i: int):
+        nonlocal used
+        selected.append(i)
+        used += chunks[i]["tokens"]
+        covered[features[i][0]] = True
+
+    if keep_first and chunks and chunks[0]["tokens"] <= token_budget:
+        take(0)
+    # Lazy greedy: gains only shrink as more is covered, so a stale gain is an upper bound
+    heap = [(-gain(i), i) for i in range(len(chunks)) if i not in selected]
+    heapq.heapify(heap)
+    while heap:
+        _, i = heapq.heappop(heap)
+        if used + chunks[i]["tokens"] > token_budget:
+            continue
+        current = gain(i)
+        if heap and current < -heap[0][0]:
+            heapq.heappush(heap, (-current, i))
+            continue
+        take(i)
+
+    selected.sort()
+    return [chunks[i] for i in selected], len(chunks) - len(selected)
+
+
+class TokenBudget:
+    """
+    Token budget of one analysis. Planned up front from what each agent would
+    send (its demand, in document tokens): if the demands do not fit the
+    request budget, it is shared out max-min fairly, so small demands are met
+    in full and the large ones are cut. Each agent's grant is also held to
+    what is actually left of the request budget when it starts.
+    """
+    def __init__(
+        self,
+        token_tracker,
+        demands: Dict[str, int],
+        model: Optional[str] = None,
+        request_budget: int = REQUEST_TOKEN_BUDGET,
+        agent_budgets: Optional[Dict[str, int]] = None,
+        calibration: TokenCalibration = token_calibration,
+        overhead: float = BUDGET_OVERHEAD
+    ):
+        self.token_tracker = token_tracker
+        self.request_budget = request_budget
+        self.agent_budgets = parse_agent_budgets(AGENT_TOKEN_BUDGETS) if agent_budgets is None else agent_budgets
+        self.ratio = calibration.ratio(model)
+        self.chars_per_token = calibration.chars_per_token(model)
+        # Spent tokens per document token (as we count them) an agent sends
+        self.cost_per_token = self.ratio * overhead
+        self.grants: Dict[str, Dict[str, int]] = {}
+        self._lock = threading.Lock()
+
+        self.demands = {agent: demand for agent, demand in demands.items() if demand > 0}
+        self.plan = self._plan(self._remaining())
+
+    def _spent(self) -> int:
+        return self.token_tracker.get_totals()["total_tokens"] if self.token_tracker else 0
+
+    def _remaining(self) -> float:
+        """Document tokens the rest of the request budget pays for"""
+        return max(0.0, (self.request_budget - self._spent()) / self.cost_per_token)
+
+    def _capped(self, agent: str, tokens: int) -> int:
+        ceiling = self.agent_budgets.get(agent)
+        return tokens if ceiling is None else min(tokens, ceiling)
+
+    def _plan(self, available: float) -> Dict[str, int]:
+        wanted = {agent: self._capped(agent, demand) for agent, demand in self.demands.items()}
+        plan = {}
+        for position, agent in enumerate(sorted(wanted, key=wanted.get)):
+            share = available / (len(wanted) - position)
+            plan[agent] = int(min(wanted[agent], share))
+            available -= plan[agent]
+        return plan
+
+    def grant(self, agent: str, wanted: int) -> int:
+        """Document tokens agent may send now, at most wanted (0 when the request budget is spent)"""
+        with self._lock:
+            granted = min(self._capped(agent, wanted), int(self._remaining()))
+            if agent in self.plan:
+                granted = min(granted, self.plan[agent])
+            granted = max(granted, 0)
+            self.grants[agent] = {"wanted": wanted, "granted": granted}
+            return granted
+
+    def degraded(self) -> List[str]:
+        """Agents granted less than they wanted"""
+        with self._lock:
+            return [agent for agent, grant in self.grants.items() if grant["granted"] < grant["wanted"]]
+
+    def report(self) -> Dict[str, Any]:
+        with self._lock:
+            grants = {agent: dict(grant) for agent, grant in self.grants.items()}
+        return {
+            "request_budget": self.request_budget,
+            "spent": self._spent(),
+            "agent_budgets": self.agent_budgets,
+            "calibration_ratio": round(self.ratio, 4),
+            "chars_per_token": round(self.chars_per_token, 3) if self.chars_per_token else None,
+            "plan": self.plan,
+            "grants": grants,
+            "degraded_agents": [agent for agent, grant in grants.items() if grant["granted"] < grant["wanted"]]
+        }
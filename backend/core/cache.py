@@ -0,0 +1,125 @@
+"""
+Content-addressed Result Cache
+Serves repeat /analyze-pdf requests without re-running the agent graph
+"""
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, Optional, Callable, BinaryIO
+
+RESULT_CACHE_TTL_SECONDS = int(os.getenv("RESULT_CACHE_TTL_SECONDS", "86400"))
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", "256"))
+
+
+def hash_stream(source: BinaryIO, sink: Optional[BinaryIO] = None, block_size: int = 1 << 20) -> str:
+    """
+    SHA-256 of a file object, read in blocks so large uploads are never held
+    in memory. When `sink` is given, the bytes are copied into it on the way.
+    """
+    digest = hashlib.sha256()
+    while True:
+        block = source.read(block_size)
+        if not block:
+            break
+        digest.update(block)
+        if sink is not None:
+            sink.write(block)
+    return digest.hexdigest()
+
+
+def make_cache_key(content_hash: str, user_question: Optional[str], model: str, prompt_version: str) -> str:
+    """Build the cache key from everything that influences the analysis output"""
+    parts = [content_hash, (user_question or "").strip(), model, prompt_version]
+    return hashlib.sha256("\x1f".join(parts).encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """
+    Two-tier result cache: an in-process LRU with TTL in front of a
+    persistent lookup (stored AnalysisResult rows).
+    """
+    def __init__(
+        self,
+        max_entries: int = RESULT_CACHE_MAX_ENTRIES,
+        ttl_seconds: int = RESULT_CACHE_TTL_SECONDS,
+        persistent_lookup: Optional[Callable[[str, int], Optional[Dict[str, Any]]]] = None
+    ):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.persistent_lookup = persistent_lookup
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.local_hits = 0
+        self.persistent_hits = 0
+        self.misses = 0
+        self.bypasses = 0
+        self.evictions = 0
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Look up a cached result, checking the local tier first"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                stored_at, value = entry
+                if now - stored_at <= self.ttl_seconds:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    self.local_hits += 1
+                    return dict(value)
+                del self._entries[key]
+                self.evictions += 1
+
+        value = None
+        if self.persistent_lookup:
+            try:
+                value = self.persistent_lookup(key, self.ttl_seconds)
+            except Exception as e:
+                print(f"Result cache lookup failed: {e}")
+
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.persistent_hits += 1
+        # Promote persistent hits into the local tier
+        self.put(key, value)
+        return dict(value)
+
+    def put(self, key: str, value: Dict[str, Any]):
+        """Store a result in the local tier, evicting least recently used entries"""
+        with self._lock:
+            self._entries[key] = (time.time(), dict(value))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def record_bypass(self):
+        with self._lock:
+            self.bypasses += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """Process-wide cache counters"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'local_hits': self.local_hits,
+                'persistent_hits': self.persistent_hits,
+                'misses': self.misses,
+                'bypasses': self.bypasses,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0,
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl_seconds': self.ttl_seconds
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,195 @@
+"""
+Token-aware Chunking
+Splits document text into chunks that respect sentence/paragraph boundaries
+and a token limit, with a precomputed token count and page span per chunk.
+"""
+import os
+import re
+import zlib
+import hashlib
+from collections import deque
+from functools import lru_cache
+from typing import Iterable, List, Tuple
+
+from core.state import Chunk
+
+CHUNK_MAX_TOKENS = int(os.getenv("CHUNK_MAX_TOKENS", "300"))
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "30"))
+TOKENIZER_ENCODING = os.getenv("TOKENIZER_ENCODING", "cl100k_base")
+# Content-defined boundaries: past CHUNK_MIN_TOKENS, a chunk also ends after any
+# sentence whose hash is divisible by CHUNK_BOUNDARY_MODULUS (0 = fill chunks to
+# the limit). Boundaries then depend on nearby text only, so an edit does not
+# shift every later chunk and unchanged chunks keep their content hash.
+CHUNK_MIN_TOKENS = int(os.getenv("CHUNK_MIN_TOKENS", str(CHUNK_MAX_TOKENS // 2)))
+CHUNK_BOUNDARY_MODULUS = int(os.getenv("CHUNK_BOUNDARY_MODULUS", "4"))
+
+# Fallback ratio when no tokenizer is available
+CHARS_PER_TOKEN = 4
+
+# A sentence ends at . ! ? followed by whitespace; a blank line ends a paragraph.
+# Trailing whitespace stays attached so chunks can be joined back losslessly.
+_UNIT_PATTERN = re.compile(r".+?(?:[.!?](?=\s)|\n\s*\n|$)\s*", re.S)
+_WHITESPACE = re.compile(r"\s+")
+
+
+@lru_cache(maxsize=1)
+def _get_encoding():
+    try:
+        import tiktoken
+        return tiktoken.get_encoding(TOKENIZER_ENCODING)
+    except Exception as e:
+        print(f"Warning: tokenizer unavailable, estimating token counts ({e}).")
+        return None
+
+
+def _normalized(text: str) -> bytes:
+    return _WHITESPACE.sub(" ", text).strip().encode("utf-8")
+
+
+def is_boundary(text: str, modulus: int) -> bool:
+    """Whether a content-defined boundary follows this text (independent of whitespace layout)"""
+    return modulus > 0 and zlib.crc32(_normalized(text)) % modulus == 0
+
+
+def chunk_hash(chunk: Chunk) -> str:
+    """Content hash of a chunk (or map window), insensitive to whitespace layout"""
+    return hashlib.sha1(_normalized(chunk["text"])).hexdigest()[:16]
+
+
+def count_tokens(text: str) -> int:
+    """Token count of text (estimated from length if no tokenizer is available)"""
+    encoding = _get_encoding()
+    if encoding is None:
+        return -(-len(text) // CHARS_PER_TOKEN)
+    return len(encoding.encode_ordinary(text))
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Leading part of text that fits in max_tokens"""
+    encoding = _get_encoding()
+    if encoding is None:
+        return text[:max_tokens * CHARS_PER_TOKEN]
+    # Only tokenize a prefix that is certain to hold max_tokens tokens
+    # (tokens average well under 8 chars), not the whole document.
+    prefix_chars = max_tokens * 8
+    while True:
+        tokens = encoding.encode_ordinary(text[:prefix_chars])
+        if len(tokens) >= max_tokens or prefix_chars >= len(text):
+            break
+        prefix_chars *= 2
+    if len(tokens) <= max_tokens and prefix_chars >= len(text):
+        return text
+    return encoding.decode(tokens[:max_tokens])
+
+
+def _split_by_tokens(text: str, max_tokens: int) -> List[Tuple[str, int]]:
+    """Hard-split a unit that is longer than a whole chunk"""
+    encoding = _get_encoding()
+    if encoding is None:
+        step = max_tokens * CHARS_PER_TOKEN
+        return [(text[i:i + step], count_tokens(text[i:i + step])) for i in range(0, len(text), step)]
+    tokens = encoding.encode_ordinary(text)
+    return [
+        (encoding.decode(tokens[i:i + max_tokens]), len(tokens[i:i + max_tokens]))
+        for i in range(0, len(tokens), max_tokens)
+    ]
+
+
+class TokenChunker:
+    """
+    Incremental chunker: pages are fed in order and complete chunks are
+    returned as soon as they are available. Each sentence is tokenized once,
+    so the whole pass is linear in the document length.
+    """
+    def __init__(
+        self,
+        max_tokens: int = CHUNK_MAX_TOKENS,
+        overlap_tokens: int = CHUNK_OVERLAP_TOKENS,
+        min_tokens: int = CHUNK_MIN_TOKENS,
+        boundary_modulus: int = CHUNK_BOUNDARY_MODULUS
+    ):
+        self.max_tokens = max_tokens
+        self.overlap_tokens = min(overlap_tokens, max_tokens // 2)
+        self.min_tokens = min(min_tokens, max_tokens)
+        self.boundary_modulus = boundary_modulus
+        self.total_tokens = 0
+        self._units: deque = deque()  # (text, tokens, page_number)
+        self._tokens = 0
+        self._fresh = 0  # units added since the last emitted chunk
+
+    def _emit(self) -> Chunk:
+        return {
+            "text": "".join(unit[0] for unit in self._units),
+            "tokens": self._tokens,
+            "page_start": self._units[0][2],
+            "page_end": self._units[-1][2]
+        }
+
+    def _carry_overlap(self):
+        """Keep trailing units (up to overlap_tokens) as the start of the next chunk"""
+        kept = deque()
+        kept_tokens = 0
+        for unit in reversed(self._units):
+            if kept_tokens + unit[1] > self.overlap_tokens:
+                break
+            kept.appendleft(unit)
+            kept_tokens += unit[1]
+        self._units = kept
+        self._tokens = kept_tokens
+        self._fresh = 0
+
+    def _add(self, text: str, tokens: int, page_number: int, out: List[Chunk]):
+        if self._tokens + tokens > self.max_tokens:
+            if self._fresh:
+                out.append(self._emit())
+                self._carry_overlap()
+            if self._tokens + tokens > self.max_tokens:
+                self._units.clear()
+                self._tokens = 0
+        self._units.append((text, tokens, page_number))
+        self._tokens += tokens
+        self._fresh += 1
+        if self._tokens >= self.min_tokens and is_boundary(text, self.boundary_modulus):
+            out.append(self._emit())
+            self._carry_overlap()
+
+    def feed_page(self, page_number: int, text: str) -> List[Chunk]:
+        """Add a page of text and return any chunks that are now complete"""
+        out: List[Chunk] = []
+        for match in _UNIT_PATTERN.finditer(text):
+            unit = match.group(0)
+            tokens = count_tokens(unit)
+            self.total_tokens += tokens
+            if tokens > self.max_tokens:
+                for piece, piece_tokens in _split_by_tokens(unit, self.max_tokens):
+                    self._add(piece, piece_tokens, page_number, out)
+            else:
+                self._add(unit, tokens, page_number, out)
+        return out
+
+    def finish(self) -> List[Chunk]:
+        """Return the final partial chunk once all pages have been fed"""
+        out = [self._emit()] if self._fresh else []
+        self._units.clear()
+        self._tokens = 0
+        self._fresh = 0
+        return out
+
+
+def chunk_pages(
+    pages: Iterable[Tuple[int, str]],
+    max_tokens: int = CHUNK_MAX_TOKENS,
+    overlap_tokens: int = CHUNK_OVERLAP_TOKENS
+) -> List[Chunk]:
+    """Chunk a sequence of (page_number, text) pairs"""
+    chunker = TokenChunker(max_tokens, overlap_tokens)
+    chunks: List[Chunk] = []
+    for page_number, text in pages:
+        chunks.extend(chunker.feed_page(page_number, text))
+    chunks.extend(chunker.finish())
+    return chunks
+
+
+def chunk_document(text: str, **kwargs) -> List[Chunk]:
+    """Chunk text that has no page information (treated as page 1)"""
+    return chunk_pages([(1, text)], **kwargs)
@@ -0,0 +1,158 @@
+"""
+Near-duplicate Detection
+MinHash signatures over the words of a document's chunks, and an LSH index
+(band keys stored next to each AnalysisResult) to find earlier analyses of
+nearly the same text, e.g. a contract revision where only dates or names
+changed. Those are missed by the exact content-hash cache. Per-chunk content
+hashes tell which parts of a revision changed.
+"""
+import os
+import re
+import zlib
+import hashlib
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from core.state import Chunk
+from core.chunking import chunk_hash
+from core.db import get_near_duplicate_candidates, get_analysis_for_reuse, get_analysis_partials
+
+NEAR_DUPLICATE_ENABLED = os.getenv("NEAR_DUPLICATE_ENABLED", "1") == "1"
+# Estimated Jaccard similarity of word shingles above which a prior analysis is reused
+NEAR_DUPLICATE_THRESHOLD = float(os.getenv("NEAR_DUPLICATE_THRESHOLD", "0.8"))
+# Changed text (in tokens) up to which only the changed chunks are re-analyzed;
+# beyond it the document is analyzed in full and only the classification is reused
+NEAR_DUPLICATE_MAX_CHANGED_TOKENS = int(os.getenv("NEAR_DUPLICATE_MAX_CHANGED_TOKENS", "2500"))
+
+SHINGLE_WORDS = 5
+MINHASH_PERMUTATIONS = 128
+# 16 bands of 8 rows: documents become candidates from about 0.7 similarity
+LSH_BANDS = 16
+LSH_ROWS = MINHASH_PERMUTATIONS // LSH_BANDS
+
+# Largest prime below 2**32: hash values and permutation parameters stay under
+# 2**32, so a * x + b cannot overflow uint64.
+_PRIME = np.uint64(4294967291)
+_rng = np.random.default_rng(20240101)  # fixed seed: signatures are persisted
+_PERM_A = _rng.integers(1, int(_PRIME), MINHASH_PERMUTATIONS, dtype=np.uint64)[:, None]
+_PERM_B = _rng.integers(0, int(_PRIME), MINHASH_PERMUTATIONS, dtype=np.uint64)[:, None]
+# Multipliers that combine SHINGLE_WORDS word hashes into one shingle hash
+_SHINGLE_MULT = _rng.integers(1, 2 ** 63, SHINGLE_WORDS, dtype=np.uint64) | np.uint64(1)
+
+_WORD = re.compile(r"\w+")
+_BLOCK = 4096
+
+
+def _shingle_hashes(text: str) -> np.ndarray:
+    """32-bit hashes of the word SHINGLE_WORDS-grams of text"""
+    words = _WORD.findall(text.lower())
+    if not words:
+        return np.empty(0, dtype=np.uint64)
+    word_hashes = np.array([zlib.crc32(w.encode("utf-8")) for w in words], dtype=np.uint64)
+    k = min(SHINGLE_WORDS, len(words))
+    n = len(words) - k + 1
+    combined = np.zeros(n, dtype=np.uint64)
+    for j in range(k):
+        combined += word_hashes[j:j + n] * _SHINGLE_MULT[j]  # wraps modulo 2**64
+    return (combined >> np.uint64(32)) ^ (combined & np.uint64(0xFFFFFFFF))
+
+
+def minhash_signature(chunks: List[Chunk]) -> Optional[np.ndarray]:
+    """MinHash signature (MINHASH_PERMUTATIONS uint32 values) of the chunks' word shingles, or None without words"""
+    shingles = np.unique(np.concatenate([_shingle_hashes(chunk["text"]) for chunk in chunks] or [np.empty(0, dtype=np.uint64)]))
+    if not len(shingles):
+        return None
+    signature = np.full(MINHASH_PERMUTATIONS, _PRIME, dtype=np.uint64)
+    # Blocks bound the (permutations x shingles) matrix for long documents
+    for start in range(0, len(shingles), _BLOCK):
+        block = shingles[start:start + _BLOCK][None, :]
+        np.minimum(signature, ((_PERM_A * block + _PERM_B) % _PRIME).min(axis=1), out=signature)
+    return signature.astype("<u4")
+
+
+def lsh_band_keys(signature: np.ndarray) -> List[str]:
+    """One key per band of LSH_ROWS signature values; documents sharing a key are candidates"""
+    return [
+        f"{band:02d}:{hashlib.blake2b(signature[band * LSH_ROWS:(band + 1) * LSH_ROWS].tobytes(), digest_size=8).hexdigest()}"
+        for band in range(LSH_BANDS)
+    ]
+
+
+def fingerprint_document(chunks: List[Chunk]) -> Optional[Dict[str, Any]]:
+    """
+    Everything stored with an AnalysisResult for near-duplicate lookups:
+    minhash (signature bytes), lsh_bands and chunk_hashes. None for a
+    document without words. CPU-bound; run it in a worker thread.
+    """
+    signature = minhash_signature(chunks)
+    if signature is None:
+        return None
+    return {
+        "minhash": signature.tobytes(),
+        "lsh_bands": lsh_band_keys(signature),
+        "chunk_hashes": [chunk_hash(chunk) for chunk in chunks]
+    }
+
+
+def signature_similarity(a: bytes, b: bytes) -> float:
+    """Estimated Jaccard similarity: the share of MinHash values two signatures agree on"""
+    sig_a = np.frombuffer(a, dtype="<u4")
+    sig_b = np.frombuffer(b, dtype="<u4")
+    if len(sig_a) != len(sig_b):
+        return 0.0
+    return float(np.mean(sig_a == sig_b))
+
+
+def find_near_duplicate(
+    fingerprint: Dict[str, Any],
+    model: str,
+    prompt_version: str,
+    threshold: float = NEAR_DUPLICATE_THRESHOLD
+) -> Optional[Dict[str, Any]]:
+    """
+    Stored analysis sharing an LSH band with the fingerprint whose estimated
+    similarity reaches threshold; of several, the one with the most chunks in
+    common (the most reusable), then the most similar. Like the result cache
+    key, only analyses by the same model and prompt version qualify: outputs
+    of another prompt are not reused as-is. Blocking (database read).
+
+    Returns:
+        the stored analysis (see get_analysis_for_reuse) with its
+        "similarity", or None
+    """
+    chunk_hashes = set(fingerprint["chunk_hashes"])
+    best, best_rank = None, None
+    for candidate in get_near_duplicate_candidates(fingerprint["lsh_bands"], model, prompt_version):
+        # A failed classification is not worth reusing
+        if candidate["document_type"] in (None, "Unknown"):
+            continue
+        similarity = signature_similarity(fingerprint["minhash"], candidate["minhash"])
+        if similarity < threshold:
+            continue
+        rank = (len(chunk_hashes.intersection(candidate["chunk_hashes"])), similarity)
+        if best_rank is None or rank > best_rank:
+            best, best_rank = candidate, rank
+    if best is None:
+        return None
+    return {**best, "similarity": round(best_rank[1], 4), "partials": get_analysis_partials(best["session_id"])}
+
+
+def find_previous_revision(fingerprint: Dict[str, Any], session_id: str) -> Optional[Dict[str, Any]]:
+    """
+    Stored analysis of a named earlier revision, with its similarity to the
+    fingerprinted document whatever it is, and whatever model and prompt
+    version it is from (see core.pipeline._near_duplicate_reuse). None if the
+    session has no stored analysis. Blocking (database read).
+    """
+    previous = get_analysis_for_reuse(session_id)
+    if previous is None:
+        return None
+    similarity = signature_similarity(fingerprint["minhash"], previous["minhash"]) if previous["minhash"] else 0.0
+    return {**previous, "similarity": round(similarity, 4)}
+
+
+def changed_chunks(fingerprint: Dict[str, Any], previous_hashes: List[str]) -> List[int]:
+    """Indexes of chunks whose content does not occur in the previous revision"""
+    previous = set(previous_hashes or [])
+    return [i for i, h in enumerate(fingerprint["chunk_hashes"]) if h not in previous]
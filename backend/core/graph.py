@@ -1,28 +1,83 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import get_type_hints
+from langchain_core.runnables import RunnableLambda
 from langgraph.graph import StateGraph, END
 from core.state import DocumentState
 from core.agents import (
-    document_classifier_agent,
+    classify_and_extract_agent,
+    aclassify_and_extract_agent,
     content_extraction_agent,
+    acontent_extraction_agent,
     summarization_agent,
-    insight_generator_agent
+    asummarization_agent,
+    insight_generator_agent,
+    ainsight_generator_agent,
+    question_answering_agent,
+    aquestion_answering_agent
 )
 
+# Reducers declared on DocumentState via Annotated[..., reducer]
+_STATE_REDUCERS = {
+    key: hint.__metadata__[0]
+    for key, hint in get_type_hints(DocumentState, include_extras=True).items()
+    if getattr(hint, "__metadata__", None)
+}
+
+def merge_updates(*updates: dict) -> dict:
+    """
+    Combine state updates from agents that ran side by side, using the
+    state's reducers for shared keys (e.g. agent_logs) and last-write
+    for the rest.
+    """
+    merged = {}
+    for update in updates:
+        for key, value in update.items():
+            if key in merged and key in _STATE_REDUCERS:
+                merged[key] = _STATE_REDUCERS[key](merged[key], value)
+            else:
+                merged[key] = value
+    return merged
+
+# Agents that only depend on the classifier's output and can run concurrently.
+# The summarizer reads raw_text only, so it does not need to wait for the extractor;
+# the question answerer (a no-op without a user_question) only needs the chunk index.
+PARALLEL_AGENTS = [content_extraction_agent, summarization_agent, question_answering_agent]
+APARALLEL_AGENTS = [acontent_extraction_agent, asummarization_agent, aquestion_answering_agent]
+
+def parallel_analysis(state: DocumentState) -> DocumentState:
+    """Fan out to the extractor, summarizer and question answerer, then fan their updates back in"""
+    with ThreadPoolExecutor(max_workers=len(PARALLEL_AGENTS)) as executor:
+        futures = [executor.submit(agent, state) for agent in PARALLEL_AGENTS]
+        return merge_updates(*[f.result() for f in futures])
+
+async def aparallel_analysis(state: DocumentState) -> DocumentState:
+    """Async fan-out/fan-in: the agents await their LLM calls concurrently"""
+    updates = await asyncio.gather(*[agent(state) for agent in APARALLEL_AGENTS])
+    return merge_updates(*updates)
+
 def create_graph():
     workflow = StateGraph(DocumentState)
-    
+
     # Add Nodes
-    workflow.add_node("classifier", document_classifier_agent)
-    workflow.add_node("extractor", content_extraction_agent)
-    workflow.add_node("summarizer", summarization_agent)
-    workflow.add_node("insight_generator", insight_generator_agent)
-    
-    # Define Edges (Linear Flow)
+    # Each node carries a sync and an async implementation, so the graph can be
+    # driven with invoke() from scripts or ainvoke() from the API without
+    # blocking the event loop on LLM round trips.
+    # Fan-in is done inside the "analysis" node: this LangGraph version gives
+    # each node a single-value inbox, so two branches cannot both edge into
+    # the insight generator in the same step.
+    # The classifier node also extracts sections when the fused call applies
+    # (FUSED_CLASSIFY_EXTRACT); the extractor then has nothing left to do.
+    workflow.add_node("classifier", RunnableLambda(classify_and_extract_agent, afunc=aclassify_and_extract_agent))
+    workflow.add_node("analysis", RunnableLambda(parallel_analysis, afunc=aparallel_analysis))
+    workflow.add_node("insight_generator", RunnableLambda(insight_generator_agent, afunc=ainsight_generator_agent))
+
+    # Define Edges
     workflow.set_entry_point("classifier")
-    workflow.add_edge("classifier", "extractor")
-    workflow.add_edge("extractor", "summarizer")
-    workflow.add_edge("summarizer", "insight_generator")
+    workflow.add_edge("classifier", "analysis")
+    workflow.add_edge("analysis", "insight_generator")
     workflow.add_edge("insight_generator", END)
-    
+
     return workflow.compile()
 
 app_graph = create_graph()
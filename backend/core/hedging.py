@@ -0,0 +1,125 @@
+"""
+Hedged Requests
+A call that has not returned by the usual worst-case latency (the p95 of
+earlier calls of a similar size, from the analytics history) gets a second,
+identical request; whichever answers first is used and the other cancelled.
+This trades a few duplicate calls for a much shorter tail. Only plain
+(non-streamed) calls are hedged, see core.llm.RateControlledLLM.
+"""
+import os
+import threading
+from collections import deque
+from typing import Any, Dict, Iterable, Optional
+
+import numpy as np
+
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "0") == "1"
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))
+# Calls of a size class observed before its percentile is trusted
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "30"))
+# Never hedge sooner than this (seconds), whatever the history says
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", "1.0"))
+# Stored analytics sessions the history starts from
+HEDGE_HISTORY_SESSIONS = int(os.getenv("HEDGE_HISTORY_SESSIONS", "200"))
+
+# Latencies kept per (model, size class); older ones drop out
+_SAMPLES_PER_CLASS = 1000
+
+
+def size_class(prompt_tokens: int) -> int:
+    """Prompts of 0-1k tokens are class 0, 1-2k class 1, 2-4k class 2 and so on"""
+    return (max(prompt_tokens, 0) // 1000).bit_length()
+
+
+class LatencyHistory:
+    """
+    Recent latencies of completed, non-streamed API calls by model and
+    prompt size class. Latency grows with the prompt, so a single percentile
+    would hedge long map-reduce calls all the time and short ones never.
+    """
+    def __init__(self, min_samples: int = HEDGE_MIN_SAMPLES):
+        self.min_samples = min_samples
+        self._latencies: Dict[tuple, deque] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, call_details: Iterable[Dict[str, Any]]):
+        with self._lock:
+            for call in call_details:
+                if call.get("cache_hit") or call.get("streamed") or call.get("latency_seconds") is None:
+                    continue
+                key = (call.get("model") or "unknown", size_class(call.get("prompt_tokens", 0)))
+                self._latencies.setdefault(key, deque(maxlen=_SAMPLES_PER_CLASS)).append(call["latency_seconds"])
+
+    def load_history(self, limit: int = HEDGE_HISTORY_SESSIONS):
+        """Start from the calls of the most recent stored analytics sessions. Blocking (database read)."""
+        from core.db import get_recent_call_details
+        for call_details in get_recent_call_details(limit):
+            self.observe(call_details)
+
+    def percentile(self, model: Optional[str], prompt_tokens: int, q: float = HEDGE_PERCENTILE) -> Optional[float]:
+        """Latency percentile of calls like this one, or None without enough history"""
+        with self._lock:
+            latencies = self._latencies.get((model or "unknown", size_class(prompt_tokens)))
+            if latencies is None or len(latencies) < self.min_samples:
+                return None
+            samples = list(latencies)
+        return float(np.percentile(samples, q))
+
+    def hedge_delay(self, model: Optional[str], prompt_tokens: int) -> Optional[float]:
+        """Seconds after which a call is hedged, or None when hedging is off or the history is too short"""
+        if not HEDGE_ENABLED:
+            return None
+        latency = self.percentile(model, prompt_tokens)
+        return None if latency is None else max(latency, HEDGE_MIN_DELAY)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            classes = {key: list(latencies) for key, latencies in self._latencies.items()}
+        return {
+            f"{model}/{size}": {
+                "samples": len(samples),
+                "p50_seconds": round(float(np.percentile(samples, 50)), 4),
+                f"p{HEDGE_PERCENTILE:g}_seconds": round(float(np.percentile(samples, HEDGE_PERCENTILE)), 4)
+            }
+            for (model, size), samples in classes.items()
+        }
+
+
+class HedgeCounters:
+    """Process-wide hedging outcomes, to tune HEDGE_PERCENTILE against cost"""
+    def __init__(self):
+        self.calls = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.wasted_tokens = 0
+        self._lock = threading.Lock()
+
+    def record_call(self):
+        with self._lock:
+            self.calls += 1
+
+    def record_hedge(self):
+        with self._lock:
+            self.hedged += 1
+
+    def record_outcome(self, hedge_won: bool, wasted_tokens: int):
+        """A hedged call returned: whether the hedge answered first, and the tokens the loser cost"""
+        with self._lock:
+            self.hedge_wins += hedge_won
+            self.wasted_tokens += wasted_tokens
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "enabled": HEDGE_ENABLED,
+                "percentile": HEDGE_PERCENTILE,
+                "calls": self.calls,
+                "hedged": self.hedged,
+                "hedge_rate": round(self.hedged / self.calls, 4) if self.calls else 0,
+                "hedge_wins": self.hedge_wins,
+                "wasted_tokens": self.wasted_tokens
+            }
+
+
+latency_history = LatencyHistory()
+hedge_counters = HedgeCounters()
@@ -0,0 +1,140 @@
+"""
+Streaming Document Ingestion
+Parses an uploaded PDF page by page, chunking as pages arrive and starting
+the classifier as soon as enough leading text is available. Once parsed, the
+document is fingerprinted for near-duplicate detection.
+"""
+import asyncio
+from typing import Dict, Any, Optional
+
+from pypdf.errors import PyPdfError
+
+from core.pdf import aiter_pdf_pages, PdfSource
+from core.chunking import TokenChunker
+from core.agents import adocument_classifier_agent, CLASSIFIER_SAMPLE_TOKENS, EXTRACTOR_MAX_TOKENS, FUSED_CLASSIFY_EXTRACT, MODEL_NAME, PROMPT_VERSION
+from core.mapreduce import MAP_REDUCE_MODE
+from core.dedup import NEAR_DUPLICATE_ENABLED, fingerprint_document, find_near_duplicate, find_previous_revision
+
+# Sentences are tokenized separately, which can count slightly more tokens than
+# the joined text; the margin makes sure the early sample is never short.
+EARLY_CLASSIFY_MARGIN_TOKENS = 64
+
+
+class EmptyDocumentError(ValueError):
+    """No text could be extracted from the document"""
+
+
+def _early_classify_tokens() -> Optional[int]:
+    """
+    Parsed tokens after which the classifier starts early, or None for never.
+    With the fused classify+extract call, documents it applies to (short enough
+    for a single extraction pass) are left to it; the classifier only starts
+    early once a document is known to be longer.
+    """
+    if not FUSED_CLASSIFY_EXTRACT or MAP_REDUCE_MODE == "always":
+        return CLASSIFIER_SAMPLE_TOKENS + EARLY_CLASSIFY_MARGIN_TOKENS
+    if MAP_REDUCE_MODE == "off":
+        return None
+    return max(CLASSIFIER_SAMPLE_TOKENS, EXTRACTOR_MAX_TOKENS) + EARLY_CLASSIFY_MARGIN_TOKENS
+
+
+async def ingest_pdf(
+    source: PdfSource,
+    token_tracker=None,
+    agent_tracker=None,
+    early_classify: bool = True,
+    reuse_near_duplicates: bool = True,
+    revision_of: Optional[str] = None
+) -> Dict[str, Any]:
+    """
+    Stream a PDF into text and token-sized chunks (with page spans).
+
+    With early_classify, the classifier is launched once CLASSIFIER_SAMPLE_TOKENS
+    of text have been parsed (later with the fused call, see
+    _early_classify_tokens) and runs concurrently with the remaining pages. It
+    sees exactly the sample it would have seen after a full parse.
+
+    With reuse_near_duplicates, stored analyses are searched for a near-duplicate
+    of the parsed document. If one is found while the early classifier call is
+    still in flight, that call is cancelled: the near-duplicate's classification
+    is reused instead. revision_of names the session of an earlier revision to
+    use as the near-duplicate, however similar it is.
+
+    Returns:
+        dict with raw_text, chunks, num_pages, num_tokens, classification (the
+        classifier's state update, or None if it did not run early), fingerprint
+        (see core.dedup.fingerprint_document, None when disabled) and
+        near_duplicate (see core.dedup.find_near_duplicate)
+
+    Raises:
+        EmptyDocumentError: if the file cannot be read as a PDF
+    """
+    chunker = TokenChunker()
+    text_parts = []
+    chunks = []
+    num_pages = 0
+    classifier_task: Optional[asyncio.Task] = None
+    early_classify_tokens = _early_classify_tokens() if early_classify else None
+
+    try:
+        async for page_number, page_text in aiter_pdf_pages(source):
+            num_pages = page_number
+            if not page_text:
+                continue
+            piece = page_text + "\n"
+            text_parts.append(piece)
+            chunks.extend(chunker.feed_page(page_number, piece))
+
+            if (
+                early_classify_tokens is not None
+                and classifier_task is None
+                and chunker.total_tokens >= early_classify_tokens
+            ):
+                classifier_task = asyncio.create_task(adocument_classifier_agent({
+                    "raw_text": "".join(text_parts),
+                    "document_type": None,
+                    "_token_tracker": token_tracker,
+                    "_agent_tracker": agent_tracker
+                }))
+        chunks.extend(chunker.finish())
+    except BaseException as e:
+        if classifier_task:
+            classifier_task.cancel()
+        # Truncated or corrupt uploads are the client's error, however far parsing got
+        if isinstance(e, PyPdfError):
+            raise EmptyDocumentError(f"Could not read PDF: {e}") from e
+        raise
+
+    fingerprint = near_duplicate = None
+    try:
+        if NEAR_DUPLICATE_ENABLED or revision_of:
+            fingerprint = await asyncio.to_thread(fingerprint_document, chunks)
+        if fingerprint and revision_of:
+            near_duplicate = await asyncio.to_thread(find_previous_revision, fingerprint, revision_of)
+        elif fingerprint and reuse_near_duplicates:
+            near_duplicate = await asyncio.to_thread(find_near_duplicate, fingerprint, MODEL_NAME, PROMPT_VERSION)
+    except BaseException:
+        if classifier_task:
+            classifier_task.cancel()
+        raise
+
+    if near_duplicate and classifier_task and not classifier_task.done():
+        classifier_task.cancel()
+        try:
+            await classifier_task
+        except asyncio.CancelledError:
+            pass
+        if agent_tracker:
+            agent_tracker.discard_agent("classifier")
+        classifier_task = None
+
+    classification = await classifier_task if classifier_task else None
+    return {
+        "raw_text": "".join(text_parts),
+        "chunks": chunks,
+        "num_pages": num_pages,
+        "num_tokens": chunker.total_tokens,
+        "classification": classification,
+        "fingerprint": fingerprint,
+        "near_duplicate": near_duplicate
+    }
@@ -0,0 +1,481 @@
+"""
+Shared LLM Client
+One process-wide ChatOpenAI backed by keep-alive httpx connection pools.
+Per-request callbacks (token tracking) are attached through the run config,
+so the client itself never has to be rebuilt.
+
+Every call goes through RateControlledLLM: it waits for the process-wide
+concurrency limiter and rate limiter (core.ratelimit), retries throttled
+or transiently failed calls with jittered backoff, gives up at the calling
+agent's deadline and hedges slow calls (core.hedging).
+"""
+import os
+import time
+import asyncio
+import threading
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, Optional
+
+import httpx
+import openai
+from langchain_openai import ChatOpenAI
+from langchain_core.runnables import Runnable, RunnableConfig
+from langchain_core.globals import set_llm_cache, get_llm_cache
+from langchain_core.load import dumps
+
+from core.ratelimit import llm_rate_limiter, llm_concurrency_limiter, retry_delay, LLM_MAX_RETRIES
+from core.llm_cache import prompt_cache, cache_call, CacheMiss
+from core.chunking import count_tokens
+from core.hedging import latency_history, hedge_counters
+
+# Initialize OpenRouter LLM
+# Note: User must provide OPENROUTER_API_KEY in .env
+# We use a default lightweight model, but allow configuration.
+MODEL_NAME = os.getenv("LLM_MODEL", "google/gemini-2.0-flash-001") # flexible default
+BASE_URL = os.getenv("LLM_BASE_URL", "https://openrouter.ai/api/v1")
+API_KEY = os.getenv("OPENROUTER_API_KEY")
+
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "100"))
+LLM_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("LLM_MAX_KEEPALIVE_CONNECTIONS", "20"))
+LLM_KEEPALIVE_EXPIRY = float(os.getenv("LLM_KEEPALIVE_EXPIRY", "30"))
+# Seconds one request may take (connect, write, read, pool)
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "60"))
+# Seconds each agent may spend on the LLM in total (queueing, retries and all its
+# calls), as "agent=seconds,..."; agents not listed are only held to LLM_TIMEOUT per call
+AGENT_DEADLINES = os.getenv(
+    "AGENT_DEADLINES",
+    "classifier=30,classifier_extractor=90,extractor=180,summarizer=180,insight_generator=60,question_answerer=45"
+)
+
+# Prompt-level response cache for every chain built on the shared client
+if prompt_cache is not None:
+    set_llm_cache(prompt_cache)
+
+_llm: Optional[ChatOpenAI] = None
+_http_clients: list = []
+_llm_lock = threading.Lock()
+
+
+def _limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=LLM_MAX_CONNECTIONS,
+        max_keepalive_connections=LLM_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=LLM_KEEPALIVE_EXPIRY
+    )
+
+
+def build_llm(api_key: Optional[str] = API_KEY, base_url: str = BASE_URL, model: str = MODEL_NAME) -> ChatOpenAI:
+    """
+    Build a ChatOpenAI whose sync and async OpenAI clients each own a pooled
+    httpx client. ChatOpenAI only accepts a single `http_client` for both, so
+    the two clients are constructed here and passed in directly.
+    """
+    if not api_key:
+        # Fallback only for demonstration or specific envs; ideally should raise error or handle gracefully
+        print("Warning: OPENROUTER_API_KEY not found.")
+
+    sync_http = httpx.Client(limits=_limits(), timeout=LLM_TIMEOUT)
+    async_http = httpx.AsyncClient(limits=_limits(), timeout=LLM_TIMEOUT)
+    _http_clients.extend([sync_http, async_http])
+
+    # Retries are RateControlledLLM's, so the limiter sees every throttled attempt
+    client_params = {"api_key": api_key, "base_url": base_url, "timeout": LLM_TIMEOUT, "max_retries": 0}
+    return ChatOpenAI(
+        model=model,
+        openai_api_key=api_key,
+        openai_api_base=base_url,
+        temperature=0.1,
+        request_timeout=LLM_TIMEOUT,
+        max_retries=0,
+        client=openai.OpenAI(http_client=sync_http, **client_params).chat.completions,
+        async_client=openai.AsyncOpenAI(http_client=async_http, **client_params).chat.completions
+    )
+
+
+def get_shared_llm() -> ChatOpenAI:
+    """The process-wide client, created on first use"""
+    global _llm
+    with _llm_lock:
+        if _llm is None:
+            _llm = build_llm()
+        return _llm
+
+
+def _is_throttled(error: BaseException) -> bool:
+    return isinstance(error, openai.APIStatusError) and error.status_code in (429, 503)
+
+def _is_retryable(error: BaseException) -> bool:
+    return _is_throttled(error) or isinstance(error, (openai.InternalServerError, openai.APIConnectionError))
+
+def _retry_after(error: BaseException) -> Optional[float]:
+    response = getattr(error, "response", None)
+    try:
+        return float(response.headers.get("retry-after")) if response is not None else None
+    except (TypeError, ValueError):
+        return None
+
+def _prompt_text(value: Any) -> str:
+    if hasattr(value, "to_string"):
+        return value.to_string()
+    if isinstance(value, list):
+        return "\n".join(str(getattr(m, "content", m)) for m in value)
+    return str(value)
+
+
+class DeadlineExceeded(TimeoutError):
+    """An agent's LLM call did not return before the agent's deadline (AGENT_DEADLINES)"""
+
+
+def parse_agent_deadlines(value: str) -> Dict[str, float]:
+    deadlines = {}
+    for item in value.split(","):
+        if "=" in item:
+            agent, seconds = item.split("=", 1)
+            deadlines[agent.strip()] = float(seconds)
+    return deadlines
+
+_agent_deadlines = parse_agent_deadlines(AGENT_DEADLINES)
+
+def agent_deadline(agent_name: str) -> Optional[float]:
+    """Monotonic time by which an agent starting now must be done with the LLM, or None"""
+    seconds = _agent_deadlines.get(agent_name)
+    return time.monotonic() + seconds if seconds else None
+
+
+# Ticket of a hedge that found no free slot
+_NO_SLOT = object()
+
+
+class RateControlledLLM(Runnable):
+    """
+    The shared client behind the process-wide concurrency and rate limiters,
+    with retries, an optional deadline (monotonic time) for all of its calls,
+    and hedging of plain async calls (see core.hedging). Queue waits, the
+    concurrency limit, retries, missed deadlines and hedges are reported to
+    the request's TokenUsageTracker, if it has one. Streamed calls are only
+    retried until their first chunk arrives, and never hedged.
+
+    Async calls are cancelled at the deadline; a blocking sync call cannot
+    be, so the sync path only stops retrying once the deadline has passed.
+
+    Plain calls the prompt cache can answer skip the limiters altogether:
+    they neither wait for a slot nor spend a token, and their latency is not
+    the provider's. Such a call may only be answered from the cache: if its
+    entry is evicted before the client reads it, the call takes the limited
+    path instead of reaching the provider. Only responses cacheable accepts
+    are stored (see core.llm_cache.cache_call). Streamed calls never use the cache.
+    """
+    def __init__(self, llm: ChatOpenAI, usage_tracker=None, deadline: Optional[float] = None, cacheable: Optional[Callable[[str], bool]] = None):
+        self.llm = llm
+        self.usage_tracker = usage_tracker
+        self.deadline = deadline
+        self.cacheable = cacheable
+
+    def _remaining(self) -> Optional[float]:
+        return None if self.deadline is None else self.deadline - time.monotonic()
+
+    def _deadline_exceeded(self):
+        if self.usage_tracker is not None:
+            self.usage_tracker.record_deadline_exceeded()
+        raise DeadlineExceeded("LLM call did not return before the agent's deadline")
+
+    def _check_deadline(self):
+        remaining = self._remaining()
+        if remaining is not None and remaining <= 0:
+            self._deadline_exceeded()
+
+    def _admitted(self, waited: float):
+        if self.usage_tracker is not None:
+            limit = llm_concurrency_limiter.current_limit() if llm_concurrency_limiter else None
+            self.usage_tracker.record_queue_wait(waited, limit)
+
+    def _release(self, ticket, **observed):
+        if ticket is not None:
+            llm_concurrency_limiter.release(ticket, **observed)
+
+    def _retry_delay(self, error: BaseException, attempt: int, retry: bool = True) -> Optional[float]:
+        """Seconds to wait before retrying a failed attempt, or None to give up"""
+        if not retry or not _is_retryable(error) or attempt >= LLM_MAX_RETRIES:
+            return None
+        delay = retry_delay(attempt, _retry_after(error))
+        remaining = self._remaining()
+        if remaining is not None and delay >= remaining:
+            return None
+        if self.usage_tracker is not None:
+            self.usage_tracker.record_retry(_is_throttled(error))
+        return delay
+
+    def _failed(self, ticket, error: BaseException):
+        self._release(ticket, throttled=_is_throttled(error))
+
+    def _succeeded(self, ticket, start: float, prompt: str, output: str, cache_hit: bool = False):
+        if cache_hit:
+            # Stored by a concurrent call since _cached looked
+            self._release(ticket)
+        elif ticket is not None:
+            self._release(ticket, latency=time.monotonic() - start, prompt_tokens=count_tokens(prompt), output_tokens=count_tokens(output))
+
+    def _cached(self, input: Any, kwargs: dict) -> bool:
+        """Whether the prompt cache holds the answer to this call, computed the way the client looks it up"""
+        if prompt_cache is None or get_llm_cache() is not prompt_cache or self.llm.cache is False:
+            return False
+        options = dict(kwargs)
+        stop = options.pop("stop", None)
+        messages = self.llm._convert_input(input).to_messages()
+        return prompt_cache.contains(dumps(messages), self.llm._get_llm_string(stop=stop, **options))
+
+    def _acquire(self):
+        ticket, waited = llm_concurrency_limiter.acquire() if llm_concurrency_limiter else (None, 0.0)
+        if llm_rate_limiter is not None:
+            bucket_start = time.monotonic()
+            llm_rate_limiter.acquire()
+            waited += time.monotonic() - bucket_start
+        self._admitted(waited)
+        return ticket
+
+    async def _aacquire(self):
+        ticket, waited = await llm_concurrency_limiter.aacquire() if llm_concurrency_limiter else (None, 0.0)
+        if llm_rate_limiter is not None:
+            bucket_start = time.monotonic()
+            try:
+                await llm_rate_limiter.aacquire()
+            except asyncio.CancelledError:
+                self._release(ticket)
+                raise
+            waited += time.monotonic() - bucket_start
+        self._admitted(waited)
+        return ticket
+
+    async def _aacquire_by_deadline(self):
+        self._check_deadline()
+        try:
+            return await asyncio.wait_for(self._aacquire(), self._remaining())
+        except asyncio.TimeoutError:
+            self._deadline_exceeded()
+
+    def _hedge_slot(self):
+        """A slot for a hedge if one is free right now; hedges never queue"""
+        ticket = None
+        if llm_concurrency_limiter is not None:
+            ticket = llm_concurrency_limiter.try_acquire()
+            if ticket is None:
+                return _NO_SLOT
+        if llm_rate_limiter is not None and not llm_rate_limiter.try_acquire():
+            self._release(ticket)
+            return _NO_SLOT
+        return ticket
+
+    def _cancel(self, calls: dict, prompt: str) -> int:
+        """Cancel the calls still running and free their slots; the prompt tokens they cost"""
+        for task, (ticket, _, _) in calls.items():
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled():
+                task.exception()  # retrieved, so a failed loser is not reported as unhandled
+            self._release(ticket)
+        wasted = count_tokens(prompt) * len(calls)
+        calls.clear()
+        return wasted
+
+    async def _ahedged_call(self, ticket, input: Any, config: Optional[RunnableConfig], kwargs: dict, prompt: str, call):
+        """
+        One attempt, holding ticket's slot. If it runs past the hedge delay, the
+        same request is sent again (when a slot is free right now) and the first
+        one to succeed is used; the other is cancelled. Frees every slot it holds.
+        """
+        calls = {asyncio.ensure_future(self.llm.ainvoke(input, config, **kwargs)): (ticket, time.monotonic(), False)}
+        hedge_delay = latency_history.hedge_delay(self.llm.model_name, count_tokens(prompt))
+        hedge_at = time.monotonic() + hedge_delay if hedge_delay is not None else None
+        hedged, error = False, None
+        try:
+            while calls:
+                timeout = self._remaining()
+                if hedge_at is not None:
+                    until_hedge = max(hedge_at - time.monotonic(), 0)
+                    timeout = until_hedge if timeout is None else min(timeout, until_hedge)
+                done, _ = await asyncio.wait(calls, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    if hedge_at is not None and time.monotonic() >= hedge_at:
+                        hedge_at = None
+                        hedge_ticket = self._hedge_slot()
+                        if hedge_ticket is not _NO_SLOT:
+                            hedged = True
+                            hedge_counters.record_hedge()
+                            hedge = asyncio.ensure_future(self.llm.ainvoke(input, config, **kwargs))
+                            calls[hedge] = (hedge_ticket, time.monotonic(), True)
+                        continue
+                    self._deadline_exceeded()
+                for task in done:
+                    task_ticket, start, is_hedge = calls.pop(task)
+                    try:
+                        result = task.result()
+                    except Exception as e:
+                        self._failed(task_ticket, e)
+                        error = e
+                        continue
+                    self._succeeded(task_ticket, start, prompt, str(result.content), call.hit)
+                    if hedged:
+                        wasted = self._cancel(calls, prompt)
+                        hedge_counters.record_outcome(is_hedge, wasted)
+                        if self.usage_tracker is not None:
+                            self.usage_tracker.record_hedge(is_hedge, wasted)
+                    return result
+            raise error
+        finally:
+            # Deadline passed, or the caller gave up
+            self._cancel(calls, prompt)
+
+    def invoke(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any):
+        if self._cached(input, kwargs):
+            try:
+                with cache_call(self.cacheable, cached_only=True):
+                    return self.llm.invoke(input, config, **kwargs)
+            except CacheMiss:
+                # Evicted since _cached looked; take the limited path
+                pass
+        prompt = _prompt_text(input)
+        hedge_counters.record_call()
+        attempt = 0
+        while True:
+            self._check_deadline()
+            ticket = self._acquire()
+            start = time.monotonic()
+            try:
+                with cache_call(self.cacheable) as call:
+                    result = self.llm.invoke(input, config, **kwargs)
+            except Exception as e:
+                self._failed(ticket, e)
+                delay = self._retry_delay(e, attempt)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                attempt += 1
+                continue
+            self._succeeded(ticket, start, prompt, str(result.content), call.hit)
+            return result
+
+    async def ainvoke(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any):
+        if await asyncio.to_thread(self._cached, input, kwargs):
+            try:
+                with cache_call(self.cacheable, cached_only=True):
+                    return await self.llm.ainvoke(input, config, **kwargs)
+            except CacheMiss:
+                pass
+        prompt = _prompt_text(input)
+        hedge_counters.record_call()
+        attempt = 0
+        while True:
+            ticket = await self._aacquire_by_deadline()
+            try:
+                with cache_call(self.cacheable) as call:
+                    return await self._ahedged_call(ticket, input, config, kwargs, prompt, call)
+            except DeadlineExceeded:
+                raise
+            except Exception as e:
+                delay = self._retry_delay(e, attempt)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    def stream(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any) -> Iterator:
+        prompt = _prompt_text(input)
+        hedge_counters.record_call()
+        attempt = 0
+        while True:
+            self._check_deadline()
+            ticket = self._acquire()
+            start = time.monotonic()
+            output = []
+            try:
+                for chunk in self.llm.stream(input, config, **kwargs):
+                    output.append(str(chunk.content))
+                    yield chunk
+            except GeneratorExit:
+                self._release(ticket)
+                raise
+            except Exception as e:
+                self._failed(ticket, e)
+                delay = self._retry_delay(e, attempt, retry=not output)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                attempt += 1
+                continue
+            self._succeeded(ticket, start, prompt, "".join(output))
+            return
+
+    async def _anext_by_deadline(self, chunks: AsyncIterator):
+        try:
+            return await asyncio.wait_for(chunks.__anext__(), self._remaining())
+        except asyncio.TimeoutError:
+            self._deadline_exceeded()
+
+    async def astream(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any) -> AsyncIterator:
+        prompt = _prompt_text(input)
+        hedge_counters.record_call()
+        attempt = 0
+        while True:
+            ticket = await self._aacquire_by_deadline()
+            start = time.monotonic()
+            output = []
+            chunks = self.llm.astream(input, config, **kwargs)
+            try:
+                while True:
+                    try:
+                        chunk = await self._anext_by_deadline(chunks)
+                    except StopAsyncIteration:
+                        break
+                    output.append(str(chunk.content))
+                    yield chunk
+            except (GeneratorExit, asyncio.CancelledError, DeadlineExceeded):
+                self._release(ticket)
+                await chunks.aclose()
+                raise
+            except Exception as e:
+                self._failed(ticket, e)
+                delay = self._retry_delay(e, attempt, retry=not output)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            self._succeeded(ticket, start, prompt, "".join(output))
+            return
+
+
+def _usage_tracker(callbacks):
+    # Duck-typed rather than imported: core.analytics is not a dependency of the client
+    return next((c for c in callbacks or [] if hasattr(c, "record_queue_wait")), None)
+
+
+def get_llm(callbacks=None, deadline: Optional[float] = None, cacheable: Optional[Callable[[str], bool]] = None):
+    """
+    Shared client with per-call callbacks bound into its run config. Binding
+    is cheap and leaves the shared client untouched. Calls wait for the
+    process-wide concurrency and rate limiters and are retried when throttled;
+    with a deadline (see agent_deadline) they fail with DeadlineExceeded once
+    it has passed. With cacheable, only responses it accepts (e.g. that the
+    chain's output parser can parse) are stored in the prompt cache.
+    """
+    llm = RateControlledLLM(get_shared_llm(), _usage_tracker(callbacks), deadline, cacheable)
+    if callbacks:
+        return llm.with_config(callbacks=callbacks)
+    return llm
+
+
+async def aclose_llm():
+    """Close the pooled connections (application shutdown)"""
+    global _llm
+    with _llm_lock:
+        clients = list(_http_clients)
+        _http_clients.clear()
+        _llm = None
+    for client in clients:
+        try:
+            if isinstance(client, httpx.AsyncClient):
+                await client.aclose()
+            else:
+                client.close()
+        except Exception as e:
+            # Connections opened on another event loop can't be closed cleanly from this one
+            print(f"Warning: failed to close LLM HTTP client: {e}")
@@ -0,0 +1,281 @@
+"""
+Prompt-level LLM Response Cache
+Answers repeated prompts (the same boilerplate opening sent to the
+classifier, the same sections sent to the insight generator, ...) from a
+local SQLite file instead of a paid call. It is installed as LangChain's
+global LLM cache, so every agent chain built on the shared client uses it.
+"""
+import os
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence
+
+from langchain_core.caches import BaseCache
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, Generation
+
+from core.chunking import count_tokens
+
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "1") == "1"
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "./llm_cache.db")
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "20000"))
+
+_WHITESPACE = re.compile(r"\s+")
+
+# Set for a request that must not be answered from the cache (bypass_cache);
+# context variables follow the request into its tasks and executor calls.
+_bypass: ContextVar[bool] = ContextVar("prompt_cache_bypass", default=False)
+
+
+def bypass_prompt_cache():
+    """Skip cache lookups for the rest of the current request (responses are still stored)"""
+    _bypass.set(True)
+
+
+class CacheMiss(Exception):
+    """Raised by the lookup of a cached_only call the cache cannot answer, before the model is called"""
+
+
+class CacheCall:
+    """
+    One client call's use of the prompt cache (see cache_call): whether it was
+    answered from the cache, which responses it allows to be stored
+    (cacheable: response text -> bool, None for any), and whether it may only
+    be answered from the cache (cached_only).
+    """
+    def __init__(self, cacheable: Optional[Callable[[str], bool]] = None, cached_only: bool = False):
+        self.cacheable = cacheable
+        self.cached_only = cached_only
+        self.hit = False
+
+
+# The client call in progress. A mutable object rather than a flag, so a hit
+# in a task or executor call that copied the context is still seen.
+_call: ContextVar[Optional[CacheCall]] = ContextVar("prompt_cache_call", default=None)
+
+
+@contextmanager
+def cache_call(cacheable: Optional[Callable[[str], bool]] = None, cached_only: bool = False) -> Iterator[CacheCall]:
+    """
+    Report whether the model calls made inside the block were answered from
+    the cache, and store only the responses cacheable accepts. A response the
+    caller cannot parse would otherwise be replayed to it on every retry.
+
+    With cached_only, a model call the cache cannot answer raises CacheMiss
+    instead of reaching the provider, e.g. when the entry was evicted after
+    the caller checked for it.
+    """
+    call = CacheCall(cacheable, cached_only)
+    token = _call.set(call)
+    try:
+        yield call
+    finally:
+        _call.reset(token)
+
+
+def _collapse(text: str) -> str:
+    return _WHITESPACE.sub(" ", text).strip()
+
+
+def normalize_prompt(prompt: str) -> str:
+    """
+    Canonical form of a prompt, so prompts that differ only in whitespace
+    (layout of the extracted PDF text) share an entry. Chat prompts arrive
+    as serialized messages; their contents are normalized one by one.
+    """
+    try:
+        messages = json.loads(prompt)
+    except ValueError:
+        return _collapse(prompt)
+    if not isinstance(messages, list):
+        return _collapse(prompt)
+
+    normalized = []
+    for message in messages:
+        kwargs = dict(message.get("kwargs", {})) if isinstance(message, dict) else {}
+        content = kwargs.pop("content", "")
+        normalized.append({
+            "type": (message.get("id") or [""])[-1] if isinstance(message, dict) else "",
+            "content": _collapse(content) if isinstance(content, str) else content,
+            "kwargs": kwargs
+        })
+    return json.dumps(normalized, sort_keys=True, default=str)
+
+
+def prompt_cache_key(prompt: str, llm_string: str) -> str:
+    """
+    Hash of the normalized prompt and the serialized model, which includes
+    the model name and sampling parameters such as temperature
+    """
+    return hashlib.sha256(f"{normalize_prompt(prompt)}\x1f{llm_string}".encode("utf-8")).hexdigest()
+
+
+def _prompt_text(prompt: str) -> str:
+    """Message contents of a serialized chat prompt, for token counting"""
+    try:
+        messages = json.loads(prompt)
+        return "\n".join(str(m.get("kwargs", {}).get("content", "")) for m in messages)
+    except (ValueError, AttributeError, TypeError):
+        return prompt
+
+
+class PromptCache(BaseCache):
+    """
+    SQLite-backed LangChain cache with least-recently-used eviction once it
+    holds more than max_entries responses.
+
+    Each entry remembers the token counts of the call that produced it. Hits
+    are marked in the first generation's generation_info (prompt_cache_hit,
+    cached_prompt_tokens, cached_completion_tokens) so TokenUsageTracker can
+    report them as tokens saved rather than spent.
+    """
+    def __init__(self, path: str = LLM_CACHE_PATH, max_entries: int = LLM_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max(1, max_entries)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache ("
+            " key TEXT PRIMARY KEY,"
+            " generations TEXT NOT NULL,"
+            " prompt_tokens INTEGER NOT NULL,"
+            " completion_tokens INTEGER NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " last_used_at REAL NOT NULL,"
+            " hits INTEGER NOT NULL DEFAULT 0)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS ix_llm_cache_last_used ON llm_cache (last_used_at)")
+        self._entries = self._conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+
+        self.hits = 0
+        self.misses = 0
+        self.bypasses = 0
+        self.evictions = 0
+        # Responses not stored because the caller could not use them (see cache_call)
+        self.rejected = 0
+        self.prompt_tokens_saved = 0
+        self.completion_tokens_saved = 0
+
+    def contains(self, prompt: str, llm_string: str) -> bool:
+        """Whether lookup would answer the prompt; counts nothing and leaves its LRU position alone"""
+        if _bypass.get():
+            return False
+        key = prompt_cache_key(prompt, llm_string)
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM llm_cache WHERE key = ?", (key,)).fetchone() is not None
+
+    def lookup(self, prompt: str, llm_string: str) -> Optional[List[Generation]]:
+        call = _call.get()
+        cached_only = call is not None and call.cached_only
+        if _bypass.get():
+            if cached_only:
+                raise CacheMiss(prompt_cache_key(prompt, llm_string))
+            with self._lock:
+                self.bypasses += 1
+            return None
+
+        key = prompt_cache_key(prompt, llm_string)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT generations, prompt_tokens, completion_tokens FROM llm_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                if cached_only:
+                    # The caller's own call counts the miss
+                    raise CacheMiss(key)
+                self.misses += 1
+                return None
+            self._conn.execute(
+                "UPDATE llm_cache SET last_used_at = ?, hits = hits + 1 WHERE key = ?", (time.time(), key)
+            )
+            generations_json, prompt_tokens, completion_tokens = row
+            if call is not None:
+                call.hit = True
+            self.hits += 1
+            self.prompt_tokens_saved += prompt_tokens
+            self.completion_tokens_saved += completion_tokens
+
+        generations = [
+            ChatGeneration(message=AIMessage(content=g["text"]), generation_info=g.get("generation_info"))
+            for g in json.loads(generations_json)
+        ]
+        if generations:
+            generations[0].generation_info = {
+                **(generations[0].generation_info or {}),
+                "prompt_cache_hit": True,
+                "cached_prompt_tokens": prompt_tokens,
+                "cached_completion_tokens": completion_tokens
+            }
+        return generations
+
+    def update(self, prompt: str, llm_string: str, return_val: Sequence[Generation]) -> None:
+        call = _call.get()
+        if call is not None and call.cacheable is not None and not all(call.cacheable(g.text) for g in return_val):
+            with self._lock:
+                self.rejected += 1
+            return
+        key = prompt_cache_key(prompt, llm_string)
+        generations = [{"text": g.text, "generation_info": g.generation_info} for g in return_val]
+        prompt_tokens = count_tokens(_prompt_text(prompt))
+        completion_tokens = sum(count_tokens(g.text) for g in return_val)
+        now = time.time()
+        with self._lock:
+            inserted = self._conn.execute(
+                "INSERT OR IGNORE INTO llm_cache"
+                " (key, generations, prompt_tokens, completion_tokens, created_at, last_used_at)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (key, json.dumps(generations), prompt_tokens, completion_tokens, now, now)
+            ).rowcount
+            self._entries += inserted
+            if self._entries > self.max_entries:
+                self._evict()
+
+    def _evict(self):
+        """Drop least recently used entries down to 95% of max_entries, so eviction is not paid on every insert"""
+        target = self.max_entries - self.max_entries // 20
+        # Other processes may share the file; recount before deciding how many to drop
+        self._entries = self._conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+        excess = self._entries - target
+        if excess <= 0:
+            return
+        deleted = self._conn.execute(
+            "DELETE FROM llm_cache WHERE key IN"
+            " (SELECT key FROM llm_cache ORDER BY last_used_at LIMIT ?)",
+            (excess,)
+        ).rowcount
+        self._entries -= deleted
+        self.evictions += deleted
+
+    def clear(self, **kwargs: Any) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM llm_cache")
+            self._entries = 0
+
+    def stats(self) -> Dict[str, Any]:
+        """Process-wide counters"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'bypasses': self.bypasses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0,
+                'evictions': self.evictions,
+                'rejected': self.rejected,
+                'entries': self._entries,
+                'max_entries': self.max_entries,
+                'prompt_tokens_saved': self.prompt_tokens_saved,
+                'completion_tokens_saved': self.completion_tokens_saved
+            }
+
+
+prompt_cache = PromptCache() if LLM_CACHE_ENABLED else None
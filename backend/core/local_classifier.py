@@ -0,0 +1,274 @@
+"""
+Local Document-type Classifier
+A linear (softmax regression) model over hashed word and bigram tf-idf
+features, trained on the document types the LLM classifier assigned to stored
+analyses. It runs on the CPU in well under a millisecond, so the classifier
+node asks it first and only calls the LLM when it is not confident.
+
+Retrain from the database with:
+    python -m core.local_classifier train
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from core.retrieval import hashed_term_weights
+from core.db import init_db, iter_classifier_training_rows
+
+LOCAL_CLASSIFIER_ENABLED = os.getenv("LOCAL_CLASSIFIER_ENABLED", "1") == "1"
+LOCAL_CLASSIFIER_PATH = os.getenv("LOCAL_CLASSIFIER_PATH", "./document_classifier.npz")
+# Predicted probability from which the local answer is used instead of asking the LLM
+LOCAL_CLASSIFIER_MIN_CONFIDENCE = float(os.getenv("LOCAL_CLASSIFIER_MIN_CONFIDENCE", "0.9"))
+LOCAL_CLASSIFIER_DIMENSIONS = int(os.getenv("LOCAL_CLASSIFIER_DIMENSIONS", str(2 ** 15)))
+# Fewer labelled documents than this are not worth a model
+LOCAL_CLASSIFIER_MIN_SAMPLES = int(os.getenv("LOCAL_CLASSIFIER_MIN_SAMPLES", "50"))
+
+HOLDOUT_FRACTION = 0.2
+_BATCH = 256
+
+
+def training_text(classifier_sample: Optional[str], summary: Optional[str], key_sections: Optional[Dict[str, Any]]) -> str:
+    """
+    Text a stored analysis is trained on: the classifier sample, or for rows
+    stored before samples were kept, the summary and extracted sections
+    """
+    if classifier_sample:
+        return classifier_sample
+    parts = [summary or ""]
+    for name, content in (key_sections or {}).items():
+        parts.append(f"{name}: {content if isinstance(content, str) else json.dumps(content)}")
+    return "\n".join(parts)
+
+
+def _sparse_batch(rows: List[Tuple[np.ndarray, np.ndarray]]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Concatenated (row position, feature index, weight) of a batch of sparse rows"""
+    positions = np.concatenate([np.full(len(indices), i) for i, (indices, _) in enumerate(rows)])
+    indices = np.concatenate([indices for indices, _ in rows])
+    weights = np.concatenate([weights for _, weights in rows])
+    return positions, indices, weights
+
+
+def _softmax(logits: np.ndarray) -> np.ndarray:
+    logits = logits - logits.max(axis=-1, keepdims=True)
+    exp = np.exp(logits)
+    return exp / exp.sum(axis=-1, keepdims=True)
+
+
+class LocalClassifier:
+    """Softmax regression weights (dimensions x labels), bias, idf weights and the labels"""
+    def __init__(self, weights: np.ndarray, bias: np.ndarray, idf: np.ndarray, labels: List[str], metadata: Optional[Dict[str, Any]] = None):
+        self.weights = weights
+        self.bias = bias
+        self.idf = idf
+        self.labels = list(labels)
+        self.metadata = metadata or {}
+
+    def _features(self, text: str) -> Tuple[np.ndarray, np.ndarray]:
+        """Sparse unit-length tf-idf vector of text"""
+        indices, weights = hashed_term_weights(text, len(self.idf))
+        weights = weights * self.idf[indices]
+        norm = np.linalg.norm(weights)
+        return indices, (weights / norm if norm else weights)
+
+    def predict_proba(self, text: str) -> np.ndarray:
+        indices, weights = self._features(text)
+        return _softmax(weights @ self.weights[indices] + self.bias)
+
+    def predict(self, text: str) -> Tuple[str, float]:
+        """(document type, probability)"""
+        probabilities = self.predict_proba(text)
+        best = int(np.argmax(probabilities))
+        return self.labels[best], float(probabilities[best])
+
+    @classmethod
+    def train(
+        cls,
+        texts: List[str],
+        labels: List[str],
+        dimensions: int = LOCAL_CLASSIFIER_DIMENSIONS,
+        epochs: int = 100,
+        learning_rate: float = 10.0,
+        l2: float = 1e-4,
+        seed: int = 0
+    ) -> "LocalClassifier":
+        """
+        Fit on labelled texts with mini-batch gradient descent. Classes are
+        weighted inversely to their frequency, so a few common types do not
+        drown out the rest. CPU-bound.
+        """
+        label_names = sorted(set(labels))
+        targets = np.array([label_names.index(label) for label in labels])
+        sparse = [hashed_term_weights(text, dimensions) for text in texts]
+
+        document_frequency = np.zeros(dimensions, dtype=np.float32)
+        for indices, _ in sparse:
+            document_frequency[indices] += 1
+        idf = (np.log((1 + len(texts)) / (1 + document_frequency)) + 1).astype(np.float32)
+        rows = []
+        for indices, weights in sparse:
+            weights = weights * idf[indices]
+            norm = np.linalg.norm(weights)
+            rows.append((indices, weights / norm if norm else weights))
+
+        counts = np.bincount(targets, minlength=len(label_names))
+        class_weights = (len(targets) / (len(label_names) * np.maximum(counts, 1))).astype(np.float32)
+        weights = np.zeros((dimensions, len(label_names)), dtype=np.float32)
+        bias = np.zeros(len(label_names), dtype=np.float32)
+        rng = np.random.default_rng(seed)
+        for _ in range(epochs):
+            order = rng.permutation(len(rows))
+            for start in range(0, len(order), _BATCH):
+                batch = order[start:start + _BATCH]
+                positions, indices, values = _sparse_batch([rows[i] for i in batch])
+                y = targets[batch]
+                # Sparse forward and backward pass, one bincount per label
+                contributions = values[:, None] * weights[indices]
+                logits = np.stack([
+                    np.bincount(positions, weights=contributions[:, k], minlength=len(batch))
+                    for k in range(len(label_names))
+                ], axis=1) + bias
+                error = _softmax(logits)
+                error[np.arange(len(batch)), y] -= 1
+                error *= class_weights[y][:, None] / len(batch)
+                gradient = np.stack([
+                    np.bincount(indices, weights=values * error[positions, k], minlength=dimensions)
+                    for k in range(len(label_names))
+                ], axis=1)
+                weights -= (learning_rate * (gradient + l2 * weights)).astype(np.float32)
+                bias -= (learning_rate * error.sum(axis=0)).astype(np.float32)
+
+        return cls(weights, bias, idf, label_names, {
+            "trained_at": datetime.utcnow().isoformat(),
+            "samples": len(texts),
+            "samples_per_label": dict(zip(label_names, counts.tolist())),
+            "dimensions": dimensions
+        })
+
+    def save(self, path: str = LOCAL_CLASSIFIER_PATH):
+        """Write the model, replacing any earlier one atomically"""
+        staging = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez(
+            staging,
+            weights=self.weights.astype(np.float16),
+            bias=self.bias,
+            idf=self.idf,
+            labels=np.array(self.labels),
+            metadata=np.array(json.dumps(self.metadata))
+        )
+        os.replace(staging, path)
+
+    @classmethod
+    def load(cls, path: str = LOCAL_CLASSIFIER_PATH) -> Optional["LocalClassifier"]:
+        if not os.path.exists(path):
+            return None
+        with np.load(path, allow_pickle=False) as stored:
+            return cls(
+                stored["weights"].astype(np.float32),
+                stored["bias"],
+                stored["idf"],
+                stored["labels"].tolist(),
+                json.loads(str(stored["metadata"]))
+            )
+
+
+def evaluate(classifier: LocalClassifier, texts: List[str], labels: List[str], min_confidence: float = LOCAL_CLASSIFIER_MIN_CONFIDENCE) -> Dict[str, Any]:
+    """
+    Accuracy overall, and coverage (the share of documents the local tier
+    would answer) with accuracy at the confidence threshold
+    """
+    predictions = [classifier.predict(text) for text in texts]
+    correct = np.array([label == predicted for label, (predicted, _) in zip(labels, predictions)])
+    confident = np.array([confidence >= min_confidence for _, confidence in predictions])
+    return {
+        "samples": len(texts),
+        "accuracy": round(float(correct.mean()), 4) if len(texts) else None,
+        "min_confidence": min_confidence,
+        "coverage": round(float(confident.mean()), 4) if len(texts) else None,
+        "accuracy_when_confident": round(float(correct[confident].mean()), 4) if confident.any() else None
+    }
+
+
+def train_from_database(path: str = LOCAL_CLASSIFIER_PATH, min_samples: int = LOCAL_CLASSIFIER_MIN_SAMPLES) -> Dict[str, Any]:
+    """
+    Train on the stored analyses, evaluate on a held-out share of them, then
+    refit on all of them and save. Blocking.
+
+    Raises:
+        ValueError: with fewer than min_samples labelled documents or a single type
+    """
+    texts, labels = [], []
+    for document_type, classifier_sample, summary, key_sections in iter_classifier_training_rows():
+        text = training_text(classifier_sample, summary, key_sections)
+        if text.strip():
+            texts.append(text)
+            labels.append(document_type)
+    if len(texts) < min_samples:
+        raise ValueError(f"Only {len(texts)} labelled documents stored, need at least {min_samples}")
+    if len(set(labels)) < 2:
+        raise ValueError("All stored documents have the same type; nothing to learn")
+
+    start = time.perf_counter()
+    order = np.random.default_rng(0).permutation(len(texts))
+    holdout = set(order[:int(len(texts) * HOLDOUT_FRACTION)].tolist())
+    train_idx = [i for i in range(len(texts)) if i not in holdout]
+    held_out = sorted(holdout)
+    trial = LocalClassifier.train([texts[i] for i in train_idx], [labels[i] for i in train_idx])
+    holdout_report = evaluate(trial, [texts[i] for i in held_out], [labels[i] for i in held_out])
+
+    classifier = LocalClassifier.train(texts, labels)
+    classifier.metadata["holdout"] = holdout_report
+    classifier.metadata["training_seconds"] = round(time.perf_counter() - start, 2)
+    classifier.save(path)
+    return {"path": path, **classifier.metadata}
+
+
+_loaded: Optional[Tuple[float, LocalClassifier]] = None
+_load_lock = threading.Lock()
+
+
+def get_local_classifier() -> Optional[LocalClassifier]:
+    """
+    The trained model, or None when disabled or not trained yet. Reloaded when
+    the file changes, so a retrain takes effect without a restart.
+    """
+    global _loaded
+    if not LOCAL_CLASSIFIER_ENABLED:
+        return None
+    try:
+        mtime = os.path.getmtime(LOCAL_CLASSIFIER_PATH)
+    except OSError:
+        return None
+    if _loaded is not None and _loaded[0] == mtime:
+        return _loaded[1]
+    with _load_lock:
+        if _loaded is None or _loaded[0] != mtime:
+            try:
+                _loaded = (mtime, LocalClassifier.load(LOCAL_CLASSIFIER_PATH))
+            except (OSError, ValueError, KeyError) as e:
+                print(f"Warning: could not load local classifier {LOCAL_CLASSIFIER_PATH}: {e}")
+                return None
+        return _loaded[1]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local document-type classifier")
+    commands = parser.add_subparsers(dest="command", required=True)
+    train_parser = commands.add_parser("train", help="Retrain from the stored analyses")
+    train_parser.add_argument("--path", default=LOCAL_CLASSIFIER_PATH)
+    train_parser.add_argument("--min-samples", type=int, default=LOCAL_CLASSIFIER_MIN_SAMPLES)
+    args = parser.parse_args()
+
+    init_db()
+    try:
+        report = train_from_database(args.path, args.min_samples)
+    except ValueError as e:
+        print(f"Not trained: {e}")
+        sys.exit(1)
+    print(json.dumps(report, indent=2))
@@ -0,0 +1,336 @@
+"""
+Map-Reduce Execution for Large Documents
+Runs a chain over document windows with bounded concurrency, then reduces the
+partial results hierarchically until a single result remains.
+"""
+import os
+import time
+import hashlib
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from core.state import Chunk
+from core.chunking import chunk_hash, is_boundary
+
+# "auto": map-reduce only when the text exceeds an agent's single-pass limit
+# "always": always map-reduce, "off": always single pass (packed to the limit)
+MAP_REDUCE_MODE = os.getenv("MAP_REDUCE_MODE", "auto")
+MAP_REDUCE_MAX_CONCURRENCY = int(os.getenv("MAP_REDUCE_MAX_CONCURRENCY", "4"))
+MAP_REDUCE_WINDOW_TOKENS = int(os.getenv("MAP_REDUCE_WINDOW_TOKENS", "2000"))
+# Document tokens one agent map-reduces at most when token budgets (core.budget) are off
+MAP_REDUCE_TOKEN_BUDGET = int(os.getenv("MAP_REDUCE_TOKEN_BUDGET", "60000"))
+MAP_REDUCE_FAN_IN = int(os.getenv("MAP_REDUCE_FAN_IN", "4"))
+# Share of failed map calls above which a job fails; below it the result is
+# reduced from the windows that succeeded and the agent counts as degraded
+MAP_REDUCE_MAX_FAILED_FRACTION = float(os.getenv("MAP_REDUCE_MAX_FAILED_FRACTION", "0.25"))
+# Past half of MAP_REDUCE_WINDOW_TOKENS, a window also ends after a chunk whose
+# hash is divisible by this, so window boundaries (and the stored map outputs
+# keyed by window content) survive edits elsewhere in the document
+MAP_REDUCE_WINDOW_BOUNDARY_MODULUS = int(os.getenv("MAP_REDUCE_WINDOW_BOUNDARY_MODULUS", "2"))
+
+
+def document_tokens(chunks: List[Chunk]) -> int:
+    """Approximate token count of a chunked document (chunk overlap is counted twice)"""
+    return sum(chunk["tokens"] for chunk in chunks)
+
+
+def use_map_reduce(chunks: List[Chunk], single_pass_tokens: int) -> bool:
+    """Decide whether a document should go through map-reduce instead of a single truncated call"""
+    if MAP_REDUCE_MODE == "always":
+        return True
+    if MAP_REDUCE_MODE == "off":
+        return False
+    return document_tokens(chunks) > single_pass_tokens
+
+
+def build_windows(
+    chunks: List[Chunk],
+    window_tokens: int = MAP_REDUCE_WINDOW_TOKENS,
+    boundary_modulus: int = MAP_REDUCE_WINDOW_BOUNDARY_MODULUS
+) -> List[Chunk]:
+    """Group consecutive chunks into map windows of at most window_tokens each, ending at content-defined boundaries"""
+    windows: List[Chunk] = []
+    current: List[Chunk] = []
+    current_tokens = 0
+
+    def close():
+        windows.append({
+            "text": "\n".join(c["text"] for c in current),
+            "tokens": current_tokens,
+            "page_start": current[0]["page_start"],
+            "page_end": current[-1]["page_end"]
+        })
+
+    for chunk in chunks:
+        if current and current_tokens + chunk["tokens"] > window_tokens:
+            close()
+            current, current_tokens = [], 0
+        current.append(chunk)
+        current_tokens += chunk["tokens"]
+        if current_tokens >= window_tokens // 2 and is_boundary(chunk["text"], boundary_modulus):
+            close()
+            current, current_tokens = [], 0
+    if current:
+        close()
+    return windows
+
+
+def window_key(window: Chunk) -> str:
+    """Key of a window's map output: the hash of its content"""
+    return chunk_hash(window)
+
+
+def reduce_key(input_keys: List[str]) -> str:
+    """Key of a reduce output: the hash of its inputs' keys"""
+    return "r" + hashlib.sha1("".join(input_keys).encode("utf-8")).hexdigest()[:16]
+
+
+def group_partials(partials: List[Tuple[str, Any]], fan_in: int = MAP_REDUCE_FAN_IN) -> List[List[Tuple[str, Any]]]:
+    """
+    Consecutive groups of up to fan_in (key, partial result) pairs for one
+    reduce level. A group also ends after a partial whose key is a boundary,
+    so an edit regroups only nearby partials and the reduce outputs above
+    unchanged groups keep their keys.
+    """
+    fan_in = max(2, fan_in)
+    groups, current = [], []
+    for partial in partials:
+        current.append(partial)
+        if len(current) == fan_in or (len(current) > 1 and int(partial[0][-8:], 16) % fan_in == 0):
+            groups.append(current)
+            current = []
+    if current:
+        groups.append(current)
+    return groups
+
+
+def partial_keys(windows: List[Chunk], fan_in: int = MAP_REDUCE_FAN_IN) -> set:
+    """Keys of all partial results a MapReduceJob over these windows produces when every call succeeds"""
+    level = [(window_key(window), None) for window in windows]
+    keys = {key for key, _ in level}
+    while len(level) > 1:
+        level = [
+            group[0] if len(group) == 1 else (reduce_key([k for k, _ in group]), None)
+            for group in group_partials(level, fan_in)
+        ]
+        keys.update(key for key, _ in level)
+    return keys
+
+
+class MapReduceJob:
+    """
+    One map-reduce run for an agent.
+
+    Args:
+        agent_name: Agent the per-window timings are recorded under
+        map_chain / reduce_chain: LangChain runnables for the two phases
+        map_inputs: window text -> map_chain input dict
+        reduce_inputs: list of partial results -> reduce_chain input dict
+        parse: chain output -> partial result
+        fallback_reduce: combines partial results locally if a reduce call fails
+        agent_tracker: optional AgentExecutionTracker for per-step timings
+        final_reduce_chain: used instead of reduce_chain for the last reduce
+            call, whose output is the job's result (e.g. a streaming variant)
+        reuse: outputs of an earlier run (see outputs); windows and reduce
+            groups found there are not sent to the model again
+        max_failed_fraction: share of failed map calls above which the job
+            fails instead of reducing the windows that succeeded
+
+    After a run, outputs holds the job's partial results by content key (map
+    outputs by window_key, reduce outputs by the keys of their inputs), reused
+    ones included, to be stored for an incremental re-run.
+    """
+    def __init__(
+        self,
+        agent_name: str,
+        map_chain,
+        map_inputs: Callable[[str], Dict[str, Any]],
+        reduce_chain,
+        reduce_inputs: Callable[[List[Any]], Dict[str, Any]],
+        parse: Callable[[Any], Any],
+        fallback_reduce: Callable[[List[Any]], Any],
+        agent_tracker=None,
+        max_concurrency: int = MAP_REDUCE_MAX_CONCURRENCY,
+        fan_in: int = MAP_REDUCE_FAN_IN,
+        final_reduce_chain=None,
+        reuse: Optional[Dict[str, Any]] = None,
+        max_failed_fraction: float = MAP_REDUCE_MAX_FAILED_FRACTION
+    ):
+        self.agent_name = agent_name
+        self.map_chain = map_chain
+        self.map_inputs = map_inputs
+        self.reduce_chain = reduce_chain
+        self.reduce_inputs = reduce_inputs
+        self.parse = parse
+        self.fallback_reduce = fallback_reduce
+        self.agent_tracker = agent_tracker
+        self.max_concurrency = max(1, max_concurrency)
+        self.fan_in = max(2, fan_in)
+        self.final_reduce_chain = final_reduce_chain or reduce_chain
+        self.reuse = reuse or {}
+        self.max_failed_fraction = max_failed_fraction
+        self.outputs: Dict[str, Any] = {}
+
+    def _record(self, step: str, start: float, error: Optional[Exception] = None, **info):
+        if self.agent_tracker:
+            self.agent_tracker.record_step(
+                self.agent_name,
+                step,
+                time.time() - start,
+                success=error is None,
+                error=str(error) if error else None,
+                **info
+            )
+
+    @staticmethod
+    def _window_info(window: Chunk) -> Dict[str, Any]:
+        return {
+            "input_tokens": window["tokens"],
+            "pages": f"{window['page_start']}-{window['page_end']}"
+        }
+
+    def _map_error(self, failed: int, total: int) -> Optional[Exception]:
+        """Error failing the job when too many of its map calls failed, else None"""
+        if failed == total:
+            return RuntimeError("All map calls failed")
+        if failed > total * self.max_failed_fraction:
+            return RuntimeError(f"{failed} of {total} map calls failed")
+        return None
+
+    def _reused(self, index: int, window: Chunk) -> Tuple[str, Optional[Any]]:
+        """(window key, earlier map output or None)"""
+        key = window_key(window)
+        result = self.reuse.get(key)
+        if result is not None:
+            self._record(f"map[{index}]", time.time(), reused=True, **self._window_info(window))
+            self.outputs[key] = result
+        return key, result
+
+    def _reduce_key(self, level: int, index: int, group: List[Tuple[str, Any]]) -> Tuple[str, Optional[Any]]:
+        """(key of a group's reduce output, earlier output or None)"""
+        key = reduce_key([k for k, _ in group])
+        result = self.reuse.get(key)
+        if result is not None:
+            self._record(f"reduce[{level}.{index}]", time.time(), reused=True)
+            self.outputs[key] = result
+        return key, result
+
+    # --- sync ---
+
+    def _map_one(self, index: int, window: Chunk):
+        key, result = self._reused(index, window)
+        if result is not None:
+            return key, result
+        start = time.time()
+        try:
+            result = self.parse(self.map_chain.invoke(self.map_inputs(window["text"])))
+            self._record(f"map[{index}]", start, **self._window_info(window))
+            self.outputs[key] = result
+            return key, result
+        except Exception as e:
+            self._record(f"map[{index}]", start, e, **self._window_info(window))
+            return None
+
+    def _reduce_chain(self, final: bool):
+        return self.final_reduce_chain if final else self.reduce_chain
+
+    def _reduce_one(self, level: int, index: int, group: List[Tuple[str, Any]], final: bool = False):
+        if len(group) == 1:
+            return group[0]
+        key, result = self._reduce_key(level, index, group)
+        if result is not None:
+            return key, result
+        parts = [part for _, part in group]
+        inputs = self.reduce_inputs(parts)
+        start = time.time()
+        try:
+            result = self.parse(self._reduce_chain(final).invoke(inputs))
+            self._record(f"reduce[{level}.{index}]", start, input_chars=len(str(inputs)))
+            self.outputs[key] = result
+            return key, result
+        except Exception as e:
+            self._record(f"reduce[{level}.{index}]", start, e, input_chars=len(str(inputs)))
+            return key, self.fallback_reduce(parts)
+
+    def run(self, windows: List[Chunk]):
+        """Run map then hierarchical reduce, returning (result, error, number of failed map calls)"""
+        if not windows:
+            return None, RuntimeError("No windows within the token budget"), 0
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            partials = list(executor.map(self._map_one, range(len(windows)), windows))
+            partials = [p for p in partials if p is not None]
+            failed = len(windows) - len(partials)
+            error = self._map_error(failed, len(windows))
+            if error is not None:
+                return None, error, failed
+
+            level = 0
+            while len(partials) > 1:
+                groups = group_partials(partials, self.fan_in)
+                partials = list(executor.map(
+                    self._reduce_one, [level] * len(groups), range(len(groups)), groups,
+                    [len(groups) == 1] * len(groups)
+                ))
+                level += 1
+        return partials[0][1], None, failed
+
+    # --- async ---
+
+    async def _amap_one(self, semaphore: asyncio.Semaphore, index: int, window: Chunk):
+        key, result = self._reused(index, window)
+        if result is not None:
+            return key, result
+        async with semaphore:
+            start = time.time()
+            try:
+                result = self.parse(await self.map_chain.ainvoke(self.map_inputs(window["text"])))
+                self._record(f"map[{index}]", start, **self._window_info(window))
+                self.outputs[key] = result
+                return key, result
+            except Exception as e:
+                self._record(f"map[{index}]", start, e, **self._window_info(window))
+                return None
+
+    async def _areduce_one(self, semaphore: asyncio.Semaphore, level: int, index: int, group: List[Tuple[str, Any]], final: bool = False):
+        if len(group) == 1:
+            return group[0]
+        key, result = self._reduce_key(level, index, group)
+        if result is not None:
+            return key, result
+        parts = [part for _, part in group]
+        inputs = self.reduce_inputs(parts)
+        async with semaphore:
+            start = time.time()
+            try:
+                result = self.parse(await self._reduce_chain(final).ainvoke(inputs))
+                self._record(f"reduce[{level}.{index}]", start, input_chars=len(str(inputs)))
+                self.outputs[key] = result
+                return key, result
+            except Exception as e:
+                self._record(f"reduce[{level}.{index}]", start, e, input_chars=len(str(inputs)))
+                return key, self.fallback_reduce(parts)
+
+    async def arun(self, windows: List[Chunk]):
+        """Async map then hierarchical reduce, returning (result, error, number of failed map calls)"""
+        if not windows:
+            return None, RuntimeError("No windows within the token budget"), 0
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        partials = await asyncio.gather(*[
+            self._amap_one(semaphore, i, w) for i, w in enumerate(windows)
+        ])
+        partials = [p for p in partials if p is not None]
+        failed = len(windows) - len(partials)
+        error = self._map_error(failed, len(windows))
+        if error is not None:
+            return None, error, failed
+
+        level = 0
+        while len(partials) > 1:
+            groups = group_partials(partials, self.fan_in)
+            partials = await asyncio.gather(*[
+                self._areduce_one(semaphore, level, i, group, final=len(groups) == 1)
+                for i, group in enumerate(groups)
+            ])
+            level += 1
+        return partials[0][1], None, failed
@@ -0,0 +1,178 @@
+"""
+OCR Fallback for Scanned Pages
+Pages whose extracted text is below a density threshold are rasterized and
+run through Tesseract in a bounded process pool. Results are cached on disk
+by page-content hash and OCR settings, so repeat uploads of the same scan
+skip OCR.
+"""
+import os
+import io
+import shutil
+import hashlib
+import threading
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor, Future
+from typing import Optional, Union
+
+import pytesseract
+from pypdf import PdfWriter
+
+# Ensure Tesseract is in PATH or configure it here if needed
+# pytesseract.pytesseract.tesseract_cmd = r'C:\Program Files\Tesseract-OCR\tesseract.exe'
+
+OCR_ENABLED = os.getenv("OCR_ENABLED", "1") == "1"
+# Pages with fewer extracted characters than this are considered scanned
+OCR_MIN_CHARS_PER_PAGE = int(os.getenv("OCR_MIN_CHARS_PER_PAGE", "25"))
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", "2"))
+OCR_DPI = int(os.getenv("OCR_DPI", "200"))
+OCR_LANG = os.getenv("OCR_LANG", "eng")
+# Extra Tesseract options, e.g. "--psm 6"
+OCR_CONFIG = os.getenv("OCR_CONFIG", "")
+OCR_CACHE_DIR = os.getenv("OCR_CACHE_DIR", "./ocr_cache")
+
+
+@lru_cache(maxsize=1)
+def ocr_available() -> bool:
+    """Check once for pdf2image, poppler and the tesseract binary"""
+    try:
+        import pdf2image  # noqa: F401
+        pytesseract.get_tesseract_version()
+    except Exception as e:
+        print(f"Warning: OCR disabled, Tesseract/pdf2image not available ({e}).")
+        return False
+    if not shutil.which("pdftoppm"):
+        print("Warning: OCR disabled, poppler (pdftoppm) not found in PATH.")
+        return False
+    return True
+
+
+def needs_ocr(page_text: str) -> bool:
+    """True when a page's extracted text is too sparse to be the real content"""
+    return (
+        OCR_ENABLED
+        and len(page_text.strip()) < OCR_MIN_CHARS_PER_PAGE
+        and ocr_available()
+    )
+
+
+def page_content_hash(page) -> str:
+    """
+    Hash of what is drawn on a page: its content stream plus the data of every
+    XObject (scanned images) it references. Identical scans hash identically
+    regardless of which file or position they appear in.
+    """
+    digest = hashlib.sha256()
+    contents = page.get_contents()
+    if contents is not None:
+        digest.update(contents.get_data())
+    resources = page.get("/Resources")
+    xobjects = resources.get_object().get("/XObject") if resources else None
+    if xobjects:
+        xobjects = xobjects.get_object()
+        for name in sorted(xobjects):
+            digest.update(name.encode("utf-8"))
+            digest.update(xobjects[name].get_object().get_data())
+    return digest.hexdigest()
+
+
+@lru_cache(maxsize=1)
+def _tesseract_version() -> str:
+    try:
+        return str(pytesseract.get_tesseract_version())
+    except Exception:
+        return "unknown"
+
+
+def ocr_cache_key(page, dpi: int = OCR_DPI, lang: str = OCR_LANG, config: str = OCR_CONFIG) -> str:
+    """
+    Cache key of a page's OCR text: its content hash and everything that
+    changes what Tesseract reads from it (resolution, languages, options
+    and Tesseract's version)
+    """
+    settings = f"{dpi}\x1f{lang}\x1f{config}\x1f{_tesseract_version()}"
+    return hashlib.sha256(f"{page_content_hash(page)}\x1f{settings}".encode("utf-8")).hexdigest()
+
+
+def single_page_pdf(page) -> bytes:
+    """Serialize one page as a standalone PDF, for rasterizing in a worker"""
+    writer = PdfWriter()
+    writer.add_page(page)
+    buffer = io.BytesIO()
+    writer.write(buffer)
+    return buffer.getvalue()
+
+
+def ocr_page_pdf(pdf_bytes: bytes, dpi: int = OCR_DPI, lang: str = OCR_LANG, config: str = OCR_CONFIG) -> str:
+    """Rasterize a single-page PDF and OCR it. Runs in a worker process."""
+    from pdf2image import convert_from_bytes
+
+    images = convert_from_bytes(pdf_bytes, dpi=dpi)
+    return "\n".join(pytesseract.image_to_string(image, lang=lang, config=config) for image in images)
+
+
+class OcrCache:
+    """Disk cache of OCR text keyed by ocr_cache_key"""
+    def __init__(self, cache_dir: str = OCR_CACHE_DIR):
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.txt")
+
+    def get(self, key: str) -> Optional[str]:
+        try:
+            with open(self._path(key), "r", encoding="utf-8") as f:
+                text = f.read()
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return text
+
+    def put(self, key: str, text: str):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write-then-rename so concurrent readers never see a partial file
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+
+
+ocr_cache = OcrCache()
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    """Bounded pool for rasterization + Tesseract, created on first use"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=OCR_WORKERS)
+        return _pool
+
+
+def submit_page_ocr(page) -> Union[str, Future]:
+    """
+    Start OCR for a page. Returns the cached text immediately on a cache hit,
+    otherwise a Future whose result is the OCR text (and which fills the cache).
+    """
+    key = ocr_cache_key(page)
+    cached = ocr_cache.get(key)
+    if cached is not None:
+        return cached
+
+    future = _get_pool().submit(ocr_page_pdf, single_page_pdf(page), OCR_DPI, OCR_LANG, OCR_CONFIG)
+
+    def store(done: Future):
+        if not done.cancelled() and done.exception() is None:
+            ocr_cache.put(key, done.result())
+
+    future.add_done_callback(store)
+    return future
@@ -1,57 +1,177 @@
-import pytesseract
 from pypdf import PdfReader
+from pypdf.errors import PdfReadError
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, Future
+from typing import Optional, Union, BinaryIO, Iterator, AsyncIterator, Tuple
+from core.ocr import needs_ocr, submit_page_ocr, OCR_WORKERS
+import asyncio
 import io
+import os
+import threading
 
-# Ensure Tesseract is in PATH or configure it here if needed
-# pytesseract.pytesseract.tesseract_cmd = r'C:\Program Files\Tesseract-OCR\tesseract.exe'
+# Documents with at least this many pages are extracted in a process pool
+PDF_PARALLEL_MIN_PAGES = int(os.getenv("PDF_PARALLEL_MIN_PAGES", "64"))
+PDF_EXTRACT_WORKERS = int(os.getenv("PDF_EXTRACT_WORKERS", str(os.cpu_count() or 1)))
+# Pages buffered between the parsing thread and async consumers
+PDF_PAGE_QUEUE_SIZE = int(os.getenv("PDF_PAGE_QUEUE_SIZE", "16"))
+# Pages that may be held back waiting for OCR before the stream blocks
+OCR_LOOKAHEAD = int(os.getenv("OCR_LOOKAHEAD", str(OCR_WORKERS * 2)))
 
-def extract_text_from_pdf(file_content: bytes) -> str:
+# A PDF given as a file path, raw bytes, or a seekable binary file object
+PdfSource = Union[str, bytes, BinaryIO]
+
+# pypdf reports some malformed files with whatever error the code that trips
+# over them raises; these are re-raised as PdfReadError
+_MALFORMED_PDF_ERRORS = (AttributeError, AssertionError, IndexError, KeyError, TypeError, ValueError)
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+def _get_pool() -> ProcessPoolExecutor:
+    """Process pool shared by all extractions, created on first use"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=PDF_EXTRACT_WORKERS)
+        return _pool
+
+def _open_reader(source: PdfSource) -> PdfReader:
+    if isinstance(source, bytes):
+        return PdfReader(io.BytesIO(source))
+    return PdfReader(source)
+
+def _extract_page_range(source: Union[str, bytes], start: int, end: int) -> list[str]:
+    """Extract text for pages [start, end). Runs in a worker process."""
+    reader = _open_reader(source)
+    return [reader.pages[i].extract_text() or "" for i in range(start, end)]
+
+def _resolve_ocr(page_number: int, text: str, ocr_result) -> Tuple[int, str]:
+    if isinstance(ocr_result, Future):
+        try:
+            ocr_result = ocr_result.result()
+        except Exception as e:
+            print(f"OCR failed for page {page_number}: {e}")
+            return page_number, text
+    # Keep whichever reading of the page has more content
+    return page_number, ocr_result if len(ocr_result.strip()) > len(text.strip()) else text
+
+def _with_ocr(reader: PdfReader, pages: Iterator[Tuple[int, str]]) -> Iterator[Tuple[int, str]]:
+    """
+    Replace sparse pages with their OCR text, preserving page order. OCR jobs
+    run in the background while later pages are extracted; at most
+    OCR_LOOKAHEAD pages are held back waiting on them.
+    """
+    pending = deque()
+    for page_number, text in pages:
+        ocr_result = text
+        if needs_ocr(text):
+            try:
+                ocr_result = submit_page_ocr(reader.pages[page_number - 1])
+            except Exception as e:
+                print(f"OCR failed for page {page_number}: {e}")
+        pending.append((page_number, text, ocr_result))
+
+        while pending and (
+            not isinstance(pending[0][2], Future)
+            or pending[0][2].done()
+            or len(pending) > OCR_LOOKAHEAD
+        ):
+            yield _resolve_ocr(*pending.popleft())
+    while pending:
+        yield _resolve_ocr(*pending.popleft())
+
+def iter_pdf_pages(source: PdfSource, parallel: Optional[bool] = None) -> Iterator[Tuple[int, str]]:
     """
-    Extracts text from a PDF file content.
-    First tries standard PDF text extraction.
-    If text is sparse or empty, falls back to OCR.
+    Yields (page_number, text) pairs in page order as pages are parsed, so
+    callers can start work on the first pages before the last one is read.
+    Passing a file path or file object keeps memory bounded: pypdf reads
+    objects from the file on demand.
+    
+    Large documents given as a path or bytes are split into page ranges and
+    parsed in a process pool; ranges are yielded in order as they complete.
+    Small documents (and open file objects, which cannot be shared with worker
+    processes) are parsed in-process. Pages with too little text are sent to
+    OCR (see core.ocr).
+    
+    Args:
+        parallel: Force (True) or disable (False) the process pool. Defaults to
+            using it for documents with at least PDF_PARALLEL_MIN_PAGES pages.
+
+    Raises:
+        pypdf.errors.PyPdfError: if the file is not a readable PDF, also when
+            parsing fails only after some pages were yielded
     """
-    text = ""
     try:
-        reader = PdfReader(io.BytesIO(file_content))
-        for page in reader.pages:
-            page_text = page.extract_text()
-            if page_text:
-                text += page_text + "\n"
-        
-        # Simple heuristic to check if OCR is needed
-        if len(text.strip()) < 50:
-            # Fallback to OCR (Naive implementation, strictly per user request for Tesseract)
-            # Note: Tesseract requires image input. We need to convert PDF pages to images first.
-            # This usually requires 'pdf2image' and 'poppler'. 
-            # To keep dependencies minimal and pure python where possible, we might just return what we have
-            # or log a warning if pdf2image isn't available. 
-            # For this MVP, we will stick to PyPDF. Real OCR implies heavier setup (pdf2image).
-            # If the user specifically insists on Tesseract execution for PDFs, we need pdf2image.
-            pass
-            
-            # UNCOMMENT BELOW IF POPPLER AND PDF2IMAGE ARE INSTALLED
-            # from pdf2image import convert_from_bytes
-            # images = convert_from_bytes(file_content)
-            # type_text = ""
-            # for img in images:
-            #     type_text += pytesseract.image_to_string(img)
-            # text = type_text if len(type_text) > len(text) else text
-            
-    except Exception as e:
-        print(f"Error extracting text: {e}")
-        return ""
-
-    return text
-
-def chunk_text(text: str, chunk_size: int = 1000, overlap: int = 100) -> list[str]:
-    """
-    Splits text into chunks of specified size with overlap.
-    """
-    chunks = []
-    start = 0
-    while start < len(text):
-        end = start + chunk_size
-        chunks.append(text[start:end])
-        start += (chunk_size - overlap)
-    return chunks
+        reader = _open_reader(source)
+        yield from _with_ocr(reader, _iter_page_texts(reader, source, parallel))
+    except _MALFORMED_PDF_ERRORS as e:
+        raise PdfReadError(f"Malformed PDF: {e}") from e
+
+def _iter_page_texts(reader: PdfReader, source: PdfSource, parallel: Optional[bool]) -> Iterator[Tuple[int, str]]:
+    """Text-layer extraction only, in page order"""
+    num_pages = len(reader.pages)
+    if parallel is None:
+        parallel = num_pages >= PDF_PARALLEL_MIN_PAGES and PDF_EXTRACT_WORKERS > 1
+    if not parallel or num_pages < 2 or not isinstance(source, (str, bytes)):
+        for page_number, page in enumerate(reader.pages, start=1):
+            yield page_number, page.extract_text() or ""
+        return
+
+    # A few ranges per worker keeps the pool busy when pages vary in cost
+    num_ranges = min(num_pages, PDF_EXTRACT_WORKERS * 4)
+    bounds = [num_pages * i // num_ranges for i in range(num_ranges + 1)]
+    pool = _get_pool()
+    futures = [
+        pool.submit(_extract_page_range, source, bounds[i], bounds[i + 1])
+        for i in range(num_ranges)
+    ]
+    page_number = 0
+    for future in futures:
+        for text in future.result():
+            page_number += 1
+            yield page_number, text
+
+async def aiter_pdf_pages(source: PdfSource, parallel: Optional[bool] = None) -> AsyncIterator[Tuple[int, str]]:
+    """
+    Async version of iter_pdf_pages. Parsing runs in a background thread and
+    pages are handed over through a bounded queue, so a slow consumer applies
+    backpressure instead of buffering the whole document.
+    """
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue(maxsize=PDF_PAGE_QUEUE_SIZE)
+    done = object()
+    cancelled = threading.Event()
+
+    def produce():
+        try:
+            for item in iter_pdf_pages(source, parallel=parallel):
+                if cancelled.is_set():
+                    return
+                asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+            asyncio.run_coroutine_threadsafe(queue.put(done), loop).result()
+        except Exception as e:
+            asyncio.run_coroutine_threadsafe(queue.put(e), loop).result()
+
+    producer = loop.run_in_executor(None, produce)
+    try:
+        while True:
+            item = await queue.get()
+            if item is done:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        cancelled.set()
+        # Unblock the producer if it is waiting on a full queue
+        while not queue.empty():
+            queue.get_nowait()
+        await producer
+
+def extract_page_texts(file_content: bytes, parallel: Optional[bool] = None) -> list[str]:
+    """
+    Extracts the text of every page, in page order.
+    Large documents are split into page ranges and parsed in a process pool;
+    small ones stay in-process where the pool overhead would dominate.
+    """
+    return [text for _, text in iter_pdf_pages(file_content, parallel=parallel)]
@@ -0,0 +1,444 @@
+"""
+Document Analysis Pipeline
+Cache lookup, ingestion, the agent graph and persistence for one document.
+Shared by the single-file endpoint and the batch workers.
+"""
+import os
+import uuid
+import asyncio
+import tempfile
+from typing import Any, BinaryIO, Callable, Dict, Optional, Tuple
+
+from fastapi.concurrency import run_in_threadpool
+from langgraph.graph import END
+
+from core.graph import app_graph
+from core.agents import MODEL_NAME, PROMPT_VERSION, ANSWER_MAX_CONTEXT_TOKENS, aquestion_answering_agent, classifier_sample, token_demands
+from core.cache import ResultCache, hash_stream, make_cache_key
+from core.ingest import EmptyDocumentError, ingest_pdf
+from core.state import DocumentState
+from core.db import add_analysis, add_analytics_session, get_cached_analysis
+from core.writer import db_writer
+from core.analytics import AnalyticsSession
+from core.llm_cache import bypass_prompt_cache
+from core.dedup import NEAR_DUPLICATE_MAX_CHANGED_TOKENS, changed_chunks
+from core.mapreduce import build_windows, partial_keys
+from core.retrieval import RETRIEVAL_ENABLED, ChunkIndex, prune_indexes
+from core.budget import TOKEN_BUDGET_ENABLED, TokenBudget, token_calibration
+from core.hedging import latency_history
+
+# Result cache: local LRU tier backed by stored AnalysisResult rows
+result_cache = ResultCache(persistent_lookup=get_cached_analysis)
+
+
+class DocumentNotFoundError(LookupError):
+    """No chunk index is stored for the document id"""
+
+
+# Progress callback: on_event(event name, payload). Called from the event loop
+# and from agent threads alike, so it must be thread-safe and must not block.
+EventSink = Callable[[str, Dict[str, Any]], None]
+
+# Stored map-reduce partials are only reused by the model and prompts that produced them
+PARTIALS_VERSION = f"{MODEL_NAME}:{PROMPT_VERSION}"
+
+# State keys that are inputs or internals rather than agent output
+_INTERNAL_STATE_KEYS = {"raw_text", "chunks"}
+
+
+def _public_update(update: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        key: value for key, value in update.items()
+        if not key.startswith("_") and key not in _INTERNAL_STATE_KEYS
+    }
+
+
+async def _run_graph(initial_state: DocumentState, analytics_session: AnalyticsSession, on_event: Optional[EventSink]) -> DocumentState:
+    """Run the agent graph; with an event sink, stream each node's update as soon as the node finishes"""
+    if on_event is None:
+        return await app_graph.ainvoke(initial_state)
+
+    result_state = None
+    async for step in app_graph.astream(initial_state):
+        for node, update in step.items():
+            if node == END:
+                result_state = update
+            else:
+                on_event("node", {
+                    "node": node,
+                    "output": _public_update(update or {}),
+                    "token_usage": analytics_session.token_tracker.get_totals()
+                })
+    return result_state
+
+
+def spool_upload(source: BinaryIO, suffix: str = ".pdf") -> Tuple[str, str]:
+    """
+    Copy an uploaded file object to a temp file, hashing it on the way, so it
+    is never held in memory. Blocking; run it in a worker thread.
+
+    Returns:
+        (temp file path, SHA-256 of the content); the caller deletes the file
+    """
+    spool = tempfile.NamedTemporaryFile(suffix=suffix, delete=False)
+    try:
+        with spool:
+            content_hash = hash_stream(source, spool)
+    except BaseException:
+        os.unlink(spool.name)
+        raise
+    return spool.name, content_hash
+
+
+def _near_duplicate_reuse(match: Dict[str, Any], fingerprint: Dict[str, Any], chunks: list, classified: bool) -> Tuple[Dict[str, Any], Dict[str, Any], Dict[str, Any]]:
+    """
+    Plan the reuse of an earlier revision's analysis. Its classification is
+    reused unless the classifier already answered. The rest depends on what
+    changed: nothing ("reuse" its outputs), at most
+    NEAR_DUPLICATE_MAX_CHANGED_TOKENS of text ("update" its outputs from the
+    changed chunks), or more ("incremental": map-reduce only calls the model
+    for windows and reduce groups without a stored partial result). An
+    analysis by another model or prompt version (an explicit revision_of;
+    near-duplicate search only finds matching ones) is never reused as-is:
+    with nothing changed it is updated too, and its partials are dropped.
+
+    Returns:
+        (the _near_duplicate state entry, report for the analytics trace,
+        its stored partials that are still valid for this document, by agent)
+    """
+    changed = changed_chunks(fingerprint, match["chunk_hashes"])
+    changed_tokens = sum(chunks[i]["tokens"] for i in changed)
+    reuse_classification = not classified and match["document_type"] not in (None, "Unknown")
+    skipped = ["classifier"] if reuse_classification else []
+    same_version = match.get("model") == MODEL_NAME and match.get("prompt_version") == PROMPT_VERSION
+    if not changed and same_version:
+        mode = "reuse"
+        skipped += ["extractor", "summarizer", "insight_generator"]
+    elif changed_tokens <= NEAR_DUPLICATE_MAX_CHANGED_TOKENS:
+        mode = "update"
+    else:
+        mode = "incremental"
+
+    # Partial results this document's map-reduce would produce again stay
+    # valid. They are carried over to the new result, since the reuse and
+    # update modes run no map-reduce.
+    stored = (match.get("partials") or {}) if same_version else {}
+    valid_keys = partial_keys(build_windows(chunks))
+    carried = {
+        agent: {key: output for key, output in outputs.items() if key in valid_keys}
+        for agent, outputs in (stored.get("agents", {}) if stored.get("version") == PARTIALS_VERSION else {}).items()
+    }
+
+    state_entry = {
+        "mode": mode,
+        "source_session_id": match["session_id"],
+        "similarity": match["similarity"],
+        "document_type": match["document_type"] if reuse_classification else None,
+        "key_sections": match["key_sections"],
+        "summary": match["summary"],
+        "insights": match["insights"],
+        "partials": carried,
+        "changed_text": "".join(chunks[i]["text"] for i in changed),
+        "changed_chunks": len(changed),
+        "total_chunks": len(chunks)
+    }
+    report = {
+        "source_session_id": match["session_id"],
+        "similarity": match["similarity"],
+        "mode": mode,
+        "same_version": same_version,
+        "changed_chunks": len(changed),
+        "total_chunks": len(chunks),
+        "changed_tokens": changed_tokens,
+        "reusable_partials": {agent: len(outputs) for agent, outputs in carried.items()},
+        "skipped_agents": skipped
+    }
+    # Agents replace their entry with their own job's outputs
+    return state_entry, report, dict(carried)
+
+
+async def analyze_document(
+    path: str,
+    filename: str,
+    content_hash: str,
+    user_question: Optional[str] = None,
+    bypass_cache: bool = False,
+    session_id: Optional[str] = None,
+    on_event: Optional[EventSink] = None,
+    revision_of: Optional[str] = None
+) -> Tuple[Dict[str, Any], Optional[str]]:
+    """
+    Analyze a spooled PDF.
+
+    Results are persisted write-behind: they are queued for the background
+    writer and may reach the database shortly after this returns.
+
+    A stored analysis of a near-duplicate document (see core.dedup), or of
+    the session named by revision_of, is reused: its classification, and its
+    other outputs updated from only the chunks that changed (see
+    _near_duplicate_reuse).
+
+    A user_question is answered from the document's best matching chunks.
+    The chunk index is stored under the session id, which the response
+    returns as document_id for follow-up questions (see answer_question).
+
+    With on_event, progress is reported while the analysis runs: "cache"
+    (lookup outcome), "ingested" (page/token counts and any near-duplicate
+    found), "summary_delta" (summary text as it is generated), "agent" (each
+    agent's completion with running token counts) and "node" (each graph
+    node's state update, i.e. partial results).
+
+    Returns:
+        (response data as served by /analyze-pdf, session id of the stored
+        AnalysisResult; for cache hits, the session the hit came from)
+
+    Raises:
+        EmptyDocumentError: if the file is not a readable PDF or no text could be extracted
+    """
+    session_id = session_id or str(uuid.uuid4())
+
+    # Initialize analytics session
+    analytics_session = AnalyticsSession(session_id)
+    analytics_session.set_metadata(filename=filename, model=MODEL_NAME)
+    if on_event is not None:
+        token_tracker = analytics_session.token_tracker
+        analytics_session.agent_tracker.add_listener(lambda execution: on_event("agent", {
+            "agent": execution["agent_name"],
+            "status": execution["status"],
+            "duration_seconds": round(execution["duration_seconds"], 3),
+            "error": execution["error"],
+            "token_usage": token_tracker.get_totals()
+        }))
+
+    cache_key = make_cache_key(content_hash, user_question, MODEL_NAME, PROMPT_VERSION)
+
+    if bypass_cache:
+        result_cache.record_bypass()
+        # A forced re-run should reach the model, not replay cached prompt answers
+        bypass_prompt_cache()
+        analytics_session.record_cache_lookup("bypass", result_cache.stats())
+    else:
+        cached = await run_in_threadpool(result_cache.get, cache_key)
+        if cached:
+            source_session_id = cached.pop("source_session_id", None)
+            analytics_session.record_cache_lookup(
+                "hit",
+                result_cache.stats(),
+                source_session_id=source_session_id
+            )
+            analytics_session.set_metadata(document_type=cached.get("document_type"))
+            analytics_report = analytics_session.get_full_report()
+            await db_writer.asubmit(add_analytics_session, analytics_report)
+            if on_event is not None:
+                on_event("cache", {"status": "hit", "source_session_id": source_session_id})
+
+            response_data = {
+                **cached,
+                "agent_trace": cached.get("agent_trace", []) + ["System: Served from result cache, no agents were run."],
+                "session_id": session_id,
+                "document_id": source_session_id,
+                "analytics": analytics_report
+            }
+            return response_data, source_session_id
+        analytics_session.record_cache_lookup("miss", result_cache.stats())
+    if on_event is not None:
+        on_event("cache", {"status": analytics_session.cache_info["status"]})
+
+    # PDF parsing runs off the event loop, page by page; the classifier
+    # starts as soon as the first pages are in.
+    ingested = await ingest_pdf(
+        path,
+        token_tracker=analytics_session.token_tracker,
+        agent_tracker=analytics_session.agent_tracker,
+        reuse_near_duplicates=not bypass_cache,
+        revision_of=revision_of
+    )
+    raw_text = ingested["raw_text"]
+    classification = ingested["classification"] or {}
+
+    if not raw_text:
+        raise EmptyDocumentError("Could not extract text from PDF. It might be empty or scanned images without OCR enabled.")
+
+    chunks = ingested["chunks"]
+    # Vectorized off the event loop while the agents run; the question answerer waits for it
+    index_task = asyncio.ensure_future(asyncio.to_thread(
+        ChunkIndex.build, chunks, metadata={"filename": filename}
+    )) if RETRIEVAL_ENABLED else None
+    analytics_session.set_metadata(num_pages=ingested["num_pages"], num_tokens=ingested["num_tokens"], num_chunks=len(chunks))
+    document_type = classification.get("document_type")
+    classified_by = classification.get("classified_by")
+    system_logs = [f"System: Received file {filename}. Text length: {len(raw_text)} chars, {ingested['num_tokens']} tokens in {len(chunks)} chunks."]
+
+    near_duplicate, near_duplicate_report, partials = None, None, {}
+    match = ingested["near_duplicate"]
+    if match:
+        near_duplicate, near_duplicate_report, partials = _near_duplicate_reuse(match, ingested["fingerprint"], chunks, classified=bool(document_type))
+        if not document_type:
+            document_type, classified_by = near_duplicate["document_type"], "near_duplicate"
+        analytics_session.set_metadata(near_duplicate=near_duplicate_report)
+        system_logs.append(
+            f"System: Near-duplicate of session {match['session_id']} (similarity {match['similarity']:.2f}), "
+            f"{near_duplicate_report['changed_chunks']} of {len(chunks)} chunks changed; "
+            f"mode {near_duplicate_report['mode']}, skipped agents: {', '.join(near_duplicate_report['skipped_agents']) or 'none'}."
+        )
+    elif revision_of:
+        system_logs.append(f"System: No stored analysis for revision_of session {revision_of}; analyzing the whole document.")
+
+    if on_event is not None:
+        on_event("ingested", {
+            "num_pages": ingested["num_pages"],
+            "num_tokens": ingested["num_tokens"],
+            "num_chunks": len(chunks),
+            "document_type": document_type,
+            "near_duplicate": near_duplicate_report
+        })
+
+    chunk_index = None
+    if index_task and user_question:
+        chunk_index = await index_task
+
+    # Initialize State with analytics trackers
+    initial_state: DocumentState = {
+        "raw_text": raw_text,
+        "chunks": chunks,
+        "document_type": document_type,
+        "classified_by": classified_by,
+        "extracted_sections": {},
+        "summary": None,
+        "insights": [],
+        "user_question": user_question,
+        "answer": None,
+        "agent_logs": system_logs + classification.get("agent_logs", []),
+        "_token_tracker": analytics_session.token_tracker,
+        "_agent_tracker": analytics_session.agent_tracker,
+        "_event_sink": on_event,
+        "_near_duplicate": near_duplicate,
+        "_partials": partials,
+        "_chunk_index": chunk_index,
+        "_budget": None
+    }
+    # Planned once the early classifier's spend is known (it is counted against the request budget)
+    budget = TokenBudget(analytics_session.token_tracker, token_demands(initial_state), model=MODEL_NAME) if TOKEN_BUDGET_ENABLED else None
+    initial_state["_budget"] = budget
+
+    # Run Graph (agents await their LLM calls, so other requests are served meanwhile)
+    try:
+        result_state = await _run_graph(initial_state, analytics_session, on_event)
+    except BaseException:
+        if index_task:
+            index_task.cancel()
+        raise
+
+    token_calibration.observe(analytics_session.token_tracker.call_details)
+    latency_history.observe(analytics_session.token_tracker.call_details)
+    agent_logs = result_state.get("agent_logs", [])
+    if budget:
+        budget_report = budget.report()
+        analytics_session.set_metadata(token_budget=budget_report)
+        if budget_report["degraded_agents"]:
+            agent_logs = agent_logs + [
+                "System: Over the token budget, sent the most informative part that fit: " + ", ".join(
+                    f"{agent} {budget_report['grants'][agent]['granted']} of {budget_report['grants'][agent]['wanted']} tokens"
+                    for agent in budget_report["degraded_agents"]
+                ) + "."
+            ]
+
+    # Generate analytics report
+    analytics_session.set_metadata(document_type=result_state.get("document_type"), classified_by=result_state.get("classified_by"))
+    analytics_report = analytics_session.get_full_report()
+
+    response_data = {
+        "document_type": result_state.get("document_type", "Unknown"),
+        "summary": result_state.get("summary", "No summary available"),
+        "key_sections": result_state.get("extracted_sections", {}),
+        "insights": result_state.get("insights", []),
+        "answer": result_state.get("answer"),
+        "agent_trace": agent_logs,
+        "session_id": session_id,
+        "document_id": session_id if index_task else None,
+        "analytics": analytics_report
+    }
+
+    if index_task:
+        chunk_index = await index_task
+        chunk_index.metadata["document_type"] = response_data["document_type"]
+        await asyncio.to_thread(chunk_index.save, session_id)
+        await asyncio.to_thread(prune_indexes)
+
+    # A result some agent failed on (outage, missing API key) or reduced from
+    # only some of its map windows is stored, but never under the cache key,
+    # so the next upload of the document retries
+    agent_execution = analytics_report["agent_execution"]
+    complete = agent_execution["failed_agents"] == 0 and agent_execution["degraded_agents"] == 0
+
+    # Queue both records for the background writer (one transaction per flush)
+    await db_writer.asubmit(
+        add_analysis, filename, response_data, session_id,
+        content_hash=content_hash, cache_key=cache_key if complete else None, fingerprint=ingested["fingerprint"],
+        partials={"version": PARTIALS_VERSION, "agents": partials} if partials else None,
+        classifier_sample=classifier_sample(initial_state), classified_by=result_state.get("classified_by"),
+        model=MODEL_NAME, prompt_version=PROMPT_VERSION
+    )
+    await db_writer.asubmit(add_analytics_session, analytics_report)
+
+    if complete:
+        result_cache.put(cache_key, {
+            "document_type": response_data["document_type"],
+            "summary": response_data["summary"],
+            "key_sections": response_data["key_sections"],
+            "insights": response_data["insights"],
+            "answer": response_data["answer"],
+            "agent_trace": response_data["agent_trace"],
+            "source_session_id": session_id
+        })
+
+    return response_data, session_id
+
+
+async def answer_question(document_id: str, question: str, session_id: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Answer a follow-up question about an analyzed document from its stored
+    chunk index: no upload, parsing or re-analysis, one model call with the
+    best matching chunks. Recorded as an analytics session of its own.
+
+    Raises:
+        DocumentNotFoundError: if no chunk index is stored for document_id
+    """
+    chunk_index = await asyncio.to_thread(ChunkIndex.load, document_id)
+    if chunk_index is None:
+        raise DocumentNotFoundError(f"No stored document with id {document_id}")
+
+    session_id = session_id or str(uuid.uuid4())
+    analytics_session = AnalyticsSession(session_id)
+    analytics_session.set_metadata(
+        filename=chunk_index.metadata.get("filename"),
+        document_type=chunk_index.metadata.get("document_type"),
+        model=MODEL_NAME,
+        document_id=document_id,
+        num_chunks=len(chunk_index.chunks)
+    )
+
+    budget = TokenBudget(
+        analytics_session.token_tracker, {"question_answerer": ANSWER_MAX_CONTEXT_TOKENS}, model=MODEL_NAME
+    ) if TOKEN_BUDGET_ENABLED else None
+    update = await aquestion_answering_agent({
+        "user_question": question,
+        "_chunk_index": chunk_index,
+        "_token_tracker": analytics_session.token_tracker,
+        "_agent_tracker": analytics_session.agent_tracker,
+        "_budget": budget
+    })
+    token_calibration.observe(analytics_session.token_tracker.call_details)
+    latency_history.observe(analytics_session.token_tracker.call_details)
+    if budget:
+        analytics_session.set_metadata(token_budget=budget.report())
+
+    analytics_report = analytics_session.get_full_report()
+    await db_writer.asubmit(add_analytics_session, analytics_report)
+    return {
+        **(update.get("answer") or {"question": question, "answer": None, "sources": []}),
+        "document_id": document_id,
+        "agent_trace": update.get("agent_logs", []),
+        "session_id": session_id,
+        "analytics": analytics_report
+    }
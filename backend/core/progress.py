@@ -0,0 +1,83 @@
+"""
+Streaming Progress
+Runs one analysis and turns its progress events into a text stream, either
+server-sent events or newline-delimited JSON, so clients can show the
+classifier's verdict and partial results while later agents are still running.
+"""
+import os
+import json
+import uuid
+import asyncio
+import traceback
+from typing import Any, AsyncIterator, Dict, Optional
+
+from core.pipeline import analyze_document, EmptyDocumentError
+
+STREAM_MEDIA_TYPES = {
+    "sse": "text/event-stream",
+    "ndjson": "application/x-ndjson"
+}
+
+
+def format_event(event: str, data: Dict[str, Any], fmt: str) -> str:
+    if fmt == "sse":
+        return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+    return json.dumps({"event": event, "data": data}, default=str) + "\n"
+
+
+async def stream_analysis(
+    path: str,
+    filename: str,
+    content_hash: str,
+    user_question: Optional[str] = None,
+    bypass_cache: bool = False,
+    fmt: str = "sse",
+    revision_of: Optional[str] = None
+) -> AsyncIterator[str]:
+    """
+    Analyze a spooled PDF and yield its progress as formatted events:
+    "started", then the pipeline's events (see analyze_document), then
+    "result" (the /analyze-pdf response) or "error".
+
+    Takes ownership of the spooled file. If the client goes away the
+    analysis is cancelled.
+    """
+    loop = asyncio.get_running_loop()
+    events: asyncio.Queue = asyncio.Queue()
+    session_id = str(uuid.uuid4())
+
+    def on_event(event: str, data: Dict[str, Any]):
+        # Agents may finish on worker threads
+        loop.call_soon_threadsafe(events.put_nowait, (event, data))
+
+    async def run():
+        try:
+            response_data, _ = await analyze_document(
+                path, filename, content_hash,
+                user_question=user_question,
+                bypass_cache=bypass_cache,
+                session_id=session_id,
+                on_event=on_event,
+                revision_of=revision_of
+            )
+            on_event("result", response_data)
+        except EmptyDocumentError as e:
+            on_event("error", {"status_code": 400, "detail": str(e)})
+        except Exception as e:
+            traceback.print_exc()
+            on_event("error", {"status_code": 500, "detail": str(e)})
+        finally:
+            os.unlink(path)
+            loop.call_soon_threadsafe(events.put_nowait, None)
+
+    yield format_event("started", {"session_id": session_id, "filename": filename}, fmt)
+    task = asyncio.create_task(run())
+    try:
+        while True:
+            item = await events.get()
+            if item is None:
+                break
+            yield format_event(*item, fmt)
+    finally:
+        if not task.done():
+            task.cancel()
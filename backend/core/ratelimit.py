@@ -0,0 +1,312 @@
+"""
+LLM Rate Limiting
+A process-wide token bucket in front of every LLM call, so batch runs and
+interactive requests together stay under the provider's request rate, and
+an adaptive limit on the calls in flight, which backs off when the provider
+throttles (429) or slows down.
+"""
+import os
+import time
+import random
+import asyncio
+import threading
+from collections import deque
+from typing import Dict
+
+from core.hedging import size_class
+
+# Requests per minute across the process; 0 disables the limit
+LLM_RATE_LIMIT_RPM = float(os.getenv("LLM_RATE_LIMIT_RPM", "0"))
+# Calls allowed back to back before the rate applies
+LLM_RATE_LIMIT_BURST = int(os.getenv("LLM_RATE_LIMIT_BURST", "10"))
+
+
+class TokenBucket:
+    """
+    Token bucket usable from threads and coroutines alike. A caller reserves
+    a token up front and then waits until it becomes available, so waiters
+    are served in arrival order and nobody spins.
+    """
+    def __init__(self, rate_per_second: float, capacity: int):
+        self.rate_per_second = rate_per_second
+        self.capacity = max(1, capacity)
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self.acquired = 0
+        self.total_wait = 0.0
+
+    def _reserve(self) -> float:
+        """Take a token (possibly going into debt); return seconds to wait for it"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate_per_second)
+            self._updated = now
+            self._tokens -= 1
+            wait = max(0.0, -self._tokens / self.rate_per_second)
+            self.acquired += 1
+            self.total_wait += wait
+            return wait
+
+    def acquire(self):
+        wait = self._reserve()
+        if wait:
+            time.sleep(wait)
+
+    def try_acquire(self) -> bool:
+        """Take a token only if one is available right now"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate_per_second)
+            self._updated = now
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            self.acquired += 1
+            return True
+
+    async def aacquire(self):
+        wait = self._reserve()
+        if wait:
+            await asyncio.sleep(wait)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'rate_per_minute': round(self.rate_per_second * 60, 2),
+                'burst': self.capacity,
+                'acquired': self.acquired,
+                'average_wait_seconds': round(self.total_wait / self.acquired, 4) if self.acquired else 0
+            }
+
+
+llm_rate_limiter = (
+    TokenBucket(LLM_RATE_LIMIT_RPM / 60.0, LLM_RATE_LIMIT_BURST)
+    if LLM_RATE_LIMIT_RPM > 0 else None
+)
+
+
+# Adaptive concurrency: LLM calls in flight across the process, adjusted
+# AIMD-style. Every uncongested call raises the limit by 1/limit (about one
+# per round of calls); a 429 halves it and a call much slower than usual
+# cuts it by LLM_LATENCY_BACKOFF.
+LLM_ADAPTIVE_CONCURRENCY = os.getenv("LLM_ADAPTIVE_CONCURRENCY", "1") == "1"
+LLM_CONCURRENCY_INITIAL = int(os.getenv("LLM_CONCURRENCY_INITIAL", "8"))
+LLM_CONCURRENCY_MIN = int(os.getenv("LLM_CONCURRENCY_MIN", "1"))
+LLM_CONCURRENCY_MAX = int(os.getenv("LLM_CONCURRENCY_MAX", "64"))
+LLM_THROTTLE_BACKOFF = float(os.getenv("LLM_THROTTLE_BACKOFF", "0.5"))
+LLM_LATENCY_BACKOFF = float(os.getenv("LLM_LATENCY_BACKOFF", "0.9"))
+# Recent latency (per token) this many times the uncongested baseline of calls
+# with a prompt of the same size class counts as congestion
+LLM_LATENCY_TOLERANCE = float(os.getenv("LLM_LATENCY_TOLERANCE", "2.0"))
+
+# Retries of throttled (429) and transiently failed calls, with full-jitter exponential backoff
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "4"))
+LLM_RETRY_BASE_DELAY = float(os.getenv("LLM_RETRY_BASE_DELAY", "0.5"))
+LLM_RETRY_MAX_DELAY = float(os.getenv("LLM_RETRY_MAX_DELAY", "20"))
+
+# Smoothing of the recent latency, and how fast the baseline may drift up per call
+_LATENCY_ALPHA = 0.2
+_BASELINE_DRIFT = 1.001
+
+
+class _Waiter:
+    """A caller queued for a slot: a thread blocked on an event or a coroutine awaiting a future"""
+    def __init__(self, loop: asyncio.AbstractEventLoop = None):
+        self.granted = False
+        if loop is None:
+            self._event = threading.Event()
+        else:
+            self._loop = loop
+            self._future = loop.create_future()
+
+    def wake(self):
+        self.granted = True
+        if hasattr(self, "_event"):
+            self._event.set()
+        else:
+            self._loop.call_soon_threadsafe(self._resolve)
+
+    def _resolve(self):
+        if not self._future.done():
+            self._future.set_result(None)
+
+    def wait(self):
+        self._event.wait()
+
+    def __await__(self):
+        return self._future.__await__()
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    Semaphore whose size follows the provider's capacity, usable from threads
+    and coroutines alike. Waiters are admitted in arrival order.
+
+    acquire()/aacquire() return a ticket to hand back to release(), together
+    with what the call observed (latency, tokens, whether it was throttled).
+    Only calls admitted after the last decrease can cause another one, so a
+    burst of 429s from calls that were already in flight halves the limit once.
+
+    Latency per token is not constant across prompt sizes (a short prompt
+    pays the same fixed overhead over fewer tokens), so baseline and recent
+    latency are kept per prompt size class (core.hedging.size_class), like
+    the hedging history: a classifier call is never compared with a long
+    extraction call.
+    """
+    def __init__(
+        self,
+        initial: int = LLM_CONCURRENCY_INITIAL,
+        minimum: int = LLM_CONCURRENCY_MIN,
+        maximum: int = LLM_CONCURRENCY_MAX,
+        throttle_backoff: float = LLM_THROTTLE_BACKOFF,
+        latency_backoff: float = LLM_LATENCY_BACKOFF,
+        latency_tolerance: float = LLM_LATENCY_TOLERANCE
+    ):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = float(min(max(initial, self.minimum), self.maximum))
+        self.throttle_backoff = throttle_backoff
+        self.latency_backoff = latency_backoff
+        self.latency_tolerance = latency_tolerance
+        self.in_flight = 0
+        self._waiters = deque()
+        self._generation = 0
+        # Per prompt size class
+        self._baseline: Dict[int, float] = {}
+        self._recent: Dict[int, float] = {}
+        self._lock = threading.Lock()
+        self.acquired = 0
+        self.queued = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.throttled = 0
+        self.decreases = 0
+
+    def _try_admit(self) -> bool:
+        if self.in_flight < int(self.limit) and not self._waiters:
+            self.in_flight += 1
+            return True
+        return False
+
+    def _wake_waiters(self):
+        while self._waiters and self.in_flight < int(self.limit):
+            self.in_flight += 1
+            self._waiters.popleft().wake()
+
+    def _admitted(self, waited: float) -> tuple:
+        with self._lock:
+            self.acquired += 1
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+            return self._generation, waited
+
+    def acquire(self) -> tuple:
+        """Block until a slot is free; returns (ticket, seconds waited)"""
+        start = time.monotonic()
+        with self._lock:
+            if self._try_admit():
+                waiter = None
+            else:
+                waiter = _Waiter()
+                self._waiters.append(waiter)
+                self.queued += 1
+        if waiter is not None:
+            waiter.wait()
+        return self._admitted(time.monotonic() - start)
+
+    def try_acquire(self):
+        """A ticket if a slot is free right now (nobody waiting), else None"""
+        with self._lock:
+            if not self._try_admit():
+                return None
+            self.acquired += 1
+            return self._generation
+
+    async def aacquire(self) -> tuple:
+        start = time.monotonic()
+        with self._lock:
+            if self._try_admit():
+                waiter = None
+            else:
+                waiter = _Waiter(asyncio.get_running_loop())
+                self._waiters.append(waiter)
+                self.queued += 1
+        if waiter is not None:
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                with self._lock:
+                    if waiter.granted:
+                        # The slot was handed over just as the caller gave up
+                        self.in_flight -= 1
+                        self._wake_waiters()
+                    else:
+                        self._waiters.remove(waiter)
+                raise
+        return self._admitted(time.monotonic() - start)
+
+    def release(self, ticket: int, latency: float = None, prompt_tokens: int = 0, output_tokens: int = 0, throttled: bool = False):
+        """
+        Hand a slot back. latency (seconds) and token counts of a call the
+        provider answered feed the latency signal; throttled marks a 429.
+        """
+        with self._lock:
+            self.in_flight -= 1
+            if throttled:
+                self.throttled += 1
+                self._decrease(ticket, self.throttle_backoff)
+            elif latency is not None:
+                size = size_class(prompt_tokens)
+                sample = latency / max(prompt_tokens + output_tokens, 1)
+                baseline = self._baseline.get(size)
+                recent = self._recent.get(size)
+                baseline = self._baseline[size] = sample if baseline is None else min(sample, baseline * _BASELINE_DRIFT)
+                recent = self._recent[size] = sample if recent is None else (1 - _LATENCY_ALPHA) * recent + _LATENCY_ALPHA * sample
+                if recent > baseline * self.latency_tolerance:
+                    self._decrease(ticket, self.latency_backoff)
+                else:
+                    self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._wake_waiters()
+
+    def _decrease(self, generation: int, factor: float):
+        if generation != self._generation:
+            return
+        self.limit = max(self.minimum, self.limit * factor)
+        self._generation += 1
+        self.decreases += 1
+        # What was slow before the cut says nothing about the new limit
+        self._recent.clear()
+
+    def current_limit(self) -> int:
+        with self._lock:
+            return int(self.limit)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'limit': int(self.limit),
+                'in_flight': self.in_flight,
+                'waiting': len(self._waiters),
+                'acquired': self.acquired,
+                'queued': self.queued,
+                'average_wait_seconds': round(self.total_wait / self.acquired, 4) if self.acquired else 0,
+                'max_wait_seconds': round(self.max_wait, 4),
+                'throttled': self.throttled,
+                'decreases': self.decreases
+            }
+
+
+llm_concurrency_limiter = AdaptiveConcurrencyLimiter() if LLM_ADAPTIVE_CONCURRENCY else None
+
+
+def retry_delay(attempt: int, retry_after: float = None) -> float:
+    """
+    Seconds to wait before retry number attempt (0-based): full jitter, i.e.
+    uniform up to an exponentially growing cap, so retries from a burst do
+    not arrive together. A server's Retry-After is waited out first.
+    """
+    delay = random.uniform(0, min(LLM_RETRY_MAX_DELAY, LLM_RETRY_BASE_DELAY * 2 ** attempt))
+    if retry_after:
+        delay += min(retry_after, LLM_RETRY_MAX_DELAY)
+    return delay
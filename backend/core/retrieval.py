@@ -0,0 +1,199 @@
+"""
+Chunk Retrieval
+Hashing-vectorizer embeddings of a document's chunks, kept per document as
+NumPy files on disk and memory-mapped when loaded, so questions are answered
+from the few most relevant chunks instead of the whole document. Works
+offline: no embedding model or API call is involved.
+"""
+import os
+import re
+import json
+import uuid
+import zlib
+import time
+import shutil
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from core.state import Chunk
+
+RETRIEVAL_ENABLED = os.getenv("RETRIEVAL_ENABLED", "1") == "1"
+RETRIEVAL_INDEX_DIR = os.getenv("RETRIEVAL_INDEX_DIR", "./document_index")
+# Hashed feature space; vectors are stored as float16, i.e. 2 bytes per dimension per chunk
+RETRIEVAL_DIMENSIONS = int(os.getenv("RETRIEVAL_DIMENSIONS", "4096"))
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", "4"))
+# Retention: indexes not asked about for this long are deleted (0: never), and
+# past this total size the least recently used ones go first (0: no limit)
+RETRIEVAL_INDEX_TTL_SECONDS = int(os.getenv("RETRIEVAL_INDEX_TTL_SECONDS", str(30 * 24 * 3600)))
+RETRIEVAL_INDEX_MAX_BYTES = int(os.getenv("RETRIEVAL_INDEX_MAX_BYTES", str(2 * 1024 ** 3)))
+
+# Staging directories of an interrupted save are removed after this long
+_STAGING_MAX_AGE_SECONDS = 3600
+
+_WORD = re.compile(r"\w+")
+_DOCUMENT_ID = re.compile(r"^[A-Za-z0-9_-]+$")
+_SEARCH_BLOCK = 2048
+
+
+def _hashed_features(text: str) -> np.ndarray:
+    """crc32 of the lowercased words and word bigrams of text"""
+    words = _WORD.findall(text.lower())
+    features = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+    return np.array([zlib.crc32(f.encode("utf-8")) for f in features], dtype=np.uint32)
+
+
+def hashed_term_weights(text: str, dimensions: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Sparse sublinear term frequencies (1 + log tf) of text in a hashed space of
+    the given size, as (feature indices, weights). The hash's top bit picks the
+    sign, so colliding features tend to cancel out rather than add up.
+    """
+    hashes, counts = np.unique(_hashed_features(text), return_counts=True)
+    signs = np.where(hashes >> 31, -1.0, 1.0).astype(np.float32)
+    indices, slots = np.unique(hashes % dimensions, return_inverse=True)
+    weights = np.zeros(len(indices), dtype=np.float32)
+    np.add.at(weights, slots, signs * (1.0 + np.log(counts)).astype(np.float32))
+    return indices, weights
+
+
+def _term_vector(text: str, dimensions: int) -> np.ndarray:
+    vector = np.zeros(dimensions, dtype=np.float32)
+    indices, weights = hashed_term_weights(text, dimensions)
+    vector[indices] = weights
+    return vector
+
+
+def _normalize(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.where(norms == 0, 1, norms)
+
+
+def _index_path(document_id: str) -> Optional[str]:
+    # Ids come from URLs; only plain session ids map to a directory
+    if not _DOCUMENT_ID.match(document_id or ""):
+        return None
+    return os.path.join(RETRIEVAL_INDEX_DIR, document_id)
+
+
+class ChunkIndex:
+    """
+    Unit-length tf-idf vectors of a document's chunks (one row per chunk), the
+    idf weights they were built with, the chunks themselves and some metadata
+    about the document (e.g. filename).
+    """
+    def __init__(self, vectors: np.ndarray, idf: np.ndarray, chunks: List[Chunk], metadata: Optional[Dict[str, Any]] = None):
+        self.vectors = vectors
+        self.idf = idf
+        self.chunks = chunks
+        self.metadata = metadata or {}
+
+    @classmethod
+    def build(cls, chunks: List[Chunk], dimensions: int = RETRIEVAL_DIMENSIONS, metadata: Optional[Dict[str, Any]] = None) -> "ChunkIndex":
+        """Vectorize chunks; idf is computed over the document's own chunks. CPU-bound; run it in a worker thread."""
+        terms = np.stack([_term_vector(chunk["text"], dimensions) for chunk in chunks]) if chunks else np.zeros((0, dimensions), dtype=np.float32)
+        document_frequency = np.count_nonzero(terms, axis=0)
+        idf = (np.log((1 + len(chunks)) / (1 + document_frequency)) + 1).astype(np.float32)
+        vectors = _normalize(terms * idf).astype(np.float16)
+        return cls(vectors, idf, list(chunks), metadata)
+
+    def save(self, document_id: str):
+        """Write the index under RETRIEVAL_INDEX_DIR, replacing any earlier one. Blocking; see also prune_indexes."""
+        path = _index_path(document_id)
+        if path is None:
+            raise ValueError(f"Invalid document id: {document_id!r}")
+        os.makedirs(RETRIEVAL_INDEX_DIR, exist_ok=True)
+        staging = f"{path}.{uuid.uuid4().hex}.tmp"
+        os.makedirs(staging)
+        try:
+            np.save(os.path.join(staging, "vectors.npy"), self.vectors)
+            np.save(os.path.join(staging, "idf.npy"), self.idf)
+            with open(os.path.join(staging, "chunks.json"), "w", encoding="utf-8") as f:
+                json.dump({"metadata": self.metadata, "chunks": self.chunks}, f)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            os.replace(staging, path)
+        except BaseException:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+
+    @classmethod
+    def load(cls, document_id: str) -> Optional["ChunkIndex"]:
+        """Stored index of a document, vectors memory-mapped, or None. Marks it as recently used. Blocking."""
+        path = _index_path(document_id)
+        if path is None or not os.path.isdir(path):
+            return None
+        try:
+            # The directory's mtime is the last use prune_indexes goes by
+            os.utime(path)
+        except OSError:
+            return None
+        with open(os.path.join(path, "chunks.json"), encoding="utf-8") as f:
+            stored = json.load(f)
+        return cls(
+            np.load(os.path.join(path, "vectors.npy"), mmap_mode="r"),
+            np.load(os.path.join(path, "idf.npy")),
+            stored["chunks"],
+            stored.get("metadata")
+        )
+
+    def search(self, question: str, k: int = RETRIEVAL_TOP_K) -> List[Dict[str, Any]]:
+        """Up to k chunks most similar to question (cosine), best first, as dicts with the chunk's position and score"""
+        query = _normalize(_term_vector(question, len(self.idf)) * self.idf)
+        if not len(self.chunks) or not query.any():
+            return []
+        # Scored in blocks, so a memory-mapped index is never converted to float32 whole
+        scores = np.empty(len(self.chunks), dtype=np.float32)
+        for start in range(0, len(scores), _SEARCH_BLOCK):
+            scores[start:start + _SEARCH_BLOCK] = self.vectors[start:start + _SEARCH_BLOCK].astype(np.float32) @ query
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [{**self.chunks[i], "chunk": int(i), "score": round(float(scores[i]), 4)} for i in top if scores[i] > 0]
+
+
+def _directory_size(path: str) -> int:
+    return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+
+
+def prune_indexes(
+    ttl_seconds: int = RETRIEVAL_INDEX_TTL_SECONDS,
+    max_bytes: int = RETRIEVAL_INDEX_MAX_BYTES
+) -> Dict[str, int]:
+    """
+    Delete stored indexes last saved or loaded more than ttl_seconds ago,
+    then the least recently used ones until the rest fit in max_bytes.
+    Questions about a deleted document get a 404. Blocking.
+
+    Returns:
+        counts of the indexes kept and removed, and the bytes kept and freed
+    """
+    if not os.path.isdir(RETRIEVAL_INDEX_DIR):
+        return {"kept": 0, "removed": 0, "bytes_kept": 0, "bytes_freed": 0}
+    now = time.time()
+    indexes = []
+    for entry in os.scandir(RETRIEVAL_INDEX_DIR):
+        try:
+            if not entry.is_dir():
+                continue
+            last_used = entry.stat().st_mtime
+            if entry.name.endswith(".tmp"):
+                if now - last_used > _STAGING_MAX_AGE_SECONDS:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                continue
+            indexes.append((last_used, _directory_size(entry.path), entry.path))
+        except FileNotFoundError:
+            # Replaced or removed by a concurrent save or prune
+            continue
+
+    indexes.sort(reverse=True)
+    total = sum(size for _, size, _ in indexes)
+    removed, freed = 0, 0
+    for last_used, size, path in reversed(indexes):
+        expired = ttl_seconds > 0 and now - last_used > ttl_seconds
+        if not expired and (max_bytes <= 0 or total - freed <= max_bytes):
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        removed += 1
+        freed += size
+    return {"kept": len(indexes) - removed, "removed": removed, "bytes_kept": total - freed, "bytes_freed": freed}
@@ -1,15 +1,43 @@
-from typing import TypedDict, List, Dict, Any, Optional
+import operator
+from typing import TypedDict, List, Dict, Any, Optional, Annotated
+
+class Chunk(TypedDict):
+    """
+    A slice of the document sized in tokens, aligned to sentence boundaries.
+    """
+    text: str
+    tokens: int
+    page_start: int
+    page_end: int
 
 class DocumentState(TypedDict):
     """
     Global state shared between agents in the LangGraph workflow.
     """
     raw_text: str
-    chunks: List[str]
+    chunks: List[Chunk]
     document_type: Optional[str]
+    # Which tier set document_type: "local" model, "llm" classifier, "fused" classify+extract
+    # call or "near_duplicate" (reused from an earlier analysis)
+    classified_by: Optional[str]
     extracted_sections: Dict[str, Any]
     summary: Optional[str]
     insights: List[str]
-    agent_logs: List[str]
+    # Optional question about the document, answered from its best matching chunks
+    user_question: Optional[str]
+    answer: Optional[Dict[str, Any]]
+    # Appended to by every agent; the reducer merges updates from agents running in parallel
+    agent_logs: Annotated[List[str], operator.add]
     _token_tracker: Any
     _agent_tracker: Any
+    # Optional progress callback (see core.pipeline.EventSink), e.g. for summary text deltas
+    _event_sink: Any
+    # Earlier analysis of a near-duplicate revision (see core.pipeline): its outputs, stored
+    # map-reduce partials and the text of the chunks that changed since, or None
+    _near_duplicate: Any
+    # Filled in by map-reduce agents: agent name -> MapReduceJob.outputs, stored with the result
+    _partials: Any
+    # core.retrieval.ChunkIndex of the document, for the question answering agent
+    _chunk_index: Any
+    # core.budget.TokenBudget of the analysis, or None when budgets are off
+    _budget: Any
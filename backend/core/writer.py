@@ -0,0 +1,195 @@
+"""
+Write-behind Persistence
+Analysis results, analytics sessions and batch progress are queued and
+written by a background thread, many records per transaction, so requests
+never wait on a commit and SQLite's single writer lock is taken once per
+flush instead of once per record.
+"""
+import os
+import time
+import queue
+import atexit
+import asyncio
+import threading
+from typing import Callable, List, Optional
+
+from core.db import SessionLocal, begin_write, run_in_transaction
+
+WRITE_BEHIND_ENABLED = os.getenv("WRITE_BEHIND_ENABLED", "1") == "1"
+# Pending writes before producers block (backpressure)
+WRITE_BEHIND_MAX_QUEUE = int(os.getenv("WRITE_BEHIND_MAX_QUEUE", "10000"))
+# Most writes applied in one transaction
+WRITE_BEHIND_BATCH_SIZE = int(os.getenv("WRITE_BEHIND_BATCH_SIZE", "200"))
+# How long the writer waits for more writes before flushing a partial batch
+WRITE_BEHIND_FLUSH_INTERVAL = float(os.getenv("WRITE_BEHIND_FLUSH_INTERVAL", "0.05"))
+
+_STOP = object()
+
+
+class WriteBehindQueue:
+    """
+    Bounded FIFO of write operations drained by one writer thread. An
+    operation is a function taking a SQLAlchemy session (see core.db's add_*
+    and mark_* functions); operations are applied in submission order.
+
+    If a flush fails, its operations are retried one transaction each so a
+    single bad record cannot take the rest of the batch with it.
+    """
+    def __init__(
+        self,
+        max_queue: int = WRITE_BEHIND_MAX_QUEUE,
+        batch_size: int = WRITE_BEHIND_BATCH_SIZE,
+        flush_interval: float = WRITE_BEHIND_FLUSH_INTERVAL,
+        enabled: bool = WRITE_BEHIND_ENABLED
+    ):
+        self.max_queue = max_queue
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.enabled = enabled
+        self._queue: "queue.Queue" = queue.Queue(maxsize=max_queue)
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._atexit_registered = False
+
+        self.submitted = 0
+        self.written = 0
+        self.failed = 0
+        self.flushes = 0
+        self.max_depth = 0
+        self.last_flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+        self.total_flush_seconds = 0.0
+
+    def _ensure_started(self):
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+                self._thread.start()
+                if not self._atexit_registered:
+                    atexit.register(self.stop)
+                    self._atexit_registered = True
+
+    def _count_submit(self):
+        with self._stats_lock:
+            self.submitted += 1
+            self.max_depth = max(self.max_depth, self._queue.qsize())
+
+    def submit(self, op: Callable, *args, **kwargs):
+        """Queue a write; blocks while the queue is full. Runs inline when disabled."""
+        if not self.enabled:
+            run_in_transaction(op, *args, **kwargs)
+            return
+        self._ensure_started()
+        self._queue.put((op, args, kwargs))
+        self._count_submit()
+
+    async def asubmit(self, op: Callable, *args, **kwargs):
+        """Queue a write from async code without blocking the event loop when the queue is full"""
+        if not self.enabled:
+            await asyncio.to_thread(run_in_transaction, op, *args, **kwargs)
+            return
+        self._ensure_started()
+        try:
+            self._queue.put_nowait((op, args, kwargs))
+        except queue.Full:
+            await asyncio.to_thread(self._queue.put, (op, args, kwargs))
+        self._count_submit()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                self._queue.task_done()
+                return
+            batch = [item]
+            stop = False
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stop = True
+                    break
+                batch.append(item)
+
+            self._flush(batch)
+            for _ in batch:
+                self._queue.task_done()
+            if stop:
+                self._queue.task_done()
+                return
+
+    def _apply(self, batch: List[tuple]):
+        db = SessionLocal()
+        try:
+            begin_write(db)
+            for op, args, kwargs in batch:
+                op(db, *args, **kwargs)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def _flush(self, batch: List[tuple]):
+        start = time.perf_counter()
+        written = failed = 0
+        try:
+            self._apply(batch)
+            written = len(batch)
+        except Exception as e:
+            print(f"Write-behind flush of {len(batch)} records failed ({e}); retrying individually.")
+            for op, args, kwargs in batch:
+                try:
+                    self._apply([(op, args, kwargs)])
+                    written += 1
+                except Exception as record_error:
+                    failed += 1
+                    print(f"Write-behind: dropped {getattr(op, '__name__', op)}: {record_error}")
+
+        elapsed = time.perf_counter() - start
+        with self._stats_lock:
+            self.written += written
+            self.failed += failed
+            self.flushes += 1
+            self.last_flush_seconds = elapsed
+            self.max_flush_seconds = max(self.max_flush_seconds, elapsed)
+            self.total_flush_seconds += elapsed
+
+    def drain(self):
+        """Block until everything submitted so far has been written"""
+        if self._thread is not None:
+            self._queue.join()
+
+    def stop(self):
+        """Write everything still queued, then stop the writer thread"""
+        with self._start_lock:
+            thread = self._thread
+            self._thread = None
+        if thread is not None and thread.is_alive():
+            self._queue.put(_STOP)
+            thread.join()
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            return {
+                'enabled': self.enabled,
+                'queue_depth': self._queue.qsize(),
+                'max_queue_depth': self.max_depth,
+                'max_queue': self.max_queue,
+                'submitted': self.submitted,
+                'written': self.written,
+                'failed': self.failed,
+                'flushes': self.flushes,
+                'average_batch_size': round(self.written / self.flushes, 2) if self.flushes else 0,
+                'last_flush_ms': round(self.last_flush_seconds * 1000, 2),
+                'average_flush_ms': round(self.total_flush_seconds / self.flushes * 1000, 2) if self.flushes else 0,
+                'max_flush_ms': round(self.max_flush_seconds * 1000, 2)
+            }
+
+
+db_writer = WriteBehindQueue()
@@ -1,19 +1,28 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException, Form
+from fastapi import FastAPI, UploadFile, File, HTTPException, Form, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Union
 import uvicorn
 import shutil
 import os
-import uuid
+import zipfile
+from datetime import datetime, date
 from dotenv import load_dotenv
 
-from core.graph import app_graph
-from core.pdf import extract_text_from_pdf, chunk_text
-from core.state import DocumentState
+from core.llm import aclose_llm
+from core.pipeline import analyze_document, answer_question, spool_upload, result_cache, EmptyDocumentError, DocumentNotFoundError
+from core.progress import stream_analysis, STREAM_MEDIA_TYPES
+from core.batch import batch_processor, BatchQueueFullError, is_zip_upload, spool_zip_members
+from core.ratelimit import llm_rate_limiter, llm_concurrency_limiter
+from core.llm_cache import prompt_cache
+from core.writer import db_writer
+from core.budget import token_calibration
+from core.hedging import latency_history, hedge_counters
+from core.retrieval import prune_indexes
 
-from core.db import init_db, save_analysis, save_analytics_session, get_analytics_sessions, get_analytics_summary
-from core.analytics import AnalyticsSession
+from core.db import init_db, get_analytics_sessions, get_analytics_summary, get_batch, get_batch_results, fail_interrupted_batch_items
 
 load_dotenv()
 
@@ -31,6 +40,37 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("startup")
+async def start_batch_workers():
+    interrupted = await run_in_threadpool(fail_interrupted_batch_items)
+    if interrupted:
+        print(f"Marked {interrupted} batch items interrupted by the last shutdown as failed.")
+    batch_processor.start()
+
+@app.on_event("startup")
+async def calibrate_token_budgets():
+    # Token budgets start from what the API reported for recent analyses
+    await run_in_threadpool(token_calibration.load_history)
+
+@app.on_event("startup")
+async def load_latency_history():
+    # Requests are hedged at a percentile of the latencies of recent analyses
+    await run_in_threadpool(latency_history.load_history)
+
+@app.on_event("startup")
+async def prune_document_indexes():
+    # Stored chunk indexes past their retention (also pruned after every save)
+    pruned = await run_in_threadpool(prune_indexes)
+    if pruned["removed"]:
+        print(f"Removed {pruned['removed']} stored document indexes ({pruned['bytes_freed']} bytes) past retention.")
+
+@app.on_event("shutdown")
+async def close_llm_connections():
+    """Stop batch workers, flush pending writes and release the shared LLM client's pooled connections"""
+    await batch_processor.stop()
+    await run_in_threadpool(db_writer.stop)
+    await aclose_llm()
+
 class AnalyzeResponse(BaseModel):
     document_type: str
     summary: str
@@ -38,93 +78,211 @@ class AnalyzeResponse(BaseModel):
     insights: List[str]
     agent_trace: List[str]
     session_id: str
+    answer: Optional[Dict[str, Any]] = None
+    document_id: Optional[str] = None
     analytics: Optional[Dict[str, Any]] = None
 
 @app.post("/analyze-pdf", response_model=AnalyzeResponse)
 async def analyze_pdf(
     file: UploadFile = File(...),
-    user_question: Optional[str] = Form(None)
+    user_question: Optional[str] = Form(None),
+    bypass_cache: bool = Form(False),
+    revision_of: Optional[str] = Form(None)
 ):
-    # Generate unique session ID
-    session_id = str(uuid.uuid4())
-    
-    # Initialize analytics session
-    analytics_session = AnalyticsSession(session_id)
-    analytics_session.set_metadata(filename=file.filename)
-    
+    # revision_of: session id of an earlier revision of this document; only the
+    # parts that changed since are re-analyzed. Near-duplicates of stored
+    # documents are detected without it.
+    # The upload is spooled to a temp file (hashed on the way) instead of being
+    # read into memory; pages are then parsed from disk as a stream.
+    spool_path, content_hash = await run_in_threadpool(spool_upload, file.file)
     try:
-        content = await file.read()
-        raw_text = extract_text_from_pdf(content)
-        
-        if not raw_text:
-            raise HTTPException(status_code=400, detail="Could not extract text from PDF. It might be empty or scanned images without OCR enabled.")
-            
-        chunks = chunk_text(raw_text)
-        
-        # Initialize State with analytics trackers
-        initial_state: DocumentState = {
-            "raw_text": raw_text,
-            "chunks": chunks,
-            "document_type": None,
-            "extracted_sections": {},
-            "summary": None,
-            "insights": [],
-            "agent_logs": [f"System: Received file {file.filename}. Text length: {len(raw_text)} chars."],
-            "_token_tracker": analytics_session.token_tracker,
-            "_agent_tracker": analytics_session.agent_tracker
-        }
-        
-        # Run Graph
-        result_state = app_graph.invoke(initial_state)
-        
-        # Generate analytics report
-        analytics_report = analytics_session.get_full_report()
-        
-        response_data = {
-            "document_type": result_state.get("document_type", "Unknown"),
-            "summary": result_state.get("summary", "No summary available"),
-            "key_sections": result_state.get("extracted_sections", {}),
-            "insights": result_state.get("insights", []),
-            "agent_trace": result_state.get("agent_logs", []),
-            "session_id": session_id,
-            "analytics": analytics_report
-        }
-
-        # Save to SQLite
-        save_analysis(file.filename, response_data, session_id)
-        save_analytics_session(analytics_report)
-        
+        response_data, _ = await analyze_document(
+            spool_path, file.filename, content_hash,
+            user_question=user_question,
+            bypass_cache=bypass_cache,
+            revision_of=revision_of
+        )
         return AnalyzeResponse(**response_data)
 
+    except EmptyDocumentError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         import traceback
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        os.unlink(spool_path)
+
+@app.post("/analyze-pdf/stream")
+async def analyze_pdf_stream(
+    file: UploadFile = File(...),
+    user_question: Optional[str] = Form(None),
+    bypass_cache: bool = Form(False),
+    format: str = Form("sse"),
+    revision_of: Optional[str] = Form(None)
+):
+    """
+    Same analysis as /analyze-pdf, streamed while it runs as server-sent
+    events (format=sse) or newline-delimited JSON (format=ndjson). Each agent's
+    completion and each graph node's partial output is sent as soon as it is
+    available; the last event is "result" (the /analyze-pdf response) or "error".
+    """
+    if format not in STREAM_MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail=f"format must be one of: {', '.join(STREAM_MEDIA_TYPES)}")
+    spool_path, content_hash = await run_in_threadpool(spool_upload, file.file)
+    return StreamingResponse(
+        stream_analysis(
+            spool_path, file.filename, content_hash,
+            user_question=user_question,
+            bypass_cache=bypass_cache,
+            fmt=format,
+            revision_of=revision_of
+        ),
+        media_type=STREAM_MEDIA_TYPES[format],
+        # Keep reverse proxies from buffering the stream
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.post("/documents/{document_id}/ask")
+async def ask_document(document_id: str, question: str = Form(...)):
+    """
+    Answer a question about an analyzed document (document_id from its
+    analysis) from its best matching chunks, without re-uploading it
+    """
+    if not question.strip():
+        raise HTTPException(status_code=400, detail="question must not be empty")
+    try:
+        return await answer_question(document_id, question)
+    except DocumentNotFoundError:
+        raise HTTPException(status_code=404, detail="Document not found")
+
+@app.post("/analyze-batch", status_code=202)
+async def analyze_batch(
+    files: List[UploadFile] = File(...),
+    user_question: Optional[str] = Form(None)
+):
+    """
+    Queue many PDFs (or zip archives of PDFs) for analysis.
+    Returns a batch id to poll with GET /batches/{batch_id}.
+    """
+    documents = []
+    try:
+        for upload in files:
+            if is_zip_upload(upload.filename, upload.content_type):
+                documents.extend(await run_in_threadpool(spool_zip_members, upload.file))
+            else:
+                path, content_hash = await run_in_threadpool(spool_upload, upload.file)
+                documents.append((upload.filename, path, content_hash))
+        if not documents:
+            raise HTTPException(status_code=400, detail="No PDF files found in the upload.")
+
+        batch_id = await batch_processor.submit(documents, user_question)
+    except BaseException as e:
+        for _, path, _ in documents:
+            os.unlink(path)
+        if isinstance(e, BatchQueueFullError):
+            raise HTTPException(status_code=503, detail=str(e))
+        if isinstance(e, zipfile.BadZipFile):
+            raise HTTPException(status_code=400, detail=f"Invalid zip archive: {e}")
+        raise
+
+    return {"batch_id": batch_id, "total_items": len(documents), "status": "queued"}
+
+@app.get("/batches/{batch_id}")
+def get_batch_status(batch_id: str):
+    """Batch progress and per-file status"""
+    batch = get_batch(batch_id)
+    if batch is None:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    return batch
+
+@app.get("/batches/{batch_id}/results")
+def get_batch_result_list(batch_id: str):
+    """Per-file analysis results of a batch"""
+    batch = get_batch(batch_id)
+    if batch is None:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    return {
+        "batch_id": batch_id,
+        "status": batch["status"],
+        "results": get_batch_results(batch_id)
+    }
+
+# Plain (non-async) handlers: FastAPI runs these in its threadpool so the
+# blocking DB queries don't stall the event loop.
+def _as_datetime(value: Optional[Union[datetime, date]]) -> Optional[datetime]:
+    """Plain dates in query parameters mean midnight"""
+    if type(value) is date:
+        return datetime.combine(value, datetime.min.time())
+    return value
 
 @app.get("/analytics/sessions")
-async def get_sessions(limit: int = 10):
-    """Get recent analytics sessions"""
-    sessions = get_analytics_sessions(limit)
+def get_sessions(
+    limit: int = Query(10, ge=1, le=100),
+    cursor: Optional[str] = None,
+    filename: Optional[str] = None,
+    document_type: Optional[str] = None,
+    since: Optional[Union[datetime, date]] = None,
+    until: Optional[Union[datetime, date]] = None
+):
+    """Get analytics sessions, newest first. Pass next_cursor back as cursor for the next page."""
+    try:
+        sessions, next_cursor = get_analytics_sessions(
+            limit,
+            cursor=cursor,
+            filename=filename,
+            document_type=document_type,
+            since=_as_datetime(since),
+            until=_as_datetime(until)
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     return {
         "sessions": [
             {
-                "session_id": s.session_id,
-                "filename": s.filename,
-                "start_timestamp": s.start_timestamp.isoformat() if s.start_timestamp else None,
-                "total_tokens": s.total_tokens,
-                "estimated_cost_usd": s.estimated_cost_usd,
-                "total_duration_seconds": s.total_duration_seconds,
-                "successful_agents": s.successful_agents,
-                "failed_agents": s.failed_agents
+                "session_id": s["session_id"],
+                "filename": s["filename"],
+                "document_type": s["document_type"],
+                "start_timestamp": s["start_timestamp"].isoformat() if s["start_timestamp"] else None,
+                "total_tokens": s["total_tokens"],
+                "estimated_cost_usd": s["estimated_cost_usd"],
+                "total_duration_seconds": s["total_duration_seconds"],
+                "successful_agents": s["successful_agents"],
+                "failed_agents": s["failed_agents"]
             }
             for s in sessions
-        ]
+        ],
+        "next_cursor": next_cursor
     }
 
 @app.get("/analytics/summary")
-async def get_summary():
-    """Get overall analytics summary"""
-    return get_analytics_summary()
+def get_summary(
+    since: Optional[Union[datetime, date]] = None,
+    until: Optional[Union[datetime, date]] = None,
+    model: Optional[str] = None
+):
+    """Get analytics summary, optionally for the window [since, until) and a single model"""
+    # Plain dates land on day boundaries, which the daily rollups answer directly
+    return get_analytics_summary(since=_as_datetime(since), until=_as_datetime(until), model=model)
+
+@app.get("/analytics/cache")
+async def get_cache_stats():
+    """Get result cache and prompt cache hit/miss counters"""
+    return {
+        **result_cache.stats(),
+        "prompt_cache": prompt_cache.stats() if prompt_cache is not None else None
+    }
+
+@app.get("/analytics/queue")
+async def get_queue_stats():
+    """Get batch queue, write-behind queue, LLM rate limiter, concurrency limiter and hedging counters"""
+    return {
+        "batch": batch_processor.stats(),
+        "writer": db_writer.stats(),
+        "rate_limiter": llm_rate_limiter.stats() if llm_rate_limiter else None,
+        "concurrency_limiter": llm_concurrency_limiter.stats() if llm_concurrency_limiter else None,
+        "hedging": {**hedge_counters.stats(), "latency_history": latency_history.stats()}
+    }
 
 if __name__ == "__main__":
     uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
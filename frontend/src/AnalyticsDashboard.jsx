@@ -86,6 +86,12 @@ function AnalyticsDashboard({ analytics }) {
                <div style={{ fontSize: '13px', color: 'var(--text-muted)' }}>
                   API Calls
                </div>
+               {tokenUsage.average_time_to_first_token_seconds != null && (
+                  <div style={{ fontSize: '11px', color: 'var(--text-muted)', marginTop: '8px' }}>
+                     Avg first token: {tokenUsage.average_time_to_first_token_seconds.toFixed(2)}s
+                     {tokenUsage.average_tokens_per_second != null && ` | ${tokenUsage.average_tokens_per_second.toFixed(0)} tok/s`}
+                  </div>
+               )}
             </div>
 
             {/* Estimated Cost */}
@@ -109,6 +115,11 @@ function AnalyticsDashboard({ analytics }) {
                <div style={{ fontSize: '13px', color: 'var(--text-muted)' }}>
                   Estimated Cost
                </div>
+               {tokenUsage.prompt_cache_hits > 0 && (
+                  <div style={{ fontSize: '11px', color: 'var(--text-muted)', marginTop: '8px' }}>
+                     Saved ${tokenUsage.estimated_cost_saved_usd?.toFixed(6)} ({tokenUsage.tokens_saved?.toLocaleString()} tokens, {tokenUsage.prompt_cache_hits} cached calls)
+                  </div>
+               )}
             </div>
 
             {/* Processing Time */}
@@ -291,7 +302,7 @@ function AnalyticsDashboard({ analytics }) {
                         }}
                      >
                         <div>
-                           <span style={{ color: 'var(--text-muted)' }}>Call {idx + 1}</span>
+                           <span style={{ color: 'var(--text-muted)' }}>Call {idx + 1}{call.cache_hit && ' (cached)'}</span>
                         </div>
                         <div>
                            <span style={{ color: 'var(--text-muted)' }}>Prompt:</span> {call.prompt_tokens} | 
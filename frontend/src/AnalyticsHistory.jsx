@@ -9,19 +9,45 @@ import {
    ArrowLeft
 } from 'lucide-react';
 
+const PAGE_SIZE = 20;
+
+const DOCUMENT_TYPES = ['Contract', 'Research Paper', 'Technical Report', 'Notes', 'Legal Document', 'Invoice', 'Resume', 'Other'];
+
+const EMPTY_FILTERS = { filename: '', documentType: '', since: '', until: '' };
+
+function sessionsUrl(filters, cursor) {
+   const params = new URLSearchParams({ limit: PAGE_SIZE });
+   if (cursor) params.set('cursor', cursor);
+   if (filters.filename) params.set('filename', filters.filename);
+   if (filters.documentType) params.set('document_type', filters.documentType);
+   if (filters.since) params.set('since', filters.since);
+   if (filters.until) params.set('until', filters.until);
+   return `/analytics/sessions?${params}`;
+}
+
 function AnalyticsHistory({ onBack }) {
    const [sessions, setSessions] = useState([]);
    const [summary, setSummary] = useState(null);
    const [loading, setLoading] = useState(true);
+   const [filters, setFilters] = useState(EMPTY_FILTERS);
+   const [nextCursor, setNextCursor] = useState(null);
+   const [loadingMore, setLoadingMore] = useState(false);
 
    useEffect(() => {
       fetchAnalytics();
    }, []);
 
+   // Re-query the first page whenever the filters change (debounced for typing)
+   useEffect(() => {
+      if (loading) return;
+      const timer = setTimeout(() => fetchSessions(null), 300);
+      return () => clearTimeout(timer);
+   }, [filters]);
+
    const fetchAnalytics = async () => {
       try {
          const [sessionsRes, summaryRes] = await Promise.all([
-            fetch('/analytics/sessions?limit=20'),
+            fetch(sessionsUrl(filters, null)),
             fetch('/analytics/summary')
          ]);
 
@@ -29,6 +55,7 @@ function AnalyticsHistory({ onBack }) {
          const summaryData = await summaryRes.json();
 
          setSessions(sessionsData.sessions || []);
+         setNextCursor(sessionsData.next_cursor || null);
          setSummary(summaryData);
       } catch (error) {
          console.error('Failed to fetch analytics:', error);
@@ -37,6 +64,32 @@ function AnalyticsHistory({ onBack }) {
       }
    };
 
+   // cursor = null fetches the first page; otherwise the page is appended
+   const fetchSessions = async (cursor) => {
+      setLoadingMore(Boolean(cursor));
+      try {
+         const res = await fetch(sessionsUrl(filters, cursor));
+         const data = await res.json();
+         setSessions(prev => cursor ? [...prev, ...(data.sessions || [])] : (data.sessions || []));
+         setNextCursor(data.next_cursor || null);
+      } catch (error) {
+         console.error('Failed to fetch sessions:', error);
+      } finally {
+         setLoadingMore(false);
+      }
+   };
+
+   const updateFilter = (key, value) => setFilters(prev => ({ ...prev, [key]: value }));
+
+   const filterInputStyle = {
+      padding: '8px 12px',
+      border: '1px solid var(--border)',
+      borderRadius: '8px',
+      fontSize: '13px',
+      background: 'var(--bg)',
+      color: 'inherit'
+   };
+
    if (loading) {
       return (
          <div style={{ minHeight: '100vh', padding: '40px 20px' }}>
@@ -186,15 +239,52 @@ function AnalyticsHistory({ onBack }) {
                   Recent Sessions
                </h2>
 
+               {/* Filters */}
+               <div style={{ display: 'flex', flexWrap: 'wrap', gap: '12px', marginBottom: '20px' }}>
+                  <input
+                     type="text"
+                     placeholder="Filter by filename"
+                     value={filters.filename}
+                     onChange={(e) => updateFilter('filename', e.target.value)}
+                     style={{ ...filterInputStyle, flex: '1 1 200px' }}
+                  />
+                  <select
+                     value={filters.documentType}
+                     onChange={(e) => updateFilter('documentType', e.target.value)}
+                     style={filterInputStyle}
+                  >
+                     <option value="">All document types</option>
+                     {DOCUMENT_TYPES.map(type => (
+                        <option key={type} value={type}>{type}</option>
+                     ))}
+                  </select>
+                  <input
+                     type="date"
+                     value={filters.since}
+                     onChange={(e) => updateFilter('since', e.target.value)}
+                     style={filterInputStyle}
+                     title="From"
+                  />
+                  <input
+                     type="date"
+                     value={filters.until}
+                     onChange={(e) => updateFilter('until', e.target.value)}
+                     style={filterInputStyle}
+                     title="Until (exclusive)"
+                  />
+               </div>
+
                {sessions.length === 0 ? (
                   <div style={{ textAlign: 'center', padding: '40px', color: 'var(--text-muted)' }}>
-                     No sessions found. Analyze a PDF to get started.
+                     {Object.values(filters).every(value => !value)
+                        ? 'No sessions found. Analyze a PDF to get started.'
+                        : 'No sessions match these filters.'}
                   </div>
                ) : (
                   <div style={{ display: 'flex', flexDirection: 'column', gap: '12px' }}>
-                     {sessions.map((session, idx) => (
+                     {sessions.map((session) => (
                         <div
-                           key={idx}
+                           key={session.session_id}
                            className="card"
                            style={{
                               padding: '20px',
@@ -211,6 +301,7 @@ function AnalyticsHistory({ onBack }) {
                                  <div style={{ fontSize: '12px', color: 'var(--text-muted)', display: 'flex', alignItems: 'center', gap: '6px' }}>
                                     <Calendar size={12} />
                                     {session.start_timestamp ? new Date(session.start_timestamp).toLocaleString() : 'N/A'}
+                                    {session.document_type && <span>· {session.document_type}</span>}
                                  </div>
                               </div>
                               <div style={{
@@ -270,6 +361,25 @@ function AnalyticsHistory({ onBack }) {
                            </div>
                         </div>
                      ))}
+
+                     {nextCursor && (
+                        <button
+                           onClick={() => fetchSessions(nextCursor)}
+                           disabled={loadingMore}
+                           style={{
+                              padding: '10px 16px',
+                              border: '1px solid var(--border)',
+                              borderRadius: '8px',
+                              background: 'var(--bg)',
+                              color: 'var(--primary)',
+                              cursor: loadingMore ? 'default' : 'pointer',
+                              fontSize: '14px',
+                              fontWeight: '500'
+                           }}
+                        >
+                           {loadingMore ? 'Loading...' : 'Load more'}
+                        </button>
+                     )}
                   </div>
                )}
             </div>
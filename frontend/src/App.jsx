@@ -8,6 +8,7 @@ function App() {
    const [isDragging, setIsDragging] = useState(false);
    const [loading, setLoading] = useState(false);
    const [result, setResult] = useState(null);
+   const [progress, setProgress] = useState(null); // partial results streamed while analyzing
    const [error, setError] = useState(null);
    const [view, setView] = useState('analyzer'); // 'analyzer' or 'history'
    const fileInputRef = useRef(null);
@@ -47,18 +48,55 @@ function App() {
       }
    };
 
+   const handleStreamEvent = ({ event, data }) => {
+      switch (event) {
+         case 'ingested':
+            if (data.document_type) {
+               setProgress(prev => ({ ...prev, document_type: data.document_type }));
+            }
+            break;
+         case 'summary_delta':
+            setProgress(prev => ({ ...prev, summary: (prev.summary || '') + data.delta }));
+            break;
+         case 'agent':
+            setProgress(prev => ({ ...prev, agents: [...prev.agents, data] }));
+            break;
+         case 'node': {
+            const { document_type, summary, extracted_sections, insights } = data.output;
+            setProgress(prev => ({
+               ...prev,
+               ...(document_type && { document_type }),
+               ...(summary && { summary }),
+               ...(extracted_sections && { key_sections: extracted_sections }),
+               ...(insights && { insights })
+            }));
+            break;
+         }
+         case 'result':
+            setResult(data);
+            break;
+         case 'error':
+            throw new Error(`Analysis failed: ${data.detail}`);
+         default:
+            break;
+      }
+   };
+
    const handleAnalysis = async () => {
       if (!file) return;
 
       setLoading(true);
       setError(null);
       setResult(null);
+      setProgress({ agents: [], key_sections: {}, insights: [] });
 
       const formData = new FormData();
       formData.append('file', file);
+      formData.append('format', 'ndjson');
 
       try {
-         const response = await fetch('/analyze-pdf', {
+         // Each agent's output is rendered as soon as it arrives
+         const response = await fetch('/analyze-pdf/stream', {
             method: 'POST',
             body: formData,
          });
@@ -67,15 +105,30 @@ function App() {
             throw new Error(`Analysis failed: ${response.statusText}`);
          }
 
-         const data = await response.json();
-         setResult(data);
+         const reader = response.body.getReader();
+         const decoder = new TextDecoder();
+         let buffered = '';
+         while (true) {
+            const { done, value } = await reader.read();
+            if (done) break;
+            buffered += decoder.decode(value, { stream: true });
+            const lines = buffered.split('\n');
+            buffered = lines.pop();
+            for (const line of lines) {
+               if (line.trim()) handleStreamEvent(JSON.parse(line));
+            }
+         }
       } catch (err) {
          setError(err.message);
       } finally {
          setLoading(false);
+         setProgress(null);
       }
    };
 
+   // Final result once available, otherwise whatever has streamed in so far
+   const shown = result || progress;
+
    // Show analytics history view
    if (view === 'history') {
       return <AnalyticsHistory onBack={() => setView('analyzer')} />;
@@ -218,41 +271,54 @@ function App() {
                      animation: 'spin 0.8s linear infinite'
                   }} />
                   <p style={{ color: 'var(--text-muted)', margin: 0 }}>Processing document...</p>
+                  {progress && progress.agents.length > 0 && (
+                     <div style={{ marginTop: '16px', fontSize: '13px', color: 'var(--text-muted)', display: 'flex', flexDirection: 'column', gap: '4px' }}>
+                        {progress.agents.map((agent, idx) => (
+                           <div key={idx}>
+                              {agent.status === 'completed' ? '✓' : '✗'} {agent.agent} ({agent.duration_seconds.toFixed(1)}s, {agent.token_usage.total_tokens} tokens so far)
+                           </div>
+                        ))}
+                     </div>
+                  )}
                </div>
             )}
 
-            {result && (
+            {shown && (shown.document_type || result) && (
                <div style={{ display: 'flex', flexDirection: 'column', gap: '24px' }}>
 
                   {/* Document Type */}
-                  <div className="card" style={{ padding: '24px' }}>
-                     <div style={{ fontSize: '13px', color: 'var(--text-muted)', marginBottom: '4px', textTransform: 'uppercase', letterSpacing: '0.5px' }}>
-                        Document Type
-                     </div>
-                     <div style={{ fontSize: '24px', fontWeight: '600', display: 'flex', alignItems: 'center', gap: '8px' }}>
-                        {result.document_type}
-                        <CheckCircle size={20} color="#10b981" />
+                  {shown.document_type && (
+                     <div className="card" style={{ padding: '24px' }}>
+                        <div style={{ fontSize: '13px', color: 'var(--text-muted)', marginBottom: '4px', textTransform: 'uppercase', letterSpacing: '0.5px' }}>
+                           Document Type
+                        </div>
+                        <div style={{ fontSize: '24px', fontWeight: '600', display: 'flex', alignItems: 'center', gap: '8px' }}>
+                           {shown.document_type}
+                           <CheckCircle size={20} color="#10b981" />
+                        </div>
                      </div>
-                  </div>
+                  )}
 
                   {/* Summary */}
-                  <div className="card" style={{ padding: '24px' }}>
-                     <h3 style={{ fontSize: '16px', marginBottom: '16px', fontWeight: '600' }}>
-                        Summary
-                     </h3>
-                     <p style={{ margin: 0, lineHeight: '1.7', color: 'var(--text-main)' }}>
-                        {result.summary}
-                     </p>
-                  </div>
+                  {shown.summary && (
+                     <div className="card" style={{ padding: '24px' }}>
+                        <h3 style={{ fontSize: '16px', marginBottom: '16px', fontWeight: '600' }}>
+                           Summary
+                        </h3>
+                        <p style={{ margin: 0, lineHeight: '1.7', color: 'var(--text-main)' }}>
+                           {shown.summary}
+                        </p>
+                     </div>
+                  )}
 
                   {/* Key Sections */}
-                  {Object.keys(result.key_sections).length > 0 && (
+                  {Object.keys(shown.key_sections).length > 0 && (
                      <div className="card" style={{ padding: '24px' }}>
                         <h3 style={{ fontSize: '16px', marginBottom: '16px', fontWeight: '600' }}>
                            Key Sections
                         </h3>
                         <div style={{ display: 'flex', flexDirection: 'column', gap: '12px' }}>
-                           {Object.entries(result.key_sections).map(([key, value], idx) => (
+                           {Object.entries(shown.key_sections).map(([key, value], idx) => (
                               <div key={idx} style={{
                                  padding: '16px',
                                  background: 'var(--bg)',
@@ -270,13 +336,13 @@ function App() {
                   )}
 
                   {/* Insights */}
-                  {result.insights.length > 0 && (
+                  {shown.insights.length > 0 && (
                      <div className="card" style={{ padding: '24px' }}>
                         <h3 style={{ fontSize: '16px', marginBottom: '16px', fontWeight: '600' }}>
                            Insights
                         </h3>
                         <ul style={{ margin: 0, padding: '0 0 0 20px', display: 'flex', flexDirection: 'column', gap: '8px' }}>
-                           {result.insights.map((insight, idx) => (
+                           {shown.insights.map((insight, idx) => (
                               <li key={idx} style={{ fontSize: '14px', lineHeight: '1.6', color: 'var(--text-main)' }}>
                                  {insight}
                               </li>
@@ -286,21 +352,23 @@ function App() {
                   )}
 
                   {/* Agent Trace */}
-                  <details className="card" style={{ padding: '24px' }}>
-                     <summary style={{ fontSize: '14px', fontWeight: '500', cursor: 'pointer', color: 'var(--text-muted)' }}>
-                        Agent Execution Trace
-                     </summary>
-                     <div style={{ marginTop: '16px', fontSize: '12px', fontFamily: 'monospace', display: 'flex', flexDirection: 'column', gap: '4px' }}>
-                        {result.agent_trace.map((log, idx) => (
-                           <div key={idx} style={{ color: 'var(--text-muted)' }}>
-                              [{idx + 1}] {log}
-                           </div>
-                        ))}
-                     </div>
-                  </details>
+                  {result && (
+                     <details className="card" style={{ padding: '24px' }}>
+                        <summary style={{ fontSize: '14px', fontWeight: '500', cursor: 'pointer', color: 'var(--text-muted)' }}>
+                           Agent Execution Trace
+                        </summary>
+                        <div style={{ marginTop: '16px', fontSize: '12px', fontFamily: 'monospace', display: 'flex', flexDirection: 'column', gap: '4px' }}>
+                           {result.agent_trace.map((log, idx) => (
+                              <div key={idx} style={{ color: 'var(--text-muted)' }}>
+                                 [{idx + 1}] {log}
+                              </div>
+                           ))}
+                        </div>
+                     </details>
+                  )}
 
                   {/* Analytics Dashboard */}
-                  <AnalyticsDashboard analytics={result.analytics} />
+                  {result && <AnalyticsDashboard analytics={result.analytics} />}
 
                </div>
             )}